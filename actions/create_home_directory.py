@@ -17,7 +17,7 @@ import asyncio
 import getpass
 import pathlib
 
-from krs.users import list_users
+from krs.users import iter_users
 from krs.token import get_rest_client
 from krs.rabbitmq import RabbitMQListener
 
@@ -26,9 +26,7 @@ logger = logging.getLogger('create_home_directory')
 
 
 async def process(root_dir, keycloak_client=None):
-    ret = await list_users(rest_client=keycloak_client)
-    for username in ret:
-        user = ret[username]
+    async for user in iter_users(rest_client=keycloak_client):
         if ('attributes' in user and 'homeDirectory' in user['attributes']
                 and 'uidNumber' in user['attributes']
                 and 'gidNumber' in user['attributes']):
@@ -47,14 +45,19 @@ async def process(root_dir, keycloak_client=None):
 
 def listener(address=None, exchange=None, dedup=1, **kwargs):
     """Set up RabbitMQ listener"""
+    def has_home_directory(message):
+        return 'attributes' in message['representation'] and 'homeDirectory' in message['representation']['attributes']
+
     async def action(message):
         logger.debug(f'{message}')
-        if 'attributes' in message['representation'] and 'homeDirectory' in message['representation']['attributes']:
+        if has_home_directory(message):
             await process(**kwargs)
 
     args = {
         'routing_key': 'KK.EVENT.ADMIN.#.SUCCESS.USER.#',
         'dedup': dedup,
+        # every relevant message triggers the same full scan, so coalesce them all
+        'dedup_key': lambda message: '' if has_home_directory(message) else None,
     }
     if address:
         args['address'] = address
@@ -7,8 +7,10 @@ import time
 
 from krs.groups import get_group_membership
 from krs.token import get_rest_client
-from krs.ldap import LDAP
-from krs.rabbitmq import RabbitMQListener
+from krs.ldap import LDAP, AsyncLDAP
+from krs.mirror import RealmMirror
+from krs.posix_ids import PosixIdAllocator
+from krs.rabbitmq import RabbitMQListener, group_path_key
 
 
 logger = logging.getLogger('create_posix_account')
@@ -22,64 +24,71 @@ SHADOW_ATTRIBS = {
 }
 
 
-async def process(group_path, keycloak_client=None, dryrun=False, ldap_client=None):
-    # get highest uid, gid in ldap
-    max_uid = 0
-    max_gid = 0
-    users = ldap_client.list_users(['uidNumber', 'gidNumber', 'loginShell'])
+async def process(group_path, keycloak_client=None, dryrun=False, ldap_client=None, mirror=None, id_allocator=None):
+    ldap_client = AsyncLDAP.wrap(ldap_client)
+
+    # overlap the LDAP and Keycloak listings
+    if mirror:
+        users, groups = await asyncio.gather(
+            ldap_client.list_users(['uidNumber', 'gidNumber', 'loginShell']),
+            ldap_client.list_groups(attrs=['gidNumber']),
+        )
+        ret = mirror.get_group_membership(group_path)
+    else:
+        users, groups, ret = await asyncio.gather(
+            ldap_client.list_users(['uidNumber', 'gidNumber', 'loginShell']),
+            ldap_client.list_groups(attrs=['gidNumber']),
+            get_group_membership(group_path, rest_client=keycloak_client),
+        )
+
+    # index used uid, gid numbers in ldap
+    if id_allocator is None:
+        id_allocator = PosixIdAllocator(ldap_client.ldap_client)
+        id_allocator.load(users, groups)
     ldapPosix = set()
     for username in users:
         user = users[username]
-        if 'uidNumber' in user and user['uidNumber'] > max_uid:
-            max_uid = user['uidNumber']
-        if 'gidNumber' in user and user['gidNumber'] > max_gid:
-            max_gid = user['gidNumber']
         if 'loginShell' in user and user['loginShell'] and user['loginShell'] != '/sbin/nologin':
             ldapPosix.add(username)
-    groups = ldap_client.list_groups(attrs=['gidNumber'])
-    for cn in groups:
-        group = groups[cn]
-        if 'gidNumber' in group and group['gidNumber'] > max_gid:
-            max_gid = group['gidNumber']
-    max_id = max(max_uid, max_gid)
-
-    ret = await get_group_membership(group_path, rest_client=keycloak_client)
 
     # add new users
     for username in sorted(ret):
+        if username not in users:
+            logger.warning(f'skipping user {username}: not in LDAP')
+            continue
         user = users[username]
-        if username in users and 'uidNumber' in users[username]:
+        if 'uidNumber' in user:
             if 'loginShell' in user and user['loginShell'] and user['loginShell'] == '/sbin/nologin':
                 # add back an existing account access
                 attribs = {
                     'loginShell': '/bin/bash',
                 }
                 if not dryrun:
-                    ldap_client.modify_user(username, attribs)
+                    await ldap_client.modify_user(username, attribs)
                 logger.info(f're-enabled user {username} as a POSIX user')
         else:
             # new uid/gid
-            max_id += 1
+            posix_id = await asyncio.to_thread(id_allocator.allocate, dryrun=dryrun)
             shell = user['attributes']['loginShell'] if 'attributes' in user and 'loginShell' in user['attributes'] else '/bin/bash'
             attribs = {
-                'uidNumber': max_id,
-                'gidNumber': max_id,
+                'uidNumber': posix_id,
+                'gidNumber': posix_id,
                 'homeDirectory': f'/home/{username}',
                 'loginShell': shell,
             }
             if not dryrun:
-                ldap_client.modify_user(username, attribs, objectClass='posixAccount')
+                await ldap_client.modify_user(username, attribs, objectClass='posixAccount')
                 attribs = SHADOW_ATTRIBS.copy()
                 unix_days = int(time.time()/86400)
                 attribs.update({
                     'shadowExpire': unix_days+SHADOW_ATTRIBS['shadowMax'],
                     'shadowLastChange': unix_days,
                 })
-                ldap_client.modify_user(username, attribs, objectClass='shadowAccount')
+                await ldap_client.modify_user(username, attribs, objectClass='shadowAccount')
                 # make posix group
-                ldap_client.create_group(username, gidNumber=max_id)
-                ldap_client.add_user_group(username, username)
-            logger.info(f'added user {username} as a POSIX user with {max_id}:{max_id}')
+                await ldap_client.create_group(username, gidNumber=posix_id)
+                await ldap_client.add_user_group(username, username)
+            logger.info(f'added user {username} as a POSIX user with {posix_id}:{posix_id}')
 
     # remove users that lost POSIX access
     for username in sorted(ldapPosix.difference(ret)):
@@ -87,7 +96,7 @@ async def process(group_path, keycloak_client=None, dryrun=False, ldap_client=No
             'loginShell': '/sbin/nologin',
         }
         if not dryrun:
-            ldap_client.modify_user(username, attribs)
+            await ldap_client.modify_user(username, attribs)
         logger.info(f'disabled user {username} as a POSIX user')
 
     # sync with Keycloak
@@ -95,16 +104,26 @@ async def process(group_path, keycloak_client=None, dryrun=False, ldap_client=No
         await ldap_client.force_keycloak_sync(keycloak_client=keycloak_client)
 
 
-def listener(group_path, address=None, exchange=None, dedup=1, **kwargs):
-    """Set up RabbitMQ listener"""
+def listener(group_path, address=None, exchange=None, dedup=1, mirror=None, **kwargs):
+    """
+    Set up RabbitMQ listener.
+
+    If a `RealmMirror` is given, subscribe to it instead, and read Keycloak
+    state from the mirror. The mirror is returned to be started.
+    """
     async def action(message):
         logger.debug(f'{message}')
         if message['representation']['path'] == group_path:
-            await process(group_path, **kwargs)
+            await process(group_path, mirror=mirror, **kwargs)
+
+    if mirror:
+        mirror.subscribe(action, resource_types=['GROUP_MEMBERSHIP'], dedup=dedup, dedup_key=group_path_key)
+        return mirror
 
     args = {
         'routing_key': 'KK.EVENT.ADMIN.#.SUCCESS.GROUP_MEMBERSHIP.#',
         'dedup': dedup,
+        'dedup_key': group_path_key,
     }
     if address:
         args['address'] = address
@@ -123,6 +142,8 @@ def main():
     parser.add_argument('--listen', default=False, action='store_true', help='enable persistent RabbitMQ listener')
     parser.add_argument('--listen-address', help='RabbitMQ address, including user/pass')
     parser.add_argument('--listen-exchange', help='RabbitMQ exchange name')
+    parser.add_argument('--listen-mirror', default=False, action='store_true',
+                        help='keep an in-memory mirror of Keycloak while listening')
     parser.add_argument('--dryrun', action='store_true', help='dry run')
     args = vars(parser.parse_args())
 
@@ -131,14 +152,27 @@ def main():
     keycloak_client = get_rest_client()
     ldap_client = LDAP()
 
-    if args['listen']:
-        ret = listener(args['group_path'], address=args['listen_address'], exchange=args['listen_exchange'],
-                       keycloak_client=keycloak_client, ldap_client=ldap_client)
-        loop = asyncio.get_event_loop()
-        loop.create_task(ret.start())
-        loop.run_forever()
-    else:
-        asyncio.run(process(args['group_path'], keycloak_client=keycloak_client, dryrun=args['dryrun'], ldap_client=ldap_client))
+    try:
+        if args['listen']:
+            mirror = None
+            if args['listen_mirror']:
+                mirror = RealmMirror(keycloak_client, address=args['listen_address'], exchange=args['listen_exchange'])
+            id_allocator = PosixIdAllocator(ldap_client)
+            if id_allocator.counter_dn:
+                # with an LDAP counter, other processes can't hand out the same
+                # ids, so the index only needs to be loaded once
+                id_allocator.load()
+            else:
+                id_allocator = None
+            ret = listener(args['group_path'], address=args['listen_address'], exchange=args['listen_exchange'], mirror=mirror,
+                           keycloak_client=keycloak_client, ldap_client=ldap_client, id_allocator=id_allocator)
+            loop = asyncio.get_event_loop()
+            loop.create_task(ret.start())
+            loop.run_forever()
+        else:
+            asyncio.run(process(args['group_path'], keycloak_client=keycloak_client, dryrun=args['dryrun'], ldap_client=ldap_client))
+    finally:
+        ldap_client.close()
 
 
 if __name__ == '__main__':
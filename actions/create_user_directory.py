@@ -21,7 +21,7 @@ import subprocess
 from krs.groups import get_group_membership
 from krs.users import list_users
 from krs.token import get_rest_client
-from krs.rabbitmq import RabbitMQListener
+from krs.rabbitmq import RabbitMQListener, group_path_key
 
 from .util import QUOTAS
 
@@ -66,6 +66,7 @@ def listener(group_path, address=None, exchange=None, dedup=1, **kwargs):
     args = {
         'routing_key': 'KK.EVENT.ADMIN.#.SUCCESS.GROUP_MEMBERSHIP.#',
         'dedup': dedup,
+        'dedup_key': group_path_key,
     }
     if address:
         args['address'] = address
@@ -16,20 +16,24 @@ import json
 import logging
 import pathlib
 
+from krs.cache import RealmCache
 from krs.groups import get_group_membership
 from krs.users import list_users
 from krs.token import get_rest_client
-from krs.rabbitmq import RabbitMQListener
+from krs.rabbitmq import RabbitMQListener, group_path_key
 import actions.util
 
 
 logger = logging.getLogger('create_user_directory_ssh')
 
 
-async def process(server, group_path, root_dir, mode=0o755, dryrun=False, keycloak_client=None):
+async def process(server, group_path, root_dir, mode=0o755, dryrun=False, keycloak_client=None, realm_cache=None):
     skip_roles = actions.util.INGORE_DIR_ROLES.get(str(root_dir), [])
     group_members = await get_group_membership(group_path, rest_client=keycloak_client)
-    users = await list_users(rest_client=keycloak_client)
+    if realm_cache:
+        users = await realm_cache.list_users(require=group_members, rest_client=keycloak_client)
+    else:
+        users = await list_users(rest_client=keycloak_client)
 
     user_dirs = {}
     for username in group_members:
@@ -91,6 +95,7 @@ def listener(group_path, address=None, exchange=None, dedup=1, **kwargs):
     args = {
         'routing_key': 'KK.EVENT.ADMIN.#.SUCCESS.GROUP_MEMBERSHIP.#',
         'dedup': dedup,
+        'dedup_key': group_path_key,
     }
     if address:
         args['address'] = address
@@ -117,24 +122,26 @@ def main():
     parser.add_argument('--listen-address', help='RabbitMQ address, including user/pass')
     parser.add_argument('--listen-exchange', help='RabbitMQ exchange name')
     parser.add_argument('--dryrun', action='store_true', help='dry run')
+    parser.add_argument('--no-cache', action='store_true', help='bypass the realm snapshot cache (see krs/cache.py)')
     args = vars(parser.parse_args())
 
     logging.basicConfig(level=getattr(logging, args['log_level'].upper()))
 
     keycloak_client = get_rest_client()
+    realm_cache = RealmCache.from_environment(bypass=args['no_cache'])
 
     if args['listen']:
         ret = listener(address=args['listen_address'], exchange=args['listen_exchange'],
                        server=args['server'], group_path=args['group_path'],
                        root_dir=args['root_dir'], mode=args['mode'],
-                       keycloak_client=keycloak_client)
+                       keycloak_client=keycloak_client, realm_cache=realm_cache)
         loop = asyncio.get_event_loop()
         loop.create_task(ret.start())
         loop.run_forever()
     else:
         asyncio.run(process(args['server'], args['group_path'], args['root_dir'],
                             mode=args['mode'], dryrun=args['dryrun'],
-                            keycloak_client=keycloak_client))
+                            keycloak_client=keycloak_client, realm_cache=realm_cache))
 
 
 if __name__ == '__main__':
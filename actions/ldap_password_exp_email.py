@@ -7,9 +7,11 @@ import logging
 from pprint import pprint
 import time
 
+from ldap3.utils.conv import escape_filter_chars
+
 from krs.token import get_rest_client
 from krs.email import send_email
-from krs.ldap import LDAP
+from krs.ldap import LDAP, AsyncLDAP
 from krs.users import modify_user
 
 
@@ -75,7 +77,9 @@ async def _get_expired_users(ldap_users, usernames):
 
 
 async def process(username=None, dryrun=False, ldap_client=None, keycloak_client=None):
-    ldap_users = ldap_client.list_users()
+    ldap_client = AsyncLDAP.wrap(ldap_client)
+    search_filter = f'(uid={escape_filter_chars(username)})' if username else None
+    ldap_users = await ldap_client.list_users(['shadowExpire', 'shadowMax', 'givenName', 'mail'], search_filter=search_filter)
 
     if username:
         usernames = [username]
@@ -183,7 +187,10 @@ def main():
     ldap_client = LDAP()
     keycloak_client = get_rest_client()
 
-    asyncio.run(process(args['user'], dryrun=args['dryrun'], ldap_client=ldap_client, keycloak_client=keycloak_client))
+    try:
+        asyncio.run(process(args['user'], dryrun=args['dryrun'], ldap_client=ldap_client, keycloak_client=keycloak_client))
+    finally:
+        ldap_client.close()
 
 
 if __name__ == '__main__':
@@ -50,9 +50,10 @@ import logging
 
 from datetime import datetime, timedelta
 
+from krs.cache import RealmCache
 from krs.token import get_rest_client
 from krs.groups import get_group_membership, group_info, remove_user_group
-from krs.users import user_info
+from krs.users import get_users, UserDoesNotExist
 from krs.institutions import list_insts
 from krs.email import send_email
 
@@ -71,6 +72,23 @@ Please contact help@icecube.wisc.edu for support.
 """
 
 
+def _is_removable(user, allowed_institutions, removal_grace_days):
+    """Return whether a user is not allowed in a group and their grace period expired."""
+    user_insts = user['attributes'].get('institutions_last_seen', '')
+    user_insts = [i.strip() for i in user_insts.split(',') if i.strip()]
+    if allowed_institutions.intersection(user_insts):
+        return False
+    logger.debug(f"User {user['username']} is not a member of an allowed institution")
+    if 'institutions_last_changed' in user['attributes']:
+        insts_changed = user['attributes']['institutions_last_changed']
+        insts_changed = datetime.fromisoformat(insts_changed)
+        time_since_inst_change = datetime.now() - insts_changed
+        if time_since_inst_change < timedelta(days=removal_grace_days):
+            logger.debug(f"Leaving {user['username']} alone because grace period hasn't expired")
+            return False
+    return True
+
+
 async def _prune_group(group_path, removal_grace_days, allowed_institutions,
                        user_info_cache, keycloak_client, dryrun=False):
     """Remove from group_path users who are not members of allowed_institutions.
@@ -79,6 +97,9 @@ async def _prune_group(group_path, removal_grace_days, allowed_institutions,
     period before removal. Relies on user attributes `institutions_last_seen` and
     `institutions_last_changed`.
 
+    `user_info_cache` may be stale (e.g. from a realm snapshot), so users are
+    re-fetched from Keycloak before they are removed.
+
     Args:
         group_path (str): path of the group to be worked on
         removal_grace_days (int): delay of user removal
@@ -91,33 +112,32 @@ async def _prune_group(group_path, removal_grace_days, allowed_institutions,
     """
     removed_users = []
     ml_group_members = await get_group_membership(group_path, rest_client=keycloak_client)
-    for username in ml_group_members:
-        try:
-            user = user_info_cache[username]
-        except KeyError:
-            user = await user_info(username, rest_client=keycloak_client)
-            user_info_cache[username] = user
-
-        user_insts = user['attributes'].get('institutions_last_seen', '')
-        user_insts = [i.strip() for i in user_insts.split(',') if i.strip()]
-        if not allowed_institutions.intersection(user_insts):
-            logger.debug(f'User {username} is not allowed to be in {group_path}')
-            if 'institutions_last_changed' in user['attributes']:
-                insts_changed = user['attributes']['institutions_last_changed']
-                insts_changed = datetime.fromisoformat(insts_changed)
-                time_since_inst_change = datetime.now() - insts_changed
-                if time_since_inst_change < timedelta(days=removal_grace_days):
-                    logger.debug(f"Leaving {username} alone because grace period hasn't expired")
-                    continue
-            logger.info(f'Removing {username} from {group_path} (dryrun={dryrun})')
-            removed_users.append(username)
-            if not dryrun:
-                await remove_user_group(group_path, username, rest_client=keycloak_client)
+    users, missing = await get_users([u for u in ml_group_members if u not in user_info_cache],
+                                     rest_client=keycloak_client)
+    if missing:
+        raise UserDoesNotExist(f'members of {group_path} do not exist: {missing}')
+    user_info_cache.update(users)
+
+    candidates = [username for username in ml_group_members
+                  if _is_removable(user_info_cache[username], allowed_institutions, removal_grace_days)]
+    # Make removal decisions based on current data only
+    fresh_users, _ = await get_users(candidates, rest_client=keycloak_client, use_cache=False)
+    user_info_cache.update(fresh_users)
+    for username in candidates:
+        if username not in fresh_users:
+            logger.debug(f'Leaving {username} alone because the user no longer exists')
+            continue
+        if not _is_removable(fresh_users[username], allowed_institutions, removal_grace_days):
+            continue
+        logger.info(f'Removing {username} from {group_path} (dryrun={dryrun})')
+        removed_users.append(username)
+        if not dryrun:
+            await remove_user_group(group_path, username, rest_client=keycloak_client)
     return removed_users
 
 
 async def prune_mail_groups(removal_grace_days, single_group,
-                            send_notifications, keycloak_client, dryrun=False):
+                            send_notifications, keycloak_client, dryrun=False, realm_cache=None):
     """Recursively remove from mail group(s) users who are not members of the
     experiments listed in the `allow_members_from_experiments` attribute.
 
@@ -134,8 +154,11 @@ async def prune_mail_groups(removal_grace_days, single_group,
         send_notifications (bool): whether to send email notifications
         keycloak_client (RestClient): KeyCloak REST API client
         dryrun (bool): perform a mock run with no changes made
+        realm_cache (RealmCache): (optional) realm snapshot cache to get users from
     """
     user_info_cache = {}
+    if realm_cache:
+        user_info_cache.update(await realm_cache.list_users(rest_client=keycloak_client))
     ml_root_group = await group_info('/mail', rest_client=keycloak_client)
 
     if single_group:
@@ -205,6 +228,8 @@ def main():
                         help='REST client logging level.')
     parser.add_argument('--dryrun', action='store_true',
                         help='dry run: make no changes and send no notifications')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='bypass the realm snapshot cache (see krs/cache.py)')
     args = vars(parser.parse_args())
 
     logging.basicConfig(level=getattr(logging, args['log_level'].upper()))
@@ -220,7 +245,8 @@ def main():
         args['single_group'],
         args['send_notifications'],
         keycloak_client,
-        args['dryrun']))
+        args['dryrun'],
+        RealmCache.from_environment(bypass=args['no_cache'])))
 
 
 if __name__ == '__main__':
@@ -22,13 +22,17 @@ import time
 from google.oauth2 import service_account
 from googleapiclient.discovery import build
 
+from krs.cache import RealmCache
 from krs.ldap import LDAP
 from krs.token import get_rest_client
 from krs.users import list_users
 
-from actions.util import retry_execute
+from actions.util import batch_execute, retry_execute
 
 logger = logging.getLogger('sync_gws_accounts')
+
+# Max number of requests in a Directory API batch request
+DIRECTORY_API_BATCH_SIZE = 1000
 SHADOWEXPIRE_DAYS_REMAINING_CUTOFF_FOR_ELIGIBILITY = -365 * 2
 
 
@@ -50,21 +54,17 @@ def get_gws_accounts(gws_users_client):
     return dict((u['primaryEmail'].split('@')[0], u) for u in user_list)
 
 
-def add_canonical_alias(gws_users_client, kc_attrs):
-    """Add the canonical email address as an alias for the account in kc_attrs.
+def canonical_alias_request(gws_users_client, kc_attrs):
+    """Return a request adding the canonical email address as an alias for the account in kc_attrs.
 
     Args:
         gws_users_client (googleapiclient.discovery.Resource): Admin API Users resource.
         kc_attrs (dict): KeyCloak dictionary of the user being operated on.
     """
-    if not kc_attrs.get("attributes", {}).get("canonical_email"):
-        logger.error(f'can\'t set canonical alias because user {kc_attrs["username"]} '
-                     f'doesn\'t have attribute canonical_email')
-        return
     logger.info(f'adding to {kc_attrs["username"]} alias {kc_attrs["attributes"]["canonical_email"]}')
-    retry_execute(gws_users_client.aliases().insert(
+    return gws_users_client.aliases().insert(
         userKey=f'{kc_attrs["username"]}@icecube.wisc.edu',
-        body={'alias': kc_attrs["attributes"]["canonical_email"]}))
+        body={'alias': kc_attrs["attributes"]["canonical_email"]})
 
 
 def set_canonical_sendas(gws_creds, kc_attrs):
@@ -148,7 +148,7 @@ def create_missing_eligible_accounts(gws_users_client, gws_accounts, ldap_accoun
     Returns:
         List of created usernames (used for unit testing)
     """
-    created_usernames = []  # used for unit testing
+    user_requests = {}
     for username, attrs in kc_accounts.items():
         shadow_expire = ldap_accounts[username].get('shadowExpire', float('-inf'))
         if username not in gws_accounts and is_eligible(attrs, shadow_expire):
@@ -160,34 +160,56 @@ def create_missing_eligible_accounts(gws_users_client, gws_accounts, ldap_accoun
                              'givenName': attrs['firstName'],
                              'familyName': attrs['lastName']},
                          'password': ''.join(random.choices(string.ascii_letters, k=16))}
-            retry_execute(gws_users_client.insert(body=user_body))
-            time.sleep(3)  # give time to finish user creation before configuring it
-            created_usernames.append(username)
-            if attrs.get('attributes', {}).get('canonical_email'):
-                try:
-                    add_canonical_alias(gws_users_client, attrs)
-                    time.sleep(3)  # give time to finish alias creation before setting is as sendas
-                    set_canonical_sendas(gws_creds, attrs)
-                except:  # noqa
-                    logger.error(f'Account config failed midway. Canonical alias and/or SendAs of '
-                                 f'{username} must be manually set to {attrs["attributes"]["canonical_email"]}')
-                    raise
+            user_requests[username] = gws_users_client.insert(body=user_body)
         else:
             logger.debug(f'ignoring existing or ineligible user {username}')
+    if not user_requests:
+        return []
+
+    # Accounts are created in batches, then configured once they all exist
+    created, failed = batch_execute(gws_users_client, user_requests, batch_size=DIRECTORY_API_BATCH_SIZE)
+    for username, exc in failed.items():
+        logger.error(f'creating user {username} failed: {exc!r}')
+    created_usernames = [username for username in user_requests if username in created]
+
+    alias_requests = {username: canonical_alias_request(gws_users_client, kc_accounts[username])
+                      for username in created_usernames
+                      if kc_accounts[username].get('attributes', {}).get('canonical_email')}
+    if alias_requests:
+        time.sleep(3)  # give time to finish user creation before configuring it
+        aliased, alias_failed = batch_execute(gws_users_client, alias_requests,
+                                              batch_size=DIRECTORY_API_BATCH_SIZE)
+        time.sleep(3)  # give time to finish alias creation before setting is as sendas
+        for username in alias_requests:
+            attrs = kc_accounts[username]
+            try:
+                if username in alias_failed:
+                    raise alias_failed[username]
+                set_canonical_sendas(gws_creds, attrs)
+            except:  # noqa
+                logger.error(f'Account config failed midway. Canonical alias and/or SendAs of '
+                             f'{username} must be manually set to {attrs["attributes"]["canonical_email"]}')
+                raise
+    if failed:
+        raise next(iter(failed.values()))
     return created_usernames
 
 
 async def sync_gws_accounts(gws_users_client, ldap_client, keycloak_client,
-                            gws_creds, dryrun=False):
+                            gws_creds, dryrun=False, realm_cache=None):
     """This function looks like this to enable unit testing without needing to simulate
     clients for Google API, LDAP, and KeyCloak.
     """
-    kc_accounts = await list_users(rest_client=keycloak_client)
-    gws_accounts = get_gws_accounts(gws_users_client)
+    if realm_cache:
+        kc_accounts = await realm_cache.list_users(rest_client=keycloak_client)
+    else:
+        kc_accounts = await list_users(rest_client=keycloak_client)
+    # Google API calls block, so keep them off the event loop
+    gws_accounts = await asyncio.to_thread(get_gws_accounts, gws_users_client)
     ldap_accounts = ldap_client.list_users(attrs=['shadowExpire'])  # noqa pycharm bug?
 
-    create_missing_eligible_accounts(gws_users_client, gws_accounts, ldap_accounts,
-                                     kc_accounts, gws_creds, dryrun)
+    await asyncio.to_thread(create_missing_eligible_accounts, gws_users_client, gws_accounts,
+                            ldap_accounts, kc_accounts, gws_creds, dryrun)
 
 
 def main():
@@ -209,6 +231,8 @@ def main():
                         help='JSON file with service account credentials')
     parser.add_argument('--sa-subject', metavar='ACCOUNT', required=True,
                         help='principal on whose behalf the service account will act')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='bypass the realm snapshot cache (see krs/cache.py)')
 
     args = vars(parser.parse_args())
 
@@ -230,7 +254,8 @@ def main():
         ldap_client=ldap_client,
         keycloak_client=keycloak_client,
         gws_creds=creds,
-        dryrun=args['dryrun']))
+        dryrun=args['dryrun'],
+        realm_cache=RealmCache.from_environment(bypass=args['no_cache'])))
 
 
 if __name__ == '__main__':
@@ -49,7 +49,7 @@ from krs.email import send_email
 from krs.token import get_rest_client
 from krs.groups import get_group_membership, group_info, GroupDoesNotExist
 
-from actions.util import retry_execute
+from actions.util import API_STATS, batch_execute, retry_execute_async
 
 
 ACTION_ID = 'sync_gws_calendars'
@@ -83,8 +83,11 @@ because you were added or removed from the corresponding subgroup of
 
 ChangeLog = namedtuple('ChangeLog', 'added updated removed')
 
+# Max number of requests in a Calendar API batch request
+CALENDAR_API_BATCH_SIZE = 50
 
-def get_cal_info_text(cal_ids, calendars_res):
+
+async def get_cal_info_text(cal_ids, calendars_res):
     """Get a text block with summary (name) and descriptions of calendars.
 
     Args:
@@ -96,7 +99,7 @@ def get_cal_info_text(cal_ids, calendars_res):
     cal_infos = []
     for cal_id in cal_ids:
         req = calendars_res.get(calendarId=cal_id)
-        metadata = retry_execute(req)
+        metadata = await retry_execute_async(req)
         if metadata.get('description'):
             cal_infos.append(f"{metadata['summary']}: {metadata.get('description')}")
         else:
@@ -104,7 +107,7 @@ def get_cal_info_text(cal_ids, calendars_res):
     return '\n'.join(sorted(cal_infos))
 
 
-def get_gws_cal_user_acl_rules(calendar_id, calendar_acl_res):
+async def get_gws_cal_user_acl_rules(calendar_id, calendar_acl_res):
     """Get a filtered list of Google Calendar ACL rules.
 
     We filter out rules we are not supposed to deal with.
@@ -118,7 +121,7 @@ def get_gws_cal_user_acl_rules(calendar_id, calendar_acl_res):
     acl_rules = {}
     request = calendar_acl_res.list(calendarId=calendar_id)
     while request is not None:
-        response = retry_execute(request)
+        response = await retry_execute_async(request)
         logger.debug(f"get_gws_cal_user_acl_rules response\n{pformat(response)}")
         for item in response.get('items', []):
             if (item['kind'] != 'calendar#aclRule'
@@ -185,7 +188,7 @@ async def sync_gws_calendars(calendar_acl, calendar_cals, keycloak, creds, dryru
         # change log is used to generate notifications
         change_log = ChangeLog(defaultdict(list), defaultdict(list), defaultdict(list))
         for cal_id in cal_ids:
-            cal_meta = retry_execute(calendar_cals.get(calendarId=cal_id))
+            cal_meta = await retry_execute_async(calendar_cals.get(calendarId=cal_id))
             change_log = await sync_gws_calendar(cal_id=cal_id,
                                                  cal_name=cal_meta['summary'],
                                                  calendar_acl=calendar_acl,
@@ -201,7 +204,7 @@ async def sync_gws_calendars(calendar_acl, calendar_cals, keycloak, creds, dryru
         # new calendars may have been added/removed between runs of this script.
         for addr, cids in change_log.added.items():
             logger.info(f"Notifying {addr} of being subscribed to new cals ({dryrun=}, {notify=})")
-            cal_descr = get_cal_info_text(cids, calendar_cals)
+            cal_descr = await get_cal_info_text(cids, calendar_cals)
             if notify and not dryrun:
                 send_email(addr, "You have been subscribed to WIPAC calendars",
                            CALENDAR_ADDED_MSG.format(addr=addr, calendars=cal_descr,
@@ -210,7 +213,7 @@ async def sync_gws_calendars(calendar_acl, calendar_cals, keycloak, creds, dryru
 
         for addr, cids in change_log.updated.items():
             logger.info(f"Notifying {addr} of role change ({dryrun=}, {notify=})")
-            cal_descr = get_cal_info_text(cids, calendar_cals)
+            cal_descr = await get_cal_info_text(cids, calendar_cals)
             if notify and not dryrun:
                 send_email(addr, "Your permissions for some WIPAC calendars have changed",
                            CALENDAR_ROLE_CHANGED_MSG.format(addr=addr, calendars=cal_descr,
@@ -219,7 +222,7 @@ async def sync_gws_calendars(calendar_acl, calendar_cals, keycloak, creds, dryru
 
         for addr, cids in change_log.removed.items():
             logger.info(f"Notifying {addr} of removal ({dryrun=}, {notify=})")
-            cal_descr = get_cal_info_text(cids, calendar_cals)
+            cal_descr = await get_cal_info_text(cids, calendar_cals)
             if notify and not dryrun:
                 send_email(addr, "You have been subscribed to new WIPAC calendars",
                            CALENDAR_ROLE_CHANGED_MSG.format(addr=addr, group=kc_cal_group['path'],
@@ -238,7 +241,7 @@ async def sync_gws_calendar(cal_id, cal_name, calendar_acl, target_rules, creds,
         change_log (ChangeLog): Data structure for logging applied changes
         dryrun (bool): dryrun
     """
-    actual_rules = get_gws_cal_user_acl_rules(cal_id, calendar_acl)
+    actual_rules = await get_gws_cal_user_acl_rules(cal_id, calendar_acl)
     logger.debug(f"{target_rules=}")
 
     # Owners are managed out of band. Exclude them from actual and target ACL rules.
@@ -252,41 +255,57 @@ async def sync_gws_calendar(cal_id, cal_name, calendar_acl, target_rules, creds,
     logger.debug(f"{actual_rules=}")
     logger.debug(f"{target_rules=}")
 
+    # Changes of different subscribers are independent, so they are made in
+    # batches, and logged only if they succeed (or if this is a dry run).
+    requests = {}
+    logs = {}
+
     # Remove extraneous subscribers.
     for extraneous_addr in set(actual_rules) - set(target_rules):
-        change_log.removed[extraneous_addr].append(cal_id)
         logger.info(f"Removing extraneous {extraneous_addr} from '{cal_name}' ({dryrun=})")
-        if dryrun:
-            continue
-        req = calendar_acl.delete(calendarId=cal_id, ruleId=actual_rules[extraneous_addr]['id'])
-        retry_execute(req)
+        logs[extraneous_addr] = change_log.removed
+        if not dryrun:
+            requests[extraneous_addr] = calendar_acl.delete(calendarId=cal_id,
+                                                            ruleId=actual_rules[extraneous_addr]['id'])
 
     # Update roles of existing subscribers if needed.
     for existing_addr in set(actual_rules).intersection(set(target_rules)):
         if actual_rules[existing_addr]['role'] == target_rules[existing_addr]['role']:
             continue
-        change_log.updated[existing_addr].append(cal_id)
         logger.info(f"Change {actual_rules[existing_addr]} to {target_rules[existing_addr]} of {cal_name} ({dryrun=})")
-        if dryrun:
-            continue
-        req = calendar_acl.patch(calendarId=cal_id, ruleId=actual_rules[existing_addr]['id'],
-                                 body=target_rules[existing_addr])
-        retry_execute(req)
+        logs[existing_addr] = change_log.updated
+        if not dryrun:
+            requests[existing_addr] = calendar_acl.patch(calendarId=cal_id, ruleId=actual_rules[existing_addr]['id'],
+                                                         body=target_rules[existing_addr])
 
     # Add missing subscribers.
     for missing_addr in set(target_rules) - set(actual_rules):
         logger.info(f"Adding {target_rules[missing_addr]} to '{cal_name}' ({dryrun=})")
-        change_log.added[missing_addr].append(cal_id)
-        if dryrun:
-            continue
-        logger.info(f"Inserting ACL {target_rules[missing_addr]} into {cal_name}")
-        req = calendar_acl.insert(calendarId=cal_id, body=target_rules[missing_addr], sendNotifications=False)
-        retry_execute(req)
-        user_creds = creds.with_subject(missing_addr)
-        user_cal_list = build('calendar', 'v3', credentials=user_creds, cache_discovery=False).calendarList()
-        logger.info(f"Forcing display of calendar '{cal_name}' for {missing_addr}")
-        req = user_cal_list.insert(body={'id': cal_id, 'selected': True})
-        retry_execute(req)
+        logs[missing_addr] = change_log.added
+        if not dryrun:
+            requests[missing_addr] = calendar_acl.insert(calendarId=cal_id, body=target_rules[missing_addr],
+                                                         sendNotifications=False)
+
+    if dryrun:
+        for addr, log in logs.items():
+            log[addr].append(cal_id)
+        return change_log
+
+    done, failed = await asyncio.to_thread(batch_execute, calendar_acl, requests,
+                                           batch_size=CALENDAR_API_BATCH_SIZE)
+    for addr in done:
+        logs[addr][addr].append(cal_id)
+        if logs[addr] is change_log.added:
+            # calendarList entries are per-user, so these can't be batched
+            user_creds = creds.with_subject(addr)
+            user_cal_list = build('calendar', 'v3', credentials=user_creds, cache_discovery=False).calendarList()
+            logger.info(f"Forcing display of calendar '{cal_name}' for {addr}")
+            req = user_cal_list.insert(body={'id': cal_id, 'selected': True})
+            await retry_execute_async(req)
+    for addr, exc in failed.items():
+        logger.error(f"Failed to update ACL of {addr} in '{cal_name}': {exc!r}")
+    if failed:
+        raise next(iter(failed.values()))
 
     return change_log
 
@@ -337,6 +356,7 @@ def main():
     asyncio.run(sync_gws_calendars(calendar_acl_res, calendar_cals_res,
                                    keycloak_client, creds,
                                    args['dryrun'], args['notify']))
+    logger.info(f"Google API request stats:\n{pformat(API_STATS.summary())}")
 
 
 if __name__ == '__main__':
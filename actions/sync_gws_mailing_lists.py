@@ -56,9 +56,8 @@ PLEASE KEEP THAT PAGE IN-SYNC WITH THIS CODE.
 import asyncio
 import logging
 
-from asyncache import cached  # type: ignore
-from cachetools import Cache
 from collections import defaultdict
+from pprint import pformat
 
 # noinspection PyProtectedMember
 from googleapiclient.discovery import build, Resource  # type: ignore
@@ -67,16 +66,19 @@ from google.oauth2 import service_account  # type: ignore
 from rest_tools.client import RestClient
 
 from krs.token import get_rest_client
-from krs.groups import get_group_membership, group_info
-from krs.users import user_info, UserDoesNotExist
+from krs.groups import GroupIndex, get_group_membership, get_memberships, group_info
+from krs.users import get_users, user_info, UserDoesNotExist
 from krs.email import send_email
 
-from actions.util import retry_execute, group_tree_to_list, reflow_text
+from actions.util import API_STATS, GoogleApiExecutor, group_tree_to_list, reflow_text
 
 ACTION_ID = 'sync_gws_mailing_lists'
 SKIP_GROUP_ATTR_NAME = f"{ACTION_ID}_skip_this_group"  # link:Uo1in3ae
 logger = logging.getLogger(ACTION_ID)
 
+# Max number of requests in a Directory API batch request
+DIRECTORY_API_BATCH_SIZE = 1000
+
 # Paragraph separator. Used for re-flowing text.
 PARA_SEP = "\n\n"
 
@@ -103,12 +105,7 @@ subgroups, or you have updated your preferred address for mailing lists."""
                           + PARA_SEP + MESSAGE_FOOTER)
 
 
-@cached(Cache(maxsize=5000))
-async def cached_user_info(username, rest_client):
-    return await user_info(username, rest_client=rest_client)
-
-
-def get_gws_group_members(group_email, gws_members_client) -> list:
+async def get_gws_group_members(group_email, gws_members_client, executor: GoogleApiExecutor) -> list:
     """Return a list of Google Workspace group member dicts.
 
     Specification of group member dictionary is here:
@@ -117,6 +114,7 @@ def get_gws_group_members(group_email, gws_members_client) -> list:
     Args:
         group_email (str): Google Workspace group email
         gws_members_client (googleapiclient.discovery.Resource): Admin API Members resource
+        executor (GoogleApiExecutor): executor of Google API requests
 
     Returns:
         list: list of member dicts
@@ -124,21 +122,23 @@ def get_gws_group_members(group_email, gws_members_client) -> list:
     ret = []
     req = gws_members_client.list(groupKey=group_email)
     while req is not None:
-        res = retry_execute(req)
+        res = await executor.execute(req)
         if 'members' in res:
             ret.extend(res['members'])
         req = gws_members_client.list_next(req, res)
     return ret
 
 
-async def get_gws_members_from_kc_group(group_path, role, keycloak_client) -> dict:
+async def get_gws_members_from_kc_group(group_path, role, keycloak_client, usernames=None) -> dict:
     """Return a dict of GWS group member object dicts based on member emails of the
-    keycloak group"""
+    keycloak group. Pass `usernames` if the group's membership is already known."""
     ret = {}
-    usernames = await get_group_membership(group_path, rest_client=keycloak_client)
-    # noinspection PyCallingNonCallable
-    users = [await cached_user_info(u, keycloak_client) for u in usernames]
-    for user in users:
+    if usernames is None:
+        usernames = await get_group_membership(group_path, rest_client=keycloak_client)
+    users, missing = await get_users(usernames, rest_client=keycloak_client)
+    if missing:
+        logger.warning(f"Skipping members of {group_path} that don't exist: {missing}")
+    for user in users.values():
         # See file docstring for the explanation of why we try to use the canonical address.
         canonical = user['attributes'].get('canonical_email')
         if not canonical:
@@ -171,61 +171,86 @@ async def get_gws_members_from_kc_group(group_path, role, keycloak_client) -> di
     return ret
 
 
-async def sync_kc_group_tree_to_gws(kc_root_group: dict, group_email: str, keycloak_client: RestClient,
-                                    gws_members_client: Resource, send_notifications: bool, dryrun: bool):
-    """
-    Sync a single KeyCloak mailing group with subgroups to Google Workspace Group.
+async def get_kc_target_membership(kc_root_group: dict, keycloak_client: RestClient,
+                                   group_index: GroupIndex | None = None) -> tuple:
+    """Determine who should be subscribed to the list of a Keycloak mail group, and in what role.
 
-    Note that only group members whose role is 'MANAGER' or 'MEMBER' are managed.
-    Nothing is done with the 'OWNER' members (it's assumed these are managed out
-    ouf band). List of members who ought to be subscribed to the list are determined
-    recursively. See file docstring for important information subgroup handling.
+    Returns:
+        tuple: ({email: GWS member dict}, {email: [source keycloak group paths]})
     """
-    # Determine who should be subscribed to the list and in what role.
     member_kc_groups = defaultdict(list)  # track member's source keycloak group by email
     all_intended_members = {}
     all_intended_managers = {}
-    for group in group_tree_to_list(kc_root_group):
+    kc_groups = group_tree_to_list(kc_root_group)
+    kc_memberships, _ = await get_memberships([group['id'] for group in kc_groups],
+                                              rest_client=keycloak_client, group_index=group_index)
+    for group in kc_groups:
+        usernames = kc_memberships[group['path']]
         if group['name'] in ('_admin', '_managers'):
-            group_members = await get_gws_members_from_kc_group(group['path'], 'MANAGER', keycloak_client)
+            group_members = await get_gws_members_from_kc_group(group['path'], 'MANAGER', keycloak_client, usernames)
             all_intended_managers |= group_members
         else:
-            group_members = await get_gws_members_from_kc_group(group['path'], 'MEMBER', keycloak_client)
+            group_members = await get_gws_members_from_kc_group(group['path'], 'MEMBER', keycloak_client, usernames)
             all_intended_members |= group_members
         for email in group_members:
             member_kc_groups[email].append(group['path'])
 
     # A user may belong to both a regular group and a managerial group.
     # If that's the case, we want to use their manager settings.
-    target_membership = all_intended_members | all_intended_managers
+    return all_intended_members | all_intended_managers, member_kc_groups
+
+
+async def sync_kc_group_tree_to_gws(kc_root_group: dict, group_email: str, keycloak_client: RestClient,
+                                    gws_members_client: Resource, send_notifications: bool, dryrun: bool,
+                                    group_index: GroupIndex | None = None, *,
+                                    executor: GoogleApiExecutor):
+    """
+    Sync a single KeyCloak mailing group with subgroups to Google Workspace Group.
+
+    Note that only group members whose role is 'MANAGER' or 'MEMBER' are managed.
+    Nothing is done with the 'OWNER' members (it's assumed these are managed out
+    ouf band). List of members who ought to be subscribed to the list are determined
+    recursively. See file docstring for important information subgroup handling.
+
+    The Keycloak and Google Workspace memberships are retrieved concurrently,
+    and Google Workspace changes are made with batch requests through `executor`.
+    """
     # When we subscribe a non-icecube email in lower case, it may end up being subscribed
     # as mixed case, so we need to normalize. My theory is that it happens when the email
     # is associated with another Google Workspace where it exists in mixed case form.
+    (target_membership, member_kc_groups), gws_members = await asyncio.gather(
+        get_kc_target_membership(kc_root_group, keycloak_client, group_index),
+        get_gws_group_members(group_email, gws_members_client, executor))
     actual_membership = {member['email'].lower(): {'email': member['email'].lower(), 'role': member['role']}
-                         for member in get_gws_group_members(group_email, gws_members_client)}
+                         for member in gws_members}
 
     # Unsubscribe extraneous addresses. This needs to be done before adding new
     # emails in order to avoid "member already exists" errors when a subscriber
     # sets their `mailing_list_email` attribute to their username@icecube.wisc.edu
     # address or a non-canonical alias.
+    deletions = {}
     for email in set(actual_membership) - set(target_membership):
         if actual_membership[email]['role'] == 'OWNER':
             # Don't unsubscribe owners. They are managed out-of-band
             continue
         logger.info(f"Removing from {group_email} {email} (dryrun={dryrun})")
-        if dryrun:
-            continue
-        retry_execute(gws_members_client.delete(groupKey=group_email, memberKey=email))
-        if send_notifications:
-            logger.info(f"Sending notification to {email}")
-            send_email(email, f"You have been unsubscribed from {group_email}",
-                       reflow_text(
-                           UNSUBSCRIPTION_MESSAGE.format(
-                               group_email=group_email, email=email,
-                               role=actual_membership[email]['role'],
-                               group_path=kc_root_group['path']),
-                           para_sep=PARA_SEP),
-                       headline='IceCube Mailing List Management')
+        if not dryrun:
+            deletions[email] = gws_members_client.delete(groupKey=group_email, memberKey=email)
+    if deletions:
+        deleted, failed = await executor.execute_batch(gws_members_client, deletions,
+                                                       batch_size=DIRECTORY_API_BATCH_SIZE)
+        for email in deleted:
+            if send_notifications:
+                logger.info(f"Sending notification to {email}")
+                send_email(email, f"You have been unsubscribed from {group_email}",
+                           reflow_text(
+                               UNSUBSCRIPTION_MESSAGE.format(
+                                   group_email=group_email, email=email,
+                                   role=actual_membership[email]['role'],
+                                   group_path=kc_root_group['path']),
+                               para_sep=PARA_SEP),
+                           headline='IceCube Mailing List Management')
+        raise_batch_failures(failed, group_email, 'remove')
 
     # Build list of owners' canonical emails. Because owners are managed out of band,
     # we can have a situation where an owner who is a member of the Keycloak group is
@@ -237,12 +262,14 @@ async def sync_kc_group_tree_to_gws(kc_root_group: dict, group_email: str, keycl
         if owner_email.endswith('@icecube.wisc.edu'):
             local_part = owner_email.split('@')[0]
             try:
-                user = await cached_user_info(local_part, keycloak_client)
+                user = await user_info(local_part, rest_client=keycloak_client)
             except UserDoesNotExist:
                 # Move on if local_part is not a username or user only exists in GWS
                 continue
             actual_owner_canonical_emails.add(user['attributes'].get('canonical_email'))
 
+    insertions = {}
+    role_changes = {}
     for email, body in target_membership.items():
         if email in actual_owner_canonical_emails:
             # Owners are supposed to be managed out-of-band, but this owner is a member
@@ -252,43 +279,57 @@ async def sync_kc_group_tree_to_gws(kc_root_group: dict, group_email: str, keycl
             continue
         if email not in actual_membership:
             logger.info(f"Inserting into {group_email} {body} (dryrun={dryrun})")
-            if dryrun:
-                continue
-            retry_execute(gws_members_client.insert(groupKey=group_email, body=body))
-            if send_notifications:
-                logger.info(f"Sending notification to {email}")
-                send_email(email, f"You have been subscribed to {group_email}",
-                           reflow_text(
-                               SUBSCRIPTION_MESSAGE.format(
-                                   group_email=group_email, email=email, role=body['role'],
-                                   delivery=body['delivery_settings'],
-                                   qualifying_groups=', '.join(member_kc_groups[email]),
-                                   none_explanation=(PARA_SEP + NONE_EXPLANATION
-                                                     if body['delivery_settings'] == 'NONE'
-                                                     else '')),
-                               para_sep=PARA_SEP),
-                           headline='IceCube Mailing List Management')
+            if not dryrun:
+                insertions[email] = gws_members_client.insert(groupKey=group_email, body=body)
         # If email already subscribed, check if we need to update the role
         elif body['role'] != actual_membership[email]['role']:
             logger.info(f"Patching in {group_email} role of {email} to {body['role']} (dryrun={dryrun})")
-            if dryrun:
-                continue
-            retry_execute(gws_members_client.patch(groupKey=group_email, memberKey=email,
-                                                   body={'email': email, 'role': body['role']}))
-            if send_notifications:
-                logger.info(f"Sending notification to {email}")
-                send_email(email, f"Your member role in {group_email} has changed",
-                           reflow_text(
-                               ROLE_CHANGE_MESSAGE.format(
-                                   group_email=group_email, email=email,
-                                   old_role=actual_membership[email]['role'],
-                                   new_role=body['role'], group_path=kc_root_group['path']),
-                               para_sep=PARA_SEP),
-                           headline='IceCube Mailing List Management')
+            if not dryrun:
+                role_changes[email] = gws_members_client.patch(groupKey=group_email, memberKey=email,
+                                                               body={'email': email, 'role': body['role']})
+    if not (insertions or role_changes):
+        return
+    done, failed = await executor.execute_batch(gws_members_client, insertions | role_changes,
+                                                batch_size=DIRECTORY_API_BATCH_SIZE)
+
+    for email in done if send_notifications else []:
+        body = target_membership[email]
+        logger.info(f"Sending notification to {email}")
+        if email in insertions:
+            send_email(email, f"You have been subscribed to {group_email}",
+                       reflow_text(
+                           SUBSCRIPTION_MESSAGE.format(
+                               group_email=group_email, email=email, role=body['role'],
+                               delivery=body['delivery_settings'],
+                               qualifying_groups=', '.join(member_kc_groups[email]),
+                               none_explanation=(PARA_SEP + NONE_EXPLANATION
+                                                 if body['delivery_settings'] == 'NONE'
+                                                 else '')),
+                           para_sep=PARA_SEP),
+                       headline='IceCube Mailing List Management')
+        else:
+            send_email(email, f"Your member role in {group_email} has changed",
+                       reflow_text(
+                           ROLE_CHANGE_MESSAGE.format(
+                               group_email=group_email, email=email,
+                               old_role=actual_membership[email]['role'],
+                               new_role=body['role'], group_path=kc_root_group['path']),
+                           para_sep=PARA_SEP),
+                       headline='IceCube Mailing List Management')
+    raise_batch_failures(failed, group_email, 'add or update')
+
+
+def raise_batch_failures(failed, group_email, operation):
+    """Log failed member changes, then raise the first failure, if any."""
+    for email, exc in failed.items():
+        logger.error(f"Failed to {operation} {email} in {group_email}: {exc!r}")
+    if failed:
+        raise next(iter(failed.values()))
 
 
 async def sync_gws_mailing_lists(gws_members_client, gws_groups_client, keycloak_client,
-                                 single_group=None, send_notifications=True, dryrun=False):
+                                 single_group=None, send_notifications=True, dryrun=False,
+                                 concurrency=8, *, executor):
     """Synchronize memberships of Google Workspace groups to their corresponding
     Keycloak mailing list groups, and optionally notify users of changes.
 
@@ -300,6 +341,9 @@ async def sync_gws_mailing_lists(gws_members_client, gws_groups_client, keycloak
     have attribute `email` that will be used to map it to a Google Workspace
     group.
 
+    Up to `concurrency` groups are synced in parallel. A failure to sync one
+    group doesn't stop the others; the first failure is raised at the end.
+
     See file docstring for detailed documentation.
 
     Args:
@@ -309,16 +353,24 @@ async def sync_gws_mailing_lists(gws_members_client, gws_groups_client, keycloak
         single_group (str): only consider this group instead of all groups
         send_notifications (bool): whether to send email notifications
         dryrun (bool): Perform a mock run with no changes made
+        concurrency (int): max number of groups synced in parallel
+        executor (GoogleApiExecutor): executor of Google API requests, which must
+                                      be created with the service account credentials
+                                      if the clients share an httplib2 transport
     """
-    res = retry_execute(gws_groups_client.list(customer='my_customer'))
+    group_index, res = await asyncio.gather(
+        GroupIndex.load(rest_client=keycloak_client),
+        executor.execute(gws_groups_client.list(customer='my_customer')))
     gws_group_emails = [g['email'] for g in res.get('groups', [])]
 
-    kc_ml_group_root = await group_info('/mail', rest_client=keycloak_client)
+    kc_ml_group_root = await group_info('/mail', rest_client=keycloak_client, group_index=group_index)
     if single_group:
         logger.warning(f"Only group {single_group} will be considered.")
         kc_ml_groups = [sg for sg in kc_ml_group_root['subGroups'] if sg['name'] == single_group]
     else:
         kc_ml_groups = kc_ml_group_root['subGroups']
+
+    to_sync = []
     for kc_ml_group in kc_ml_groups:
         if kc_ml_group['attributes'].get(SKIP_GROUP_ATTR_NAME, '').strip().lower() == "true":
             if single_group:
@@ -335,6 +387,7 @@ async def sync_gws_mailing_lists(gws_members_client, gws_groups_client, keycloak
 
         # Sanity check. Subgroups of mail groups shouldn't have attribute 'email',
         # and if they do, it definitely can't be different from the root mail group.
+        conflicting_email = False
         for subgroup in group_tree_to_list(kc_ml_group)[1:]:
             if sg_email := subgroup.get('attributes', {}).get('email'):
                 if sg_email == group_email:
@@ -343,10 +396,27 @@ async def sync_gws_mailing_lists(gws_members_client, gws_groups_client, keycloak
                     logger.error(f"Group {subgroup['path']} defines email={sg_email},"
                                  f" which is different from {kc_ml_group['path']}'s email={group_email}."
                                  f"This is not allowed. Skipping {kc_ml_group['path']}")
-                    continue
+                    conflicting_email = True
+        if conflicting_email:
+            continue
+        to_sync.append((kc_ml_group, group_email))
 
-        await sync_kc_group_tree_to_gws(kc_ml_group, group_email, keycloak_client, gws_members_client,
-                                        send_notifications, dryrun)
+    sem = asyncio.Semaphore(concurrency)
+
+    async def sync(kc_ml_group, group_email):
+        async with sem:
+            try:
+                await sync_kc_group_tree_to_gws(kc_ml_group, group_email, keycloak_client, gws_members_client,
+                                                send_notifications, dryrun, group_index=group_index,
+                                                executor=executor)
+            except Exception as exc:
+                logger.error(f"Failed to sync {kc_ml_group['path']} to {group_email}: {exc!r}")
+                raise
+
+    results = await asyncio.gather(*[sync(*args) for args in to_sync], return_exceptions=True)
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
 
 
 def main():
@@ -373,6 +443,12 @@ def main():
                         help='Logging level of this application (not dependencies).')
     parser.add_argument('--log-level-client', default='warning', choices=('debug', 'info', 'warning', 'error'),
                         help='REST client logging level.')
+    parser.add_argument('--concurrency', type=int, default=8,
+                        help='max number of mailing lists synced in parallel')
+    parser.add_argument('--gws-workers', type=int, default=8,
+                        help='max number of concurrent Google Workspace requests')
+    parser.add_argument('--gws-rate', type=float, default=20,
+                        help='max number of Google Workspace requests per second')
     parser.add_argument('--dryrun', action='store_true', help='dry run')
     args = vars(parser.parse_args())
 
@@ -391,10 +467,16 @@ def main():
     gws_directory = build('admin', 'directory_v1', credentials=creds, cache_discovery=False)
     gws_members_client = gws_directory.members()
     gws_groups_client = gws_directory.groups()
-
-    asyncio.run(sync_gws_mailing_lists(gws_members_client, gws_groups_client, keycloak_client,
-                                       args['single_group'], args['send_notifications'],
-                                       dryrun=args['dryrun']))
+    executor = GoogleApiExecutor(max_workers=args['gws_workers'], rate=args['gws_rate'], credentials=creds)
+
+    try:
+        asyncio.run(sync_gws_mailing_lists(gws_members_client, gws_groups_client, keycloak_client,
+                                           args['single_group'], args['send_notifications'],
+                                           dryrun=args['dryrun'], concurrency=args['concurrency'],
+                                           executor=executor))
+    finally:
+        executor.shutdown()
+    logger.info(f'Google API request stats:\n{pformat(API_STATS.summary())}')
 
 
 if __name__ == '__main__':
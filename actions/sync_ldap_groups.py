@@ -10,8 +10,10 @@ import string
 
 from krs.groups import list_groups, get_group_membership_by_id
 from krs.token import get_rest_client
-from krs.ldap import LDAP, get_ldap_members
-from krs.rabbitmq import RabbitMQListener
+from krs.ldap import LDAP, AsyncLDAP, get_ldap_members
+from krs.mirror import RealmMirror
+from krs.posix_ids import PosixIdAllocator
+from krs.rabbitmq import RabbitMQListener, group_path_key
 
 
 logger = logging.getLogger('sync_ldap_groups')
@@ -26,24 +28,35 @@ def flatten_group_name(path):
     return path
 
 
-async def process(group_path, ldap_ou=None, posix=False, recursive=False, dryrun=False, keycloak_client=None, ldap_client=None):
-    ldap_groups = ldap_client.list_groups(groupbase=ldap_ou)
-    ldap_users = ldap_client.list_users()
+async def process(group_path, ldap_ou=None, posix=False, recursive=False, dryrun=False,
+                  keycloak_client=None, ldap_client=None, mirror=None, id_allocator=None):
+    ldap_client = AsyncLDAP.wrap(ldap_client)
+
+    # overlap the LDAP and Keycloak listings
+    if mirror:
+        ret = mirror.groups
+        ldap_groups, ldap_users = await asyncio.gather(
+            ldap_client.list_groups(groupbase=ldap_ou),
+            ldap_client.list_users(['uid']),
+        )
+    else:
+        ldap_groups, ldap_users, ret = await asyncio.gather(
+            ldap_client.list_groups(groupbase=ldap_ou),
+            ldap_client.list_users(['uid']),
+            list_groups(rest_client=keycloak_client),
+        )
 
     if posix:
-        # get highest gid in ldap
-        max_gid = 0
-        ldap_users = ldap_client.list_users(['gidNumber'])
-        for username in ldap_users:
-            user = ldap_users[username]
-            if 'gidNumber' in user and user['gidNumber'] > max_gid:
-                max_gid = user['gidNumber']
+        # index used uid, gid numbers in ldap; new gids are also unused as
+        # uids, so they never collide with a user's private group
+        if id_allocator is None:
+            id_allocator = PosixIdAllocator(ldap_client.ldap_client)
+            await asyncio.to_thread(id_allocator.load)
         for cn in ldap_groups:
             group = ldap_groups[cn]
-            if 'gidNumber' in group and group['gidNumber'] > max_gid:
-                max_gid = group['gidNumber']
+            if 'gidNumber' in group:
+                id_allocator.add_used(group['gidNumber'])
 
-    ret = await list_groups(rest_client=keycloak_client)
     groups = []
     for p in sorted(ret):
         if not p.startswith(group_path+'/'):
@@ -54,6 +67,7 @@ async def process(group_path, ldap_ou=None, posix=False, recursive=False, dryrun
             continue
         groups.append(ret[p])
 
+    failed = []
     for group in groups:
         ldap_cn = flatten_group_name(group['path'][len(group_path)+1:])
         logger.debug(f'working on group: {ldap_cn}')
@@ -61,12 +75,14 @@ async def process(group_path, ldap_ou=None, posix=False, recursive=False, dryrun
         if ldap_cn not in ldap_groups:
             kwargs = {}
             if posix:
-                max_gid += 1
-                kwargs['gidNumber'] = max_gid
+                kwargs['gidNumber'] = await asyncio.to_thread(id_allocator.allocate, dryrun=dryrun)
             if not dryrun:
-                ldap_client.create_group(ldap_cn, groupbase=ldap_ou, **kwargs)
+                await ldap_client.create_group(ldap_cn, groupbase=ldap_ou, **kwargs)
 
-        keycloak_members = await get_group_membership_by_id(group['id'], rest_client=keycloak_client)
+        if mirror:
+            keycloak_members = mirror.get_group_membership_by_id(group['id'])
+        else:
+            keycloak_members = await get_group_membership_by_id(group['id'], rest_client=keycloak_client)
         logger.debug(f'  keycloak_members: {keycloak_members}')
         ldap_members = get_ldap_members(ldap_groups[ldap_cn] if ldap_cn in ldap_groups else {})
         logger.debug(f'  ldap_members: {ldap_members}')
@@ -76,28 +92,40 @@ async def process(group_path, ldap_ou=None, posix=False, recursive=False, dryrun
         add_members = set(keycloak_members) - set(ldap_members)
         if add_members:
             logger.info(f'adding members to group {ldap_cn}: {add_members}')
-            if not dryrun:
-                for member in add_members:
-                    ldap_client.add_user_group(member, ldap_cn, groupbase=ldap_ou)
 
         remove_members = set(ldap_members) - set(keycloak_members)
         if remove_members:
             logger.info(f'removing members from group {ldap_cn}: {remove_members}')
-            if not dryrun:
-                for member in remove_members:
-                    ldap_client.remove_user_group(member, ldap_cn, groupbase=ldap_ou)
 
+        if (add_members or remove_members) and not dryrun:
+            results = await ldap_client.set_group_members(ldap_cn, add=sorted(add_members),
+                                                          remove=sorted(remove_members), groupbase=ldap_ou)
+            failed.extend(f'{ldap_cn}:{member}' for member in results if results[member] == 'failed')
+
+    if failed:
+        raise Exception(f'failed to update group members: {failed}')
 
-def listener(group_path, address=None, exchange=None, dedup=1, **kwargs):
-    """Set up RabbitMQ listener"""
+
+def listener(group_path, address=None, exchange=None, dedup=1, mirror=None, **kwargs):
+    """
+    Set up RabbitMQ listener.
+
+    If a `RealmMirror` is given, subscribe to it instead, and read Keycloak
+    state from the mirror. The mirror is returned to be started.
+    """
     async def action(message):
         logger.debug(f'{message}')
         if message['representation']['path'] == group_path:
-            await process(group_path, **kwargs)
+            await process(group_path, mirror=mirror, **kwargs)
+
+    if mirror:
+        mirror.subscribe(action, resource_types=['GROUP_MEMBERSHIP'], dedup=dedup, dedup_key=group_path_key)
+        return mirror
 
     args = {
         'routing_key': 'KK.EVENT.ADMIN.#.SUCCESS.GROUP_MEMBERSHIP.#',
         'dedup': dedup,
+        'dedup_key': group_path_key,
     }
     if address:
         args['address'] = address
@@ -119,6 +147,8 @@ def main():
     parser.add_argument('--listen', default=False, action='store_true', help='enable persistent RabbitMQ listener')
     parser.add_argument('--listen-address', help='RabbitMQ address, including user/pass')
     parser.add_argument('--listen-exchange', help='RabbitMQ exchange name')
+    parser.add_argument('--listen-mirror', default=False, action='store_true',
+                        help='keep an in-memory mirror of Keycloak while listening')
     parser.add_argument('--dryrun', action='store_true', help='dry run')
     args = vars(parser.parse_args())
 
@@ -127,20 +157,33 @@ def main():
     keycloak_client = get_rest_client()
     ldap_client = LDAP()
 
-    if args['listen']:
-        ret = listener(args['group_path'], ldap_ou=args['ldap_ou'], posix=args['posix'],
-                       recursive=args['recursive'],
-                       address=args['listen_address'], exchange=args['listen_exchange'],
-                       keycloak_client=keycloak_client, ldap_client=ldap_client)
-        loop = asyncio.get_event_loop()
-        loop.create_task(ret.start())
-        loop.run_forever()
-    else:
-        asyncio.run(process(args['group_path'], ldap_ou=args['ldap_ou'],
-                            posix=args['posix'], recursive=args['recursive'],
-                            dryrun=args['dryrun'],
-                            keycloak_client=keycloak_client,
-                            ldap_client=ldap_client))
+    try:
+        if args['listen']:
+            mirror = None
+            if args['listen_mirror']:
+                mirror = RealmMirror(keycloak_client, address=args['listen_address'], exchange=args['listen_exchange'])
+            id_allocator = PosixIdAllocator(ldap_client)
+            if args['posix'] and id_allocator.counter_dn:
+                # with an LDAP counter, other processes can't hand out the same
+                # ids, so the index only needs to be loaded once
+                id_allocator.load()
+            else:
+                id_allocator = None
+            ret = listener(args['group_path'], ldap_ou=args['ldap_ou'], posix=args['posix'],
+                           recursive=args['recursive'],
+                           address=args['listen_address'], exchange=args['listen_exchange'], mirror=mirror,
+                           keycloak_client=keycloak_client, ldap_client=ldap_client, id_allocator=id_allocator)
+            loop = asyncio.get_event_loop()
+            loop.create_task(ret.start())
+            loop.run_forever()
+        else:
+            asyncio.run(process(args['group_path'], ldap_ou=args['ldap_ou'],
+                                posix=args['posix'], recursive=args['recursive'],
+                                dryrun=args['dryrun'],
+                                keycloak_client=keycloak_client,
+                                ldap_client=ldap_client))
+    finally:
+        ldap_client.close()
 
 
 if __name__ == '__main__':
@@ -78,8 +78,7 @@ import sys
 from asyncache import cached  # type: ignore
 from attrs import define, field, fields, NOTHING
 from cachetools import Cache
-from collections import defaultdict
-from contextlib import suppress
+from contextlib import asynccontextmanager, suppress
 from datetime import datetime, timedelta
 from enum import Enum
 from itertools import chain
@@ -87,12 +86,12 @@ from jsonpath_ng.ext import parse  # type: ignore
 from rest_tools.client import RestClient
 
 from krs.email import send_email
-from krs.groups import (get_group_membership, group_info, remove_user_group,
-                        add_user_group, get_group_hierarchy, list_groups, modify_group)
+from krs.groups import (GroupIndex, get_group_membership, get_memberships, group_info,
+                        apply_membership_changes, get_group_hierarchy, list_groups, modify_group)
 from krs.token import get_rest_client
-from krs.users import user_info
+from krs.users import get_users, user_info
 
-from actions.util import reflow_text
+from actions.util import GroupHierarchyIndex, reflow_text
 
 
 ACTION_ID = "sync_synchronized_groups"
@@ -100,18 +99,9 @@ logger = logging.getLogger(f'{ACTION_ID}')
 
 
 @cached(Cache(maxsize=10000))
-async def user_info_cached(username, keycloak):
-    return await user_info(username, rest_client=keycloak)
-
-
-@cached(Cache(maxsize=10000))
-async def get_group_membership_cached(group_path, keycloak):
-    return await get_group_membership(group_path, rest_client=keycloak)
-
-
-@cached(Cache(maxsize=10000))
-async def get_group_hierarchy_cached(keycloak):
-    return await get_group_hierarchy(rest_client=keycloak)
+async def get_group_hierarchy_index_cached(keycloak):
+    """Index of the group hierarchy, which memoizes source expression results."""
+    return GroupHierarchyIndex(await get_group_hierarchy(rest_client=keycloak))
 
 
 class GrpCfgRes:
@@ -335,8 +325,12 @@ class SyncGroupConfig(SyncGroupCoreConfig):
 
         # Cache deferred removals because they will be queried often.
         # Implement caching discipline ourselves because deferred removals
-        # change during execution.
+        # change during execution. Inside deferred_removals_transaction(),
+        # changes are only made to the cache and written back on exit.
         self._deferred_removals_cache = None
+        self._deferred_removals_dirty = False
+        self._deferred_removals_transaction = False
+        self._group_index = None  # group index of the current transaction, if any
 
         def construct_message(global_no_notify: bool, notify: bool, override: str, default: str,
                               append: str, footer: str) -> str:
@@ -370,7 +364,7 @@ class SyncGroupConfig(SyncGroupCoreConfig):
     async def get_deferred_removals(self, keycloak: RestClient) -> dict:
         """Retrieve (cached) deferred removal state."""
         if self._deferred_removals_cache is None:
-            group: dict = await group_info(self.group_path, rest_client=keycloak)
+            group: dict = await group_info(self.group_path, rest_client=keycloak, group_index=self._group_index)
             group_attrs: dict = group.get('attributes', {})
             deferred_removals_raw: dict = json.loads(group_attrs.get(self.deferred_removals_attr, '{}'))
             self._deferred_removals_cache = dict((user, datetime.fromisoformat(ts))
@@ -379,24 +373,51 @@ class SyncGroupConfig(SyncGroupCoreConfig):
 
     async def set_deferred_removal(self, username: str, keycloak: RestClient):
         """Set deferred removal state of user to current time."""
-        new_deferred_removal_str = datetime.now().isoformat()
-        logger.info(f"Setting {username}'s removal timestamp to {new_deferred_removal_str}")
+        new_deferred_removal = datetime.now()
+        logger.info(f"Setting {username}'s removal timestamp to {new_deferred_removal.isoformat()}")
         deferred_removals = await self.get_deferred_removals(keycloak)
-        deferred_removals[username] = new_deferred_removal_str
-        deferred_removals_json = json.dumps(deferred_removals)
-        self._deferred_removals_cache = None
-        await modify_group(self.group_path, rest_client=keycloak,
-                           attrs={self.deferred_removals_attr: deferred_removals_json})
+        deferred_removals[username] = new_deferred_removal
+        self._deferred_removals_dirty = True
+        if not self._deferred_removals_transaction:
+            await self.flush_deferred_removals(keycloak)
 
     async def clear_deferred_removal(self, username: str, keycloak: RestClient):
         """Clear deferred removal info of user, if exists"""
         deferred_removals = await self.get_deferred_removals(keycloak)
         if deferred_removals.pop(username, None):
-            deferred_removals_json = json.dumps(deferred_removals)
-            self._deferred_removals_cache = None
-            await modify_group(self.group_path, rest_client=keycloak,
-                               attrs={self.deferred_removals_attr: deferred_removals_json})
+            self._deferred_removals_dirty = True
             logger.info(f"Cleared deferred removal of {username}. New record: {deferred_removals}")
+            if not self._deferred_removals_transaction:
+                await self.flush_deferred_removals(keycloak)
+
+    async def flush_deferred_removals(self, keycloak: RestClient):
+        """Write changed deferred removal state to the group, in one update."""
+        if not self._deferred_removals_dirty:
+            return
+        deferred_removals_json = json.dumps({user: ts.isoformat()
+                                             for user, ts in self._deferred_removals_cache.items()})
+        await modify_group(self.group_path, rest_client=keycloak, group_index=self._group_index,
+                           attrs={self.deferred_removals_attr: deferred_removals_json})
+        self._deferred_removals_dirty = False
+
+    @asynccontextmanager
+    async def deferred_removals_transaction(self, keycloak: RestClient, group_index: GroupIndex | None = None):
+        """Collect deferred removal changes in memory, and write them once on exit.
+
+        Changes are written even if the body raises, since they record
+        actions (e.g. notifications) that have already been taken.
+        `group_index` is used to look up the group within the transaction.
+        """
+        self._deferred_removals_transaction = True
+        self._group_index = group_index
+        try:
+            yield
+        finally:
+            self._deferred_removals_transaction = False
+            try:
+                await self.flush_deferred_removals(keycloak)
+            finally:
+                self._group_index = None
 
 
 async def manual_group_sync(target_path: str,
@@ -448,16 +469,23 @@ async def manual_group_sync(target_path: str,
                                          dryrun=dryrun)
 
 
-async def auto_sync_enabled_groups(keycloak_client, dryrun):
+async def auto_sync_enabled_groups(keycloak_client, dryrun, concurrency=4):
     """Discover enabled synchronized groups and sync them.
 
+    Synchronized groups may be sources of other synchronized groups, so
+    groups are synced in dependency order, with up to `concurrency`
+    independent groups synced in parallel. `concurrency` caps groups, not
+    Keycloak requests.
+
     Args:
         keycloak_client (RestClient): REST client to the KeyCloak server
         dryrun (bool): perform a trial run with no changes made
+        concurrency (int): max number of groups (not requests) synced in parallel
     """
     # Find all enabled synchronized groups. At the moment, it's much faster
     # to list all groups and pick the ones we need in python, compared to
-    # querying custom attributes via REST API.
+    # querying custom attributes via REST API. The listing includes full
+    # attributes, so there is no need to get each group again.
     all_groups = await list_groups(rest_client=keycloak_client)
     # noinspection PyTypeChecker
     auto_sync_attr = fields(SyncGroupConfig).auto_sync.metadata['attr']
@@ -465,27 +493,128 @@ async def auto_sync_enabled_groups(keycloak_client, dryrun):
                            if group.get('attributes', {})
                            .get(auto_sync_attr, '').lower() == "true"]
 
+    configs = {}
     for enabled_group_path in enabled_group_paths:
-        enabled_group = await group_info(enabled_group_path, rest_client=keycloak_client)
         try:
-            cfg = SyncGroupConfig(enabled_group_path, enabled_group['attributes'])
+            configs[enabled_group_path] = SyncGroupConfig(enabled_group_path,
+                                                          all_groups[enabled_group_path]['attributes'])
         except (SyncGroupConfigAttributeError, SyncGroupConfigValueError) as exc:
             logger.error(f"{enabled_group_path} sync configuration exception {exc!r}")
             raise
 
-        try:
-            await sync_synchronized_group(enabled_group_path,
-                                          cfg=cfg,
+    sources = {path: set(await get_source_group_paths(cfg, keycloak_client))
+               for path, cfg in configs.items()}
+    # Syncing changes memberships but not the group hierarchy, so one index serves all groups
+    group_index = await GroupIndex.load(rest_client=keycloak_client)
+    await sync_groups_in_dependency_order(configs, sources,
                                           keycloak=keycloak_client,
                                           allow_notifications=True,
-                                          dryrun=dryrun)
-        except Exception as exc:
-            logger.error(f"Exception during sync of {enabled_group_path}: {exc!r}")
-            raise
+                                          dryrun=dryrun,
+                                          concurrency=concurrency,
+                                          group_index=group_index)
+
+
+def is_nested_group(path, other):
+    """Return whether one of the group paths is an ancestor of the other, or they are equal."""
+    return path == other or path.startswith(other + '/') or other.startswith(path + '/')
+
+
+def is_in_subtree(path, root):
+    """Return whether the group path is `root` or one of its descendants."""
+    return path == root or path.startswith(root + '/')
+
+
+async def sync_groups_in_dependency_order(configs: dict, sources: dict, /, *,
+                                          keycloak: RestClient,
+                                          allow_notifications: bool,
+                                          dryrun: bool,
+                                          concurrency: int = 4,
+                                          group_index: GroupIndex | None = None):
+    """Sync many synchronized groups, in parallel where possible.
+
+    A synchronized group is synced before the groups that have it, or one
+    of its subgroups, as a source, so that its changes propagate in the same
+    run. Groups that depend on
+    a group whose sync failed are skipped. Dependency cycles are broken
+    arbitrarily (by path order). Memberships of source groups are fetched
+    once per call, and shared between the synchronized groups.
+
+    Adding a user to a group temporarily removes the user from the group's
+    subgroups (see `krs.groups.plan_membership_changes()`). So a group is
+    never synced in parallel with its ancestors or descendants, nor with a
+    group whose subtree holds one of its sources (even if a dependency cycle
+    was broken), since users would appear to be missing from the source.
+
+    `concurrency` caps the number of groups synced at once, not the number
+    of Keycloak requests; each group sync makes its own parallel requests.
+
+    Args:
+        configs (dict): group path: SyncGroupConfig
+        sources (dict): group path: set of source group paths
+        keycloak (RestClient): REST client to the KeyCloak server
+        allow_notifications (bool): if False, suppress all email notifications
+        dryrun (bool): perform a trial run with no changes made
+        concurrency (int): max number of groups (not requests) synced in parallel
+        group_index (GroupIndex): (optional) group index to use for lookups
+    """
+    membership_cache: dict = {}  # source group path: usernames
+    dependencies = {path: {other for other in configs if other != path
+                           and any(is_in_subtree(source, other) for source in sources[path])}
+                    for path in configs}
+
+    def conflict(path, other):
+        return (is_nested_group(path, other)
+                or any(is_in_subtree(source, other) for source in sources[path])
+                or any(is_in_subtree(source, path) for source in sources[other]))
+
+    pending = dict(dependencies)
+    succeeded: dict = {}  # group path: whether the sync succeeded
+    running: dict = {}  # task: group path
+    errors = []
+
+    while pending or running:
+        ready = [path for path in sorted(pending) if pending[path] <= succeeded.keys()]
+        if not ready and not running:
+            logger.warning(f"Dependency cycle between synchronized groups {sorted(pending)}")
+            ready = sorted(pending)[:1]
+        for path in ready:
+            if len(running) >= concurrency:
+                break
+            if any(conflict(path, other) for other in running.values()):
+                continue  # wait for the running group whose subgroups are affected
+            del pending[path]
+            if failed_deps := [dep for dep in dependencies[path] if not succeeded.get(dep, True)]:
+                logger.error(f"Skipping sync of {path} because sync of {failed_deps} failed")
+                succeeded[path] = False
+                continue
+            logger.debug(f"Starting sync of {path}")
+            running[asyncio.create_task(sync_synchronized_group(
+                path, cfg=configs[path], keycloak=keycloak,
+                allow_notifications=allow_notifications, dryrun=dryrun,
+                group_index=group_index, membership_cache=membership_cache))] = path
+        if not running:
+            continue
+
+        finished, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+        for task in finished:
+            path = running.pop(task)
+            if exc := task.exception():
+                logger.error(f"Exception during sync of {path}: {exc!r}")
+                errors.append(exc)
+                succeeded[path] = False
+            else:
+                succeeded[path] = True
+            # memberships of the group and its subgroups may have changed, and
+            # they may be sources of other groups
+            for cached_path in [p for p in membership_cache if is_in_subtree(p, path)]:
+                del membership_cache[cached_path]
+
+    if errors:
+        raise errors[0]
 
 
 async def send_notification(username: str, subject: str, body: str, keycloak: RestClient):
-    user = await user_info_cached(username, keycloak)
+    user = await user_info(username, rest_client=keycloak)
     user_attrs = user['attributes']
 
     # In general, we don't know what email the user checks,
@@ -555,37 +684,103 @@ async def grace_period_check_with_init(username: str, cfg: SyncGroupConfig, dryr
         return True  # pass the check since grace>0 and grace period has just been begun
 
 
-async def remove_extraneous_member(username: str, cfg: SyncGroupConfig, dryrun: bool, notify: bool,
-                                   keycloak: RestClient):
-    """Removes an extraneous member"""
-    if username in await cfg.get_deferred_removals(keycloak):
-        logger.info(f"Removing {username} from deferred removal state ({dryrun=}, {notify=})")
-        if not dryrun:
-            await cfg.clear_deferred_removal(username, keycloak)
-    logger.info(f"Removing extraneous {username} from {cfg.group_path} ({dryrun=}, {notify=}")
-    if not dryrun:
-        await remove_user_group(cfg.group_path, username, rest_client=keycloak)
-        if notify and cfg.message_removal_occurred:
+def raise_membership_failures(failed: dict, group_path: str):
+    """Log failed membership changes, then raise the first failure, if any."""
+    for username, exc in failed.items():
+        logger.error(f"Failed to change membership of {username} in {group_path}: {exc!r}")
+    if failed:
+        raise next(iter(failed.values()))
+
+
+async def remove_extraneous_members(usernames: list, cfg: SyncGroupConfig, dryrun: bool, notify: bool,
+                                    keycloak: RestClient, group_index: GroupIndex | None = None):
+    """Removes extraneous members"""
+    for username in usernames:
+        if username in await cfg.get_deferred_removals(keycloak):
+            logger.info(f"Removing {username} from deferred removal state ({dryrun=}, {notify=})")
+            if not dryrun:
+                await cfg.clear_deferred_removal(username, keycloak)
+        logger.info(f"Removing extraneous {username} from {cfg.group_path} ({dryrun=}, {notify=}")
+    if dryrun or not usernames:
+        return
+    applied, failed = await apply_membership_changes(remove={cfg.group_path: usernames}, rest_client=keycloak,
+                                                     group_index=group_index)
+    if notify and cfg.message_removal_occurred:
+        # fetch the users to notify at once (send_notification() finds them in the cache)
+        await get_users([u for u in usernames if applied.get(u)], rest_client=keycloak)
+    for username in usernames:
+        if applied.get(username) and notify and cfg.message_removal_occurred:
             await send_notification(
                 username=username, keycloak=keycloak,
                 subject=f"You have been removed from group {cfg.group_path}",
                 body=cfg.message_removal_occurred.format(username=username, group_path=cfg.group_path))
+    raise_membership_failures(failed, cfg.group_path)
 
 
-async def add_missing_member(username: str, qualifying_groups: list, cfg: SyncGroupConfig,
-                             dryrun: bool, notify: bool, keycloak: RestClient):
-    """Add a user who should be group members but isn't."""
-    logger.info(f"Adding {username} to {cfg.group_path} ({dryrun=}, {notify=})")
-    if dryrun:
+async def add_missing_members(qualifying_groups: dict, cfg: SyncGroupConfig,
+                              dryrun: bool, notify: bool, keycloak: RestClient,
+                              group_index: GroupIndex | None = None):
+    """Add users who should be group members but aren't.
+
+    Args:
+        qualifying_groups (dict): username: source group paths the user is a member of
+        group_index (GroupIndex): (optional) group index to use for lookups
+    """
+    for username in qualifying_groups:
+        logger.info(f"Adding {username} to {cfg.group_path} ({dryrun=}, {notify=})")
+    if dryrun or not qualifying_groups:
         return
-    await add_user_group(cfg.group_path, username, rest_client=keycloak)
+    applied, failed = await apply_membership_changes(add={cfg.group_path: list(qualifying_groups)},
+                                                     rest_client=keycloak, group_index=group_index)
     if notify and cfg.message_addition_occurred:
-        await send_notification(
-            username=username, keycloak=keycloak,
-            subject=f"You have been added to group {cfg.group_path}",
-            body=cfg.message_addition_occurred.format(
-                username=username, group_path=cfg.group_path,
-                qualifying_groups=', '.join(qualifying_groups)))
+        await get_users([u for u in qualifying_groups if applied.get(u)], rest_client=keycloak)
+    for username in qualifying_groups:
+        if applied.get(username) and notify and cfg.message_addition_occurred:
+            await send_notification(
+                username=username, keycloak=keycloak,
+                subject=f"You have been added to group {cfg.group_path}",
+                body=cfg.message_addition_occurred.format(
+                    username=username, group_path=cfg.group_path,
+                    qualifying_groups=', '.join(qualifying_groups[username])))
+    raise_membership_failures(failed, cfg.group_path)
+
+
+async def get_source_group_paths(cfg: SyncGroupConfig, keycloak: RestClient) -> list:
+    """Evaluate the sources expression of a synchronized group.
+
+    Args:
+        cfg (SyncGroupConfig): runtime configuration options
+        keycloak (RestClient): REST client to the KeyCloak server
+
+    Returns:
+        list: source group paths
+    """
+    # noinspection PyCallingNonCallable
+    hierarchy_index = await get_group_hierarchy_index_cached(keycloak)
+    constituent_group_paths = hierarchy_index.find(cfg.sources_expr_str)
+    logger.debug(f"{sorted(constituent_group_paths)=}")
+
+    # Sanity check source group paths. It's easy to make a mistake in the JSONPath
+    # expression that would cause it to produce garbage
+    group_path_type_error = group_path_value_error = None
+    if not all(isinstance(path, str) for path in constituent_group_paths):
+        group_path_type_error = True
+    # Check for valid group paths. Note that Keycloak is actually more liberal
+    # When it comes to group names, but IceCube policy (at least right now) is
+    # letters, numbers, -, and _. No spaces.
+    elif not all(re.match(f'(/[-_{string.ascii_letters}{string.digits}]+)+$', path)
+                 for path in constituent_group_paths):
+        group_path_value_error = True
+    if group_path_type_error or group_path_value_error:
+        logger.error("Results of sources expression don't look like group paths:")
+        logger.error(f"{cfg.sources_expr_str=}")
+        logger.error(f"{str(constituent_group_paths)[:200]=}")
+        if group_path_type_error:
+            raise TypeError("Source paths expression produced non-string objects")
+        if group_path_value_error:
+            raise ValueError("Source paths expression produced invalid paths")
+
+    return constituent_group_paths
 
 
 async def sync_synchronized_group(target_path: str,
@@ -593,7 +788,9 @@ async def sync_synchronized_group(target_path: str,
                                   cfg: SyncGroupConfig,
                                   keycloak: RestClient,
                                   allow_notifications: bool,
-                                  dryrun: bool):
+                                  dryrun: bool,
+                                  group_index: GroupIndex | None = None,
+                                  membership_cache: dict | None = None):
     """Synchronize membership of the synchronized group at `target_path`.
 
     `constituents_expr` is a string with JSONPath expression that will be
@@ -615,68 +812,49 @@ async def sync_synchronized_group(target_path: str,
         keycloak (RestClient): REST client to the KeyCloak server
         dryrun (bool): perform a trial run with no changes made
         allow_notifications (bool): if False, suppress all email notifications
+        group_index (GroupIndex): (optional) group index to use for lookups
+                                  (default: loaded once for this group)
+        membership_cache (dict): (optional) source group path: usernames, shared
+                                 between synchronized groups of the same run
     """
     # Set up partials to make the code easier to read
     logger.debug(f"Processing synchronized group {target_path}")
 
-    # noinspection PyCallingNonCallable
-    group_hierarchy = await get_group_hierarchy_cached(keycloak)
-    constituent_group_paths = [v.value for v in cfg.sources_expr.find(group_hierarchy)]
-    logger.debug(f"{sorted(constituent_group_paths)=}")
-
-    # Sanity check source group paths. It's easy to make a mistake in the JSONPath
-    # expression that would cause it to produce garbage
-    group_path_type_error = group_path_value_error = None
-    if not all(isinstance(path, str) for path in constituent_group_paths):
-        group_path_type_error = True
-    # Check for valid group paths. Note that Keycloak is actually more liberal
-    # When it comes to group names, but IceCube policy (at least right now) is
-    # letters, numbers, -, and _. No spaces.
-    elif not all(re.match(f'(/[-_{string.ascii_letters}{string.digits}]+)+$', path)
-                 for path in constituent_group_paths):
-        group_path_value_error = True
-    if group_path_type_error or group_path_value_error:
-        logger.error("Results of sources expression don't look like group paths:")
-        logger.error(f"{cfg.sources_expr_str=}")
-        logger.error(f"{str(constituent_group_paths)[:200]=}")
-        if group_path_type_error:
-            raise TypeError("Source paths expression produced non-string objects")
-        if group_path_value_error:
-            raise ValueError("Source paths expression produced invalid paths")
+    constituent_group_paths = await get_source_group_paths(cfg, keycloak)
+    if group_index is None:
+        group_index = await GroupIndex.load(rest_client=keycloak)
 
     # Determine what the current membership and memberships of the source groups
-    constituent_member_lists = await asyncio.gather(
-        *[get_group_membership_cached(group_path, keycloak)
-          for group_path in constituent_group_paths])
-    source_groups_member_dict = dict(zip(constituent_group_paths, constituent_member_lists))
-    source_members = set(chain.from_iterable(constituent_member_lists))
-    current_members = set(await get_group_membership(target_path, rest_client=keycloak))
+    source_groups_member_dict, user_memberships = await get_memberships(
+        constituent_group_paths, cache=membership_cache, rest_client=keycloak, group_index=group_index)
+    source_members = set(chain.from_iterable(source_groups_member_dict.values()))
+    current_members = set(await get_group_membership(target_path, rest_client=keycloak, group_index=group_index))
     logger.debug(f"{sorted(source_members)=}")
 
-    user_memberships = defaultdict(list)
-    for group, members in source_groups_member_dict.items():
-        for username in members:
-            user_memberships[username].append(group)
-
-    # Process the current legitimate members that don't need to be removed
-    for valid_member in current_members & source_members:
-        # Valid users may need to be removed from the deferred removal record
-        # if they rejoined a constituent group before the grace period expired
-        if valid_member in await cfg.get_deferred_removals(keycloak):
-            await clear_deferred_removal(valid_member, cfg, dryrun, allow_notifications, keycloak)
-
-    # Prune extraneous members
-    for extraneous_member in current_members - source_members:
-        if cfg.removal_grace_days:
-            if await grace_period_check_with_init(extraneous_member, cfg, dryrun, allow_notifications, keycloak):
-                continue
-        await remove_extraneous_member(extraneous_member, cfg, dryrun, allow_notifications, keycloak)
-
-    # Add missing members if policy is to match union of membership of constituents
-    if cfg.policy == MembershipSyncPolicy.match:
-        for missing_member in source_members - current_members:
-            await add_missing_member(missing_member, user_memberships[missing_member],
-                                     cfg, dryrun, allow_notifications, keycloak)
+    # Deferred removal state changes are written to the group once, at the end
+    async with cfg.deferred_removals_transaction(keycloak, group_index=group_index):
+        # Process the current legitimate members that don't need to be removed
+        for valid_member in current_members & source_members:
+            # Valid users may need to be removed from the deferred removal record
+            # if they rejoined a constituent group before the grace period expired
+            if valid_member in await cfg.get_deferred_removals(keycloak):
+                await clear_deferred_removal(valid_member, cfg, dryrun, allow_notifications, keycloak)
+
+        # Prune extraneous members
+        extraneous_members = []
+        for extraneous_member in sorted(current_members - source_members):
+            if cfg.removal_grace_days:
+                if await grace_period_check_with_init(extraneous_member, cfg, dryrun, allow_notifications, keycloak):
+                    continue
+            extraneous_members.append(extraneous_member)
+        await remove_extraneous_members(extraneous_members, cfg, dryrun, allow_notifications, keycloak,
+                                        group_index=group_index)
+
+        # Add missing members if policy is to match union of membership of constituents
+        if cfg.policy == MembershipSyncPolicy.match:
+            await add_missing_members({missing_member: user_memberships[missing_member]
+                                       for missing_member in sorted(source_members - current_members)},
+                                      cfg, dryrun, allow_notifications, keycloak, group_index=group_index)
 
 
 def print_configuration_help():  # link:ooK1Ua1B
@@ -746,6 +924,8 @@ def main():
                         help='Logging level of this application (not dependencies).')
     parser.add_argument('--log-level-client', default='warning', choices=('debug', 'info', 'warning', 'error'),
                         help='REST client logging level.')
+    parser.add_argument('--concurrency', type=int, default=4,
+                        help='Max number of synchronized groups synced in parallel in automatic mode.')
     parser.add_argument('--dryrun', action='store_true',
                         help='dry run')
     args = vars(parser.parse_args())
@@ -773,7 +953,8 @@ def main():
     if args['auto']:
         return asyncio.run(auto_sync_enabled_groups(
             keycloak_client=keycloak_client,
-            dryrun=args['dryrun']))
+            dryrun=args['dryrun'],
+            concurrency=args['concurrency']))
     else:
         target_group, source_group_expr = args['manual']
         return asyncio.run(manual_group_sync(target_group,
@@ -25,13 +25,13 @@ Example::
 import asyncio
 import logging
 from datetime import datetime
-from collections import defaultdict
 from requests.exceptions import HTTPError
 
+from krs.cache import RealmCache
 from krs.token import get_rest_client
-from krs.groups import get_group_membership
+from krs.groups import get_memberships
 from krs.institutions import list_insts
-from krs.users import list_users, modify_user
+from krs.users import iter_users, modify_user
 from krs.email import send_email
 
 logger = logging.getLogger('track_user_institutions')
@@ -50,25 +50,24 @@ This message has been generated by the track_user_institutions robot.
 """
 
 
-async def update_institution_tracking(keycloak_client=None, notify=True, dryrun=False):
+async def update_institution_tracking(keycloak_client=None, notify=True, dryrun=False, realm_cache=None):
     """Update institutions_last_seen and institutions_last_changed user attributes.
 
     Args:
         keycloak_client (OpenIDRestClient): REST client to the KeyCloak server
         notify (bool): send out notification emails
         dryrun (bool): perform a trial run with no changes made
+        realm_cache (RealmCache): (optional) realm snapshot cache to get users from
     """
 
-    user_insts = defaultdict(list)
     insts = await list_insts(rest_client=keycloak_client)
-    for inst_path in insts.keys():
-        inst_usernames = await get_group_membership(inst_path, rest_client=keycloak_client)
-        for inst_username in inst_usernames:
-            user_insts[inst_username].append(inst_path)
-
-    all_users = await list_users(rest_client=keycloak_client)
-    for username, userinfo in all_users.items():
-        insts_actual = user_insts[username]
+    _, user_insts = await get_memberships(insts.keys(), rest_client=keycloak_client)
+
+    modified = False
+    user_source = realm_cache.iter_users if realm_cache else iter_users
+    async for userinfo in user_source(rest_client=keycloak_client):
+        username = userinfo['username']
+        insts_actual = user_insts.get(username, [])
         # There's currently an issue with our keycloak that prevents using lists
         # as user attribute values. To work-around, institutions_last_seen is
         # stored as comma-separated string.
@@ -95,6 +94,7 @@ async def update_institution_tracking(keycloak_client=None, notify=True, dryrun=
                     continue
                 else:
                     raise
+            modified = True
             if notify:
                 logger.info(f"Notifying {username} of institution change")
                 send_email(userinfo.get('email', f"{username}@icecube.wisc.edu"),
@@ -103,6 +103,10 @@ async def update_institution_tracking(keycloak_client=None, notify=True, dryrun=
                                old=', '.join(sorted(insts_last_seen)) or "none",
                                new=', '.join(sorted(insts_actual)) or "none"))
 
+    if realm_cache and modified:
+        # other jobs rely on the attributes we just changed
+        realm_cache.invalidate('users', realm=keycloak_client.address)
+
 
 def main():
     import argparse
@@ -114,6 +118,8 @@ def main():
     parser.add_argument('--dryrun', action='store_true', help='dry run (implies no notifications)')
     parser.add_argument('--log-level', default='info',
                         choices=('debug', 'info', 'warning', 'error'), help='logging level')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='bypass the realm snapshot cache (see krs/cache.py)')
 
     args = vars(parser.parse_args())
 
@@ -123,7 +129,8 @@ def main():
     asyncio.run(update_institution_tracking(
         keycloak_client=keycloak_client,
         notify=args['notify'],
-        dryrun=args['dryrun']))
+        dryrun=args['dryrun'],
+        realm_cache=RealmCache.from_environment(bypass=args['no_cache'])))
 
 
 if __name__ == '__main__':
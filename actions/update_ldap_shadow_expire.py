@@ -5,8 +5,10 @@ import asyncio
 import logging
 import string
 
-from krs.ldap import LDAP
-from krs.rabbitmq import RabbitMQListener
+from ldap3.utils.conv import escape_filter_chars
+
+from krs.ldap import LDAP, AsyncLDAP
+from krs.rabbitmq import RabbitMQListener, resource_path_key
 
 
 logger = logging.getLogger('update_ldap_shadow_expire')
@@ -22,7 +24,9 @@ def flatten_group_name(path):
 
 
 async def process(username=None, dryrun=False, ldap_client=None):
-    ldap_users = ldap_client.list_users()
+    ldap_client = AsyncLDAP.wrap(ldap_client)
+    search_filter = f'(uid={escape_filter_chars(username)})' if username else None
+    ldap_users = await ldap_client.list_users(['shadowExpire', 'shadowLastChange', 'shadowMax'], search_filter=search_filter)
 
     if username:
         usernames = [username]
@@ -40,7 +44,7 @@ async def process(username=None, dryrun=False, ldap_client=None):
                 logger.debug(f'old expire = {oldExpire}, lastChange = {user["shadowLastChange"]}')
                 logger.info(f'updating expiry for user {uid} to {newExpire}')
                 if not dryrun:
-                    ldap_client.modify_user(uid, {'shadowExpire': newExpire})
+                    await ldap_client.modify_user(uid, {'shadowExpire': newExpire})
 
 
 def listener(group_path, address=None, exchange=None, dedup=1, **kwargs):
@@ -52,6 +56,7 @@ def listener(group_path, address=None, exchange=None, dedup=1, **kwargs):
     args = {
         'routing_key': 'KK.EVENT.ADMIN.#.SUCCESS.USER.#',
         'dedup': dedup,
+        'dedup_key': resource_path_key,
     }
     if address:
         args['address'] = address
@@ -77,14 +82,17 @@ def main():
 
     ldap_client = LDAP()
 
-    if args['listen']:
-        ret = listener(address=args['listen_address'], exchange=args['listen_exchange'],
-                       ldap_client=ldap_client)
-        loop = asyncio.get_event_loop()
-        loop.create_task(ret.start())
-        loop.run_forever()
-    else:
-        asyncio.run(process(args['user'], dryrun=args['dryrun'], ldap_client=ldap_client))
+    try:
+        if args['listen']:
+            ret = listener(address=args['listen_address'], exchange=args['listen_exchange'],
+                           ldap_client=ldap_client)
+            loop = asyncio.get_event_loop()
+            loop.create_task(ret.start())
+            loop.run_forever()
+        else:
+            asyncio.run(process(args['user'], dryrun=args['dryrun'], ldap_client=ldap_client))
+    finally:
+        ldap_client.close()
 
 
 if __name__ == '__main__':
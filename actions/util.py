@@ -1,10 +1,21 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
 import pathlib
+import random
 import subprocess
 import tempfile
+import threading
 import time
 
+import httplib2  # type: ignore
 from google.auth.exceptions import RefreshError
+from google_auth_httplib2 import AuthorizedHttp  # type: ignore
 from googleapiclient.errors import HttpError
+from googleapiclient.http import HttpRequest
+from jsonpath_ng import Child, Descendants, Fields, Root, Slice  # type: ignore
+from jsonpath_ng.ext import parse  # type: ignore
+from jsonpath_ng.ext.filter import Filter  # type: ignore
 
 QUOTAS = {
     # production dirs
@@ -72,6 +83,109 @@ def group_tree_to_list(root):
     return result
 
 
+class _UnsupportedExpression(Exception):
+    pass
+
+
+class GroupHierarchyIndex:
+    """Evaluate JSONPath expressions against an indexed Keycloak group hierarchy.
+
+    Evaluating expressions like `$..subGroups[?path == '/a/b'].subGroups[*].path`
+    with jsonpath-ng walks the whole hierarchy every time. This indexes the
+    hierarchy once by path, name and attribute value, and evaluates the
+    common expression shapes directly: `$..subGroups` or `$` followed by
+    filters (`[?...]`), `[*]` and `.subGroups` steps, and a final field.
+    Filters comparing path, name or an attribute with `==` are answered
+    from the index. Other expressions are evaluated with jsonpath-ng.
+    Results are memoized per expression.
+
+    Args:
+        hierarchy (list): output of `krs.groups.get_group_hierarchy()`
+    """
+    def __init__(self, hierarchy):
+        self.hierarchy = hierarchy
+        # all groups below the top level, in the order jsonpath-ng finds `$..subGroups[*]`
+        self.subgroups = []
+        self.index = {}  # (field, value): subgroups
+        self._results = {}
+
+        def add_children(group):
+            for child in group['subGroups']:
+                self.subgroups.append(child)
+                for key in ('path', 'name'):
+                    self.index.setdefault((key, child[key]), []).append(child)
+                for attr, value in child.get('attributes', {}).items():
+                    if isinstance(value, str):
+                        self.index.setdefault((f'attributes.{attr}', value), []).append(child)
+            for child in group['subGroups']:
+                add_children(child)
+        for group in hierarchy:
+            add_children(group)
+
+    def find(self, expr):
+        """Find the values matching a JSONPath expression.
+
+        Args:
+            expr (str): JSONPath expression (jsonpath-ng extended syntax)
+
+        Returns:
+            list: matching values
+        """
+        if expr not in self._results:
+            parsed = parse(expr)
+            try:
+                self._results[expr] = self._evaluate(parsed)
+            except _UnsupportedExpression:
+                self._results[expr] = [match.value for match in parsed.find(self.hierarchy)]
+        return list(self._results[expr])
+
+    def _evaluate(self, parsed):
+        steps = []
+        while isinstance(parsed, Child):
+            steps.insert(0, parsed.right)
+            parsed = parsed.left
+
+        # The state is either the elements of some lists of groups (which
+        # filters and [*] apply to), or some groups (which fields apply to).
+        if isinstance(parsed, Root):
+            elements, groups, indexed = self.hierarchy, None, False
+        elif (isinstance(parsed, Descendants) and isinstance(parsed.left, Root)
+              and parsed.right == Fields('subGroups')):
+            elements, groups, indexed = self.subgroups, None, True
+        else:
+            raise _UnsupportedExpression()
+
+        for i, step in enumerate(steps):
+            if elements is not None and isinstance(step, Filter):
+                candidates = self._candidates(step) if indexed else None
+                groups = [g for g in (elements if candidates is None else candidates)
+                          if all(e.find(g) for e in step.expressions)]
+                elements = None
+            elif elements is not None and step == Slice():
+                groups, elements = elements, None
+            elif groups is not None and step == Fields('subGroups'):
+                elements = [child for g in groups for child in g['subGroups']]
+                groups, indexed = None, False
+            elif (groups is not None and isinstance(step, Fields) and len(step.fields) == 1
+                  and i == len(steps) - 1):
+                return [g[step.fields[0]] for g in groups if step.fields[0] in g]
+            else:
+                raise _UnsupportedExpression()
+        raise _UnsupportedExpression()  # no final field
+
+    def _candidates(self, step):
+        """Return indexed groups that may match a filter, or None if not indexable."""
+        for e in step.expressions:
+            if e.op not in ('==', '=') or not isinstance(e.value, str):
+                continue
+            if isinstance(e.target, Fields) and e.target.fields in (('path',), ('name',)):
+                return self.index.get((e.target.fields[0], e.value), [])
+            if (isinstance(e.target, Child) and e.target.left == Fields('attributes')
+                    and isinstance(e.target.right, Fields) and len(e.target.right.fields) == 1):
+                return self.index.get((f'attributes.{e.target.right.fields[0]}', e.value), [])
+        return None
+
+
 def retry_execute(request, max_attempts=8):
     """Retry calling request.execute() with exponential backoff.
 
@@ -95,16 +209,9 @@ def retry_execute(request, max_attempts=8):
         sleep_time_history.append(sleep_time)
         try:
             return request.execute()
-        except RefreshError as exc:
-            # Refreshing the credentials' access token failed. This can be transient, so retry.
-            exception_history.append(exc)
-            continue
-        except HttpError as exc:
+        except (RefreshError, HttpError) as exc:
             exception_history.append(exc)
-            if exc.status_code in (400, 404, 412, 500, 503):
-                # Something required not ready yet: 400 (bad request), 412 (precondition failed).
-                # Possibly transient: 400 (bad request), 404 (not found), 503 (service unavailable),
-                # 500 (internal error).
+            if is_retryable(exc):
                 continue
             else:
                 raise RetryError(sleep_time_history, exception_history) from exc
@@ -112,6 +219,307 @@ def retry_execute(request, max_attempts=8):
         raise RetryError(sleep_time_history, exception_history)
 
 
+def is_retryable(exc):
+    """Return whether a failed Google API request should be retried."""
+    if isinstance(exc, RefreshError):
+        # Refreshing the credentials' access token failed. This can be transient, so retry.
+        return True
+    # Something required not ready yet: 400 (bad request), 412 (precondition failed).
+    # Possibly transient: 400 (bad request), 404 (not found), 503 (service unavailable),
+    # 500 (internal error), 429 (rate limit exceeded).
+    return isinstance(exc, HttpError) and exc.status_code in (400, 404, 412, 429, 500, 503)
+
+
+def _retry_after(exc):
+    """Return the delay in seconds requested by a Retry-After header of a failed request, if any."""
+    if not isinstance(exc, HttpError) or not (value := exc.resp.get('retry-after')):
+        return None
+    try:
+        return max(0., float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0., parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def _backoff_delay(attempt, max_delay, exceptions):
+    """Return the full-jitter backoff delay before retry `attempt`, but at least
+    as long as requested by a Retry-After header of any of `exceptions`."""
+    delay = random.uniform(0, min(max_delay, 2 ** attempt - 1))
+    retry_after = [d for d in map(_retry_after, exceptions) if d is not None]
+    return max([delay] + retry_after)
+
+
+def _method_id(request):
+    """Return the API method id of a request, for statistics."""
+    method = getattr(request, 'methodId', None)
+    return method if isinstance(method, str) else type(request).__name__
+
+
+class ApiStats:
+    """Retry and latency statistics of Google API requests, per API method."""
+    def __init__(self):
+        self.methods = {}
+
+    def record(self, method, latency, retried, failed):
+        """Record one attempt at executing a request.
+
+        Args:
+            method (str): API method id (e.g. directory.members.insert)
+            latency (float): seconds the attempt took
+            retried (bool): whether the attempt is a retry
+            failed (bool): whether the attempt failed
+        """
+        m = self.methods.setdefault(method, {'attempts': 0, 'retries': 0, 'errors': 0,
+                                             'total_latency': 0., 'max_latency': 0.})
+        m['attempts'] += 1
+        m['retries'] += retried
+        m['errors'] += failed
+        m['total_latency'] += latency
+        m['max_latency'] = max(m['max_latency'], latency)
+
+    def summary(self):
+        """Return a dict of statistics per method, with average latency."""
+        return {method: dict(m, avg_latency=m['total_latency'] / m['attempts'])
+                for method, m in sorted(self.methods.items())}
+
+
+API_STATS = ApiStats()
+
+
+async def retry_execute_async(request, max_attempts=8, max_delay=64, run=None, stats=None):
+    """Retry calling request.execute() with jittered exponential backoff, without
+    blocking the event loop.
+
+    Like `retry_execute()`, but request.execute() is run in a thread, the
+    backoff delays are awaited, drawn uniformly from [0, 2**attempt - 1]
+    ("full jitter"), and are at least as long as requested by a Retry-After
+    header.
+
+    Args:
+        request: object with .execute() method
+        max_attempts: maximum number of re-attempts
+        max_delay: maximum backoff delay, in seconds, unless Retry-After says otherwise
+        run: (optional) async function to call request.execute with
+             (default: run in the event loop's default thread pool)
+        stats (ApiStats): (optional) statistics to update (default: API_STATS)
+
+    Returns:
+        Return value of request.execute()
+
+    Raises:
+        RetryError if reached max_attempts
+    """
+    if not hasattr(request, 'execute'):
+        raise AttributeError(f"{type(request)} object has no attribute 'execute'")
+    if run is None:
+        async def run(func):
+            return await asyncio.get_running_loop().run_in_executor(None, func)
+    if stats is None:
+        stats = API_STATS
+    method = _method_id(request)
+
+    sleep_time_history = []
+    exception_history = []
+    for attempt in range(max_attempts):
+        if attempt:
+            sleep_time = _backoff_delay(attempt, max_delay, exception_history[-1:])
+            sleep_time_history.append(sleep_time)
+            await asyncio.sleep(sleep_time)
+        start = time.monotonic()
+        try:
+            ret = await run(request.execute)
+        except (RefreshError, HttpError) as exc:
+            stats.record(method, time.monotonic() - start, retried=attempt > 0, failed=True)
+            exception_history.append(exc)
+            if is_retryable(exc):
+                continue
+            else:
+                raise RetryError(sleep_time_history, exception_history) from exc
+        stats.record(method, time.monotonic() - start, retried=attempt > 0, failed=False)
+        return ret
+    raise RetryError(sleep_time_history, exception_history)
+
+
+def batch_execute(resource, requests, batch_size=50, max_attempts=8, max_delay=64, http=None,
+                  limiter=None, stats=None):
+    """Execute many requests using Google API batch requests, with retries.
+
+    Requests are sent in batches of up to `batch_size` (the maximum depends
+    on the API: 1000 for the Admin SDK Directory API, 50 for the Calendar API).
+    Only the sub-requests that failed with retryable errors are retried,
+    with the same jittered backoff and Retry-After handling as
+    `retry_execute_async()`. Each sub-request attempt is recorded in `stats`.
+    Requests that aren't `HttpRequest` objects (e.g. test doubles) are
+    executed one by one.
+
+    Args:
+        resource (googleapiclient.discovery.Resource): resource of the API of the requests
+        requests (dict): key: request
+        batch_size (int): max number of requests per batch
+        max_attempts (int): maximum number of attempts of each request
+        max_delay: maximum backoff delay, in seconds, unless Retry-After says otherwise
+        http: (optional) HTTP transport to use
+        limiter (RateLimiter): (optional) rate limiter of sub-requests
+        stats (ApiStats): (optional) statistics to update (default: API_STATS)
+
+    Returns:
+        tuple: ({key: response}, {key: exception}) of succeeded and failed requests
+    """
+    if stats is None:
+        stats = API_STATS
+    results = {}
+    errors = {}
+    pending = dict(requests)
+    for attempt in range(max_attempts):
+        if not pending:
+            break
+        if attempt:
+            time.sleep(_backoff_delay(attempt, max_delay, [errors[key] for key in pending]))
+        retry = {}
+
+        def done(key, response, exception, start):
+            stats.record(_method_id(pending[key]), time.monotonic() - start,
+                         retried=attempt > 0, failed=exception is not None)
+            if exception is None:
+                results[key] = response
+                errors.pop(key, None)
+            else:
+                errors[key] = exception
+                if is_retryable(exception):
+                    retry[key] = pending[key]
+
+        batchable = [key for key, request in pending.items() if isinstance(request, HttpRequest)]
+        for key in [key for key in pending if key not in batchable]:
+            if limiter:
+                limiter.acquire()
+            start = time.monotonic()
+            try:
+                response = pending[key].execute()
+            except Exception as exc:
+                done(key, None, exc, start)
+            else:
+                done(key, response, None, start)
+
+        for i in range(0, len(batchable), batch_size):
+            chunk = {str(j): key for j, key in enumerate(batchable[i:i + batch_size])}
+            if limiter:
+                for _ in chunk:
+                    limiter.acquire()
+            start = time.monotonic()
+
+            def callback(request_id, response, exception, chunk=chunk, start=start):
+                done(chunk[request_id], response, exception, start)
+            batch = resource.new_batch_http_request(callback=callback)
+            for request_id, key in chunk.items():
+                batch.add(pending[key], request_id=request_id)
+            try:
+                batch.execute(http=http)
+            except (RefreshError, HttpError) as exc:
+                # the whole batch failed
+                for key in chunk.values():
+                    done(key, None, exc, start)
+        pending = retry
+    return results, errors
+
+
+class RateLimiter:
+    """Thread-safe token bucket limiting the rate of events.
+
+    Args:
+        rate (float): events per second
+        burst (int): max number of events at once (default: `rate`)
+    """
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst if burst else max(1, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Block until an event is allowed."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class GoogleApiExecutor:
+    """Execute Google API requests with `retry_execute_async()` in a thread pool.
+
+    Lets asyncio code run many blocking Google API requests concurrently,
+    while staying under the API's rate quota (the Admin SDK Directory API
+    allows a few thousand queries per minute).
+
+    The default httplib2 transport of googleapiclient is not thread-safe.
+    If `credentials` are given, each thread executes requests with its own
+    authorized transport. Otherwise, requests are executed as they are,
+    which is only safe if they don't share a transport (e.g. mocks).
+
+    Args:
+        max_workers (int): max number of concurrent requests
+        rate (float): max number of requests per second
+        credentials (google.auth.credentials.Credentials): (optional) credentials
+    """
+    def __init__(self, max_workers=8, rate=20, credentials=None, stats=None):
+        self.pool = ThreadPoolExecutor(max_workers, thread_name_prefix='google-api')
+        self.limiter = RateLimiter(rate)
+        self.credentials = credentials
+        self.stats = stats
+        self._local = threading.local()
+
+    async def execute(self, request):
+        """Execute a request without blocking the event loop.
+
+        Args:
+            request: googleapiclient request object
+
+        Returns:
+            Return value of request.execute()
+        """
+        def execute(func):
+            self.limiter.acquire()
+            if self.credentials is not None:
+                request.http = self._http()
+            return func()
+
+        async def run(func):
+            return await asyncio.get_running_loop().run_in_executor(self.pool, execute, func)
+        return await retry_execute_async(request, run=run, stats=self.stats)
+
+    def _http(self):
+        if self.credentials is None:
+            return None
+        if not hasattr(self._local, 'http'):
+            self._local.http = AuthorizedHttp(self.credentials, http=httplib2.Http())
+        return self._local.http
+
+    async def execute_batch(self, resource, requests, batch_size=50):
+        """Execute many requests with `batch_execute()` without blocking the event loop.
+
+        Each sub-request counts against the rate limit.
+
+        Returns:
+            tuple: ({key: response}, {key: exception}) of succeeded and failed requests
+        """
+        def execute_batch():
+            return batch_execute(resource, requests, batch_size=batch_size,
+                                 http=self._http(), limiter=self.limiter, stats=self.stats)
+        return await asyncio.get_running_loop().run_in_executor(self.pool, execute_batch)
+
+    def shutdown(self):
+        self.pool.shutdown()
+
+
 def reflow_text(text, para_sep="\n\n", **kwargs):
     """Try to make the message look nice by re-wrapping lines
 
@@ -4,7 +4,7 @@ import logging
 
 from krs.ldap import LDAP, get_ldap_members
 from krs.users import UserDoesNotExist
-from krs.groups import list_groups, create_group, modify_group, add_user_group, remove_user_group
+from krs.groups import GroupIndex, create_group, modify_group, apply_membership_changes
 from krs.bootstrap import get_token
 from krs.token import get_rest_client
 
@@ -16,6 +16,17 @@ logger = logging.getLogger('import_ldap')
 IGNORE_LIST = set(['IceCube', 'wipac'])
 
 
+async def apply_changes(keycloak_conn, keycloak_groups, add=None, remove=None):
+    """Apply membership changes in bulk, skipping users that don't exist in Keycloak."""
+    _, failed = await apply_membership_changes(add=add, remove=remove, rest_client=keycloak_conn,
+                                               group_index=keycloak_groups)
+    for member, exc in failed.items():
+        if isinstance(exc, UserDoesNotExist):
+            logger.info(f'skipping user {member} - user does not exist')
+        else:
+            raise exc
+
+
 def get_attr_as_list(group, name, default=None):
     if name not in group:
         return default
@@ -36,24 +47,22 @@ async def import_ldap_groups(keycloak_conn, ldap_setup=True, dryrun=False):
     ldap_users = ldap_conn.list_users()
     ldap_groups = ldap_conn.list_groups()
 
-    keycloak_groups = await list_groups(rest_client=keycloak_conn)
+    keycloak_groups = await GroupIndex.load(rest_client=keycloak_conn)
 
     # handle /posix group
     if '/posix' not in keycloak_groups:
         logger.info('creating /posix group')
         if not dryrun:
-            await create_group('/posix', rest_client=keycloak_conn)
-    if not dryrun:
-        for member in ldap_users:
-            try:
-                if 'loginShell' in ldap_users[member] and ldap_users[member]['loginShell'] != '/sbin/nologin':
-                    logger.info(f'add {member} to /posix')
-                    await add_user_group('/posix', member, rest_client=keycloak_conn)
-                else:
-                    logger.info(f'remove {member} from /posix')
-                    await remove_user_group('/posix', member, rest_client=keycloak_conn)
-            except UserDoesNotExist:
-                logger.info(f'skipping user {member} for group /posix - user does not exist')
+            await create_group('/posix', rest_client=keycloak_conn, group_index=keycloak_groups)
+    add = {'/posix': []}
+    remove = {'/posix': []}
+    for member in ldap_users:
+        if 'loginShell' in ldap_users[member] and ldap_users[member]['loginShell'] != '/sbin/nologin':
+            logger.info(f'add {member} to /posix')
+            add['/posix'].append(member)
+        else:
+            logger.info(f'remove {member} from /posix')
+            remove['/posix'].append(member)
 
     for group_name in sorted(ldap_groups):
         members = get_ldap_members(ldap_groups[group_name])
@@ -72,26 +81,22 @@ async def import_ldap_groups(keycloak_conn, ldap_setup=True, dryrun=False):
             else:
                 logger.info(f'creating user group /posix/{group_name} with members {members}')
                 if not dryrun:
-                    await create_group(f'/posix/{group_name}', {'gidNumber': gidNumber}, rest_client=keycloak_conn)
-                    for member in members:
-                        try:
-                            await add_user_group(f'/posix/{group_name}', member, rest_client=keycloak_conn)
-                        except UserDoesNotExist:
-                            logger.info(f'skipping user {member} for group /posix/{group_name} - user does not exist')
+                    await create_group(f'/posix/{group_name}', {'gidNumber': gidNumber}, rest_client=keycloak_conn, group_index=keycloak_groups)
+                    add[f'/posix/{group_name}'] = members
         else:
             logger.info(f'creating non-user group /posix/{group_name} with members {members}')
             if not dryrun:
-                await create_group(f'/posix/{group_name}', {'gidNumber': gidNumber}, rest_client=keycloak_conn)
-                for member in members:
-                    try:
-                        await add_user_group(f'/posix/{group_name}', member, rest_client=keycloak_conn)
-                    except UserDoesNotExist:
-                        logger.info(f'skipping user {member} for group /posix/{group_name} - user does not exist')
+                await create_group(f'/posix/{group_name}', {'gidNumber': gidNumber}, rest_client=keycloak_conn, group_index=keycloak_groups)
+                add[f'/posix/{group_name}'] = members
+
+    if not dryrun:
+        await apply_changes(keycloak_conn, keycloak_groups, add=add, remove=remove)
 
 
 async def import_ldap_insts(keycloak_conn, base_group='/institutions/IceCube', INSTS=ICECUBE_INSTS, dryrun=False):
     ldap_conn = LDAP()
     ldap_users = ldap_conn.list_users()
+    keycloak_groups = await GroupIndex.load(rest_client=keycloak_conn)
 
     # now handle institutions
     keycloak_insts_by_o = {}
@@ -104,6 +109,7 @@ async def import_ldap_insts(keycloak_conn, base_group='/institutions/IceCube', I
             logger.info(f'skipping Keycloak inst {name}')
 
     inst_groups = ldap_conn.list_groups('ou=Institutions,dc=icecube,dc=wisc,dc=edu')
+    add = {}
     for inst_cn in sorted(inst_groups, key=lambda x: inst_groups[x]['o']):
         inst = inst_groups[inst_cn]
         inst_o = inst['o']
@@ -122,20 +128,21 @@ async def import_ldap_insts(keycloak_conn, base_group='/institutions/IceCube', I
             }
             if not dryrun:
                 logger.info(f'modify inst with attrs {attrs}')
-                await modify_group(keycloak_group, attrs, rest_client=keycloak_conn)
+                await modify_group(keycloak_group, attrs, rest_client=keycloak_conn, group_index=keycloak_groups)
             for user in inst_admin:
                 logger.debug(f'adding admin user {user} to {keycloak_group}/_admin')
-                if not dryrun:
-                    await add_user_group(keycloak_group+'/_admin', user, rest_client=keycloak_conn)
+                add.setdefault(keycloak_group+'/_admin', []).append(user)
             inst_full_o = f'o={inst_o},ou=Institutions,dc=icecube,dc=wisc,dc=edu'
             for user in ldap_users:
                 if ldap_users[user].get('o', None) == inst_full_o:
                     logger.debug(f'adding user {user} to {keycloak_group}')
-                    if not dryrun:
-                        await add_user_group(keycloak_group, user, rest_client=keycloak_conn)
+                    add.setdefault(keycloak_group, []).append(user)
         else:
             logger.info(f'skipping LDAP inst {inst["o"]}')
 
+    if not dryrun:
+        await apply_changes(keycloak_conn, keycloak_groups, add=add)
+
 
 def main():
     parser = argparse.ArgumentParser(description='IceCube Keycloak setup')
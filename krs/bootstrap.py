@@ -1,11 +1,14 @@
 """
 Bootstrap a Keycloak instance with an admin role account for REST access.
 """
+from functools import partial
 import time
 import requests
 
 from wipac_dev_tools import from_environment
 
+from .token import hash_secret, get_token_manager, request_token
+
 
 def wait_for_keycloak(timeout=300):
     cfg = from_environment({
@@ -40,10 +43,8 @@ def get_token():
         'password': cfg['PASSWORD'],
     }
 
-    r = requests.post(url, data=args)
-    r.raise_for_status()
-    req = r.json()
-    return req['access_token']
+    key = f'{url}|admin-cli|{cfg["USERNAME"]}|{hash_secret(cfg["PASSWORD"])}'
+    return get_token_manager().get(key, partial(request_token, url, args))
 
 
 def create_realm(realm, token=None):
@@ -0,0 +1,239 @@
+"""
+Local on-disk snapshot of Keycloak realm state.
+
+Cron-driven actions typically start by downloading all users from
+Keycloak. When several of them run back-to-back on the same host, they
+can share one snapshot stored in a local SQLite file instead.
+
+The Keycloak admin API doesn't provide ETags or modification times, so
+freshness is based on a TTL and explicit invalidation only. Actions that
+modify users should invalidate the snapshot, and actions must not make
+destructive decisions based on cached data alone.
+
+Only the user list is cached. The group hierarchy and group memberships
+are not: the actions that read them either make destructive decisions
+from them or run in response to membership changes, so a snapshot could
+not be used, and those reads are already cheap with `krs.groups.GroupIndex`.
+
+The cache is configured with environment variables:
+
+* KRS_CACHE_FILE: path of the SQLite file (caching is disabled if empty)
+* KRS_CACHE_USERS_TTL: seconds before the user list expires
+
+Example::
+
+    python -m krs.cache info
+    python -m krs.cache invalidate
+"""
+import asyncio
+from contextlib import contextmanager
+import json
+import logging
+import os
+import sqlite3
+import time
+
+from wipac_dev_tools import from_environment
+
+from .token import get_rest_client
+from .users import list_users
+
+logger = logging.getLogger('krs.cache')
+
+ENTITIES = ('users',)
+
+
+class RealmCache:
+    """
+    Realm snapshot cache backed by a SQLite file.
+
+    Snapshots are keyed on the REST client address, so one file can hold
+    snapshots of several realms. Several processes may share the file.
+
+    Args:
+        filename (str): path of the SQLite file
+        users_ttl (float): seconds before the user list expires
+        bypass (bool): ignore cached values, but still store fresh ones
+    """
+    def __init__(self, filename, users_ttl=600, bypass=False):
+        self.filename = filename
+        self.ttl = {
+            'users': users_ttl,
+        }
+        self.bypass = bypass
+
+        dirname = os.path.dirname(filename)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('''CREATE TABLE IF NOT EXISTS snapshot (
+                realm TEXT NOT NULL,
+                entity TEXT NOT NULL,
+                key TEXT NOT NULL,
+                fetched REAL NOT NULL,
+                value TEXT NOT NULL,
+                PRIMARY KEY (realm, entity, key))''')
+
+    @classmethod
+    def from_environment(cls, bypass=False):
+        """
+        Create a cache as configured by environment variables.
+
+        Args:
+            bypass (bool): ignore cached values, but still store fresh ones
+
+        Returns:
+            RealmCache|None: the cache, or None if caching is disabled
+        """
+        config = from_environment({
+            'KRS_CACHE_FILE': '',
+            'KRS_CACHE_USERS_TTL': 600,
+        })
+        if not config['KRS_CACHE_FILE']:
+            return None
+        return cls(config['KRS_CACHE_FILE'],
+                   users_ttl=float(config['KRS_CACHE_USERS_TTL']),
+                   bypass=bypass)
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.filename, timeout=60)
+        try:
+            with conn:  # commit or roll back
+                yield conn
+        finally:
+            conn.close()
+
+    def _get(self, realm, entity, key=''):
+        if self.bypass:
+            return None
+        with self._connect() as conn:
+            row = conn.execute('SELECT fetched, value FROM snapshot WHERE realm=? AND entity=? AND key=?',
+                               (realm, entity, key)).fetchone()
+        if row is None:
+            return None
+        fetched, value = row
+        if time.time() - fetched > self.ttl[entity]:
+            logger.debug(f'cached {entity} {key} of {realm} expired')
+            return None
+        return json.loads(value)
+
+    def _put(self, realm, entity, value, key=''):
+        with self._connect() as conn:
+            conn.execute('INSERT OR REPLACE INTO snapshot (realm, entity, key, fetched, value) '
+                         'VALUES (?, ?, ?, ?, ?)',
+                         (realm, entity, key, time.time(), json.dumps(value)))
+
+    async def list_users(self, require=None, rest_client=None):
+        """
+        List all users in Keycloak, using the snapshot if it is fresh.
+
+        Args:
+            require (iterable): (optional) usernames known to exist; the
+                                snapshot is refreshed if any are missing
+
+        Returns:
+            dict: username: user info
+        """
+        ret = self._get(rest_client.address, 'users')
+        if ret is not None and require and not set(require) <= ret.keys():
+            logger.info('cached users are missing some required users')
+            ret = None
+        if ret is None:
+            ret = await list_users(rest_client=rest_client)
+            self._put(rest_client.address, 'users', ret)
+        return ret
+
+    async def iter_users(self, rest_client=None):
+        """
+        Iterate over all users in Keycloak, using the snapshot if it is fresh.
+
+        Same interface as `krs.users.iter_users()`.
+
+        Yields:
+            dict: user info
+        """
+        for user in (await self.list_users(rest_client=rest_client)).values():
+            yield user
+
+    def invalidate(self, entity=None, key=None, realm=None):
+        """
+        Remove entries from the snapshot.
+
+        Args:
+            entity (str): one of ENTITIES (default: all)
+            key (str): entry key (default: all)
+            realm (str): REST client address of the realm (default: all)
+        """
+        if entity is not None and entity not in ENTITIES:
+            raise ValueError(f'unknown cache entity "{entity}", expected one of {ENTITIES}')
+        clauses, params = [], []
+        for name, val in (('entity', entity), ('key', key), ('realm', realm)):
+            if val is not None:
+                clauses.append(f'{name}=?')
+                params.append(val)
+        sql = 'DELETE FROM snapshot' + (' WHERE ' + ' AND '.join(clauses) if clauses else '')
+        with self._connect() as conn:
+            conn.execute(sql, params)
+        logger.info(f'invalidated {entity or "all entities"} {key or ""}')
+
+    def info(self):
+        """
+        Describe the contents of the snapshot.
+
+        Entries of entities that are no longer cached (e.g. written by an
+        older version) are reported as expired.
+
+        Returns:
+            list: one dict per entry, with its age and whether it expired
+        """
+        now = time.time()
+        with self._connect() as conn:
+            rows = conn.execute('SELECT realm, entity, key, fetched, length(value) FROM snapshot '
+                                'ORDER BY realm, entity, key').fetchall()
+        return [{
+            'realm': realm,
+            'entity': entity,
+            'key': key,
+            'age': round(now - fetched),
+            'expired': entity not in self.ttl or now - fetched > self.ttl[entity],
+            'size': size,
+        } for realm, entity, key, fetched, size in rows]
+
+
+def main():
+    import argparse
+    from pprint import pprint
+
+    parser = argparse.ArgumentParser(description='Keycloak realm snapshot cache (see module docstring)')
+    subparsers = parser.add_subparsers()
+    parser_info = subparsers.add_parser('info', help='show cache contents')
+    parser_info.set_defaults(func='info')
+    parser_invalidate = subparsers.add_parser('invalidate', help='remove all cache entries')
+    parser_invalidate.set_defaults(func='invalidate')
+    parser_refresh = subparsers.add_parser('refresh', help='refresh users of the configured realm')
+    parser_refresh.set_defaults(func='refresh')
+    args = vars(parser.parse_args())
+
+    logging.basicConfig(format='%(levelname)s: %(message)s', level=logging.INFO)
+
+    cache = RealmCache.from_environment()
+    if cache is None:
+        parser.exit(1, 'KRS_CACHE_FILE is not set\n')
+
+    func = args.pop('func', None)
+    if func == 'info':
+        pprint(cache.info())
+    elif func == 'invalidate':
+        cache.invalidate()
+    elif func == 'refresh':
+        cache.bypass = True
+        rest_client = get_rest_client()
+        asyncio.run(cache.list_users(rest_client=rest_client))
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
@@ -3,10 +3,11 @@ Group actions against Keycloak.
 """
 import asyncio
 import logging
+from urllib.parse import quote
 
 from .token import get_rest_client
 from .users import user_info
-from .util import fix_singleton_attributes
+from .util import fix_singleton_attributes, paginate
 
 logger = logging.getLogger('krs.groups')
 
@@ -92,17 +93,195 @@ async def list_groups(max_groups=10000, rest_client=None):
     return ret
 
 
-async def group_info(group_path, rest_client=None):
+async def _list_groups(rest_client, group_index):
+    """Return `group_index` if given, otherwise the output of `list_groups()`."""
+    if group_index is not None:
+        return group_index
+    return await list_groups(rest_client=rest_client)
+
+
+class GroupIndex:
+    """
+    In-memory index of the Keycloak group hierarchy.
+
+    Loads the group hierarchy once and provides path -> id, id -> path,
+    and parent/child lookups, so that many calls to `krs.groups` functions
+    don't each have to download the whole hierarchy. Lookups by path
+    return the same simplified group representation as `list_groups()`.
+
+    The index updates itself after `create_group()`, `modify_group()`
+    (renames) and `delete_group()` calls that are given the index.
+    Changes made by other means are not seen until `refresh()` is called.
+
+    Args:
+        groups (dict): output of `list_groups()`
+    """
+    def __init__(self, groups):
+        self.groups = groups
+        self.ids = {g['id']: path for path, g in groups.items()}
+
+    @classmethod
+    async def load(cls, rest_client=None):
+        """
+        Create an index of the current Keycloak group hierarchy.
+
+        Args:
+            rest_client (RestClient): Keycloak REST client
+
+        Returns:
+            GroupIndex: group index
+        """
+        return cls(await list_groups(rest_client=rest_client))
+
+    async def refresh(self, rest_client=None):
+        """
+        Reload the index from Keycloak.
+
+        Args:
+            rest_client (RestClient): Keycloak REST client
+        """
+        self.groups = await list_groups(rest_client=rest_client)
+        self.ids = {g['id']: path for path, g in self.groups.items()}
+
+    def __contains__(self, group_path):
+        return group_path in self.groups
+
+    def __getitem__(self, group_path):
+        return self.groups[group_path]
+
+    def __iter__(self):
+        return iter(self.groups)
+
+    def __len__(self):
+        return len(self.groups)
+
+    def keys(self):
+        return self.groups.keys()
+
+    def items(self):
+        return self.groups.items()
+
+    def get_id(self, group_path):
+        """
+        Get the id of a group.
+
+        Args:
+            group_path (str): group path (/parent/parent/name)
+
+        Returns:
+            str: group id
+        """
+        if group_path not in self.groups:
+            raise GroupDoesNotExist(f'group "{group_path}" does not exist')
+        return self.groups[group_path]['id']
+
+    def get_path(self, group_id):
+        """
+        Get the path of a group.
+
+        Args:
+            group_id (str): group id
+
+        Returns:
+            str: group path
+        """
+        if group_id not in self.ids:
+            raise GroupDoesNotExist(f'group "{group_id}" does not exist')
+        return self.ids[group_id]
+
+    def parent(self, group_path):
+        """
+        Get the path of the parent of a group.
+
+        Args:
+            group_path (str): group path (/parent/parent/name)
+
+        Returns:
+            str|None: parent group path, or None for top-level groups
+        """
+        if group_path not in self.groups:
+            raise GroupDoesNotExist(f'group "{group_path}" does not exist')
+        parent = group_path.rsplit('/', 1)[0]
+        return parent if parent else None
+
+    def children(self, group_path):
+        """
+        Get the paths of the direct children of a group.
+
+        Args:
+            group_path (str): group path (/parent/parent/name)
+
+        Returns:
+            list: child group paths
+        """
+        if group_path not in self.groups:
+            raise GroupDoesNotExist(f'group "{group_path}" does not exist')
+        return [f'{group_path}/{name}' for name in self.groups[group_path]['children']]
+
+    def descendants(self, group_path):
+        """
+        Get the paths of all the descendants of a group.
+
+        Args:
+            group_path (str): group path (/parent/parent/name)
+
+        Returns:
+            list: descendant group paths, parents before children
+        """
+        ret = []
+        for child in self.children(group_path):
+            ret.append(child)
+            ret.extend(self.descendants(child))
+        return ret
+
+    def _add(self, group):
+        path = group['path']
+        self.groups[path] = {
+            'id': group['id'],
+            'name': group['name'],
+            'path': path,
+            'children': [],
+            'attributes': group.get('attributes', {}),
+        }
+        self.ids[group['id']] = path
+        parent = path.rsplit('/', 1)[0]
+        if parent in self.groups and group['name'] not in self.groups[parent]['children']:
+            self.groups[parent]['children'].append(group['name'])
+
+    def _rename(self, group_path, new_group_name):
+        parent, old_name = group_path.rsplit('/', 1)
+        new_path = f'{parent}/{new_group_name}'
+        for path in [group_path] + self.descendants(group_path):
+            g = self.groups.pop(path)
+            g['path'] = new_path + path[len(group_path):]
+            self.groups[g['path']] = g
+            self.ids[g['id']] = g['path']
+        self.groups[new_path]['name'] = new_group_name
+        if parent in self.groups:
+            children = self.groups[parent]['children']
+            children[children.index(old_name)] = new_group_name
+
+    def _remove(self, group_path):
+        for path in [group_path] + self.descendants(group_path):
+            g = self.groups.pop(path)
+            self.ids.pop(g['id'], None)
+        parent, name = group_path.rsplit('/', 1)
+        if parent in self.groups:
+            self.groups[parent]['children'].remove(name)
+
+
+async def group_info(group_path, rest_client=None, group_index=None):
     """
     Get group information.
 
     Args:
         group_path (str): group path (/parent/parent/name)
+        group_index (GroupIndex): (optional) group index to use for lookups
 
     Returns:
         dict: group info
     """
-    groups = await list_groups(rest_client=rest_client)
+    groups = await _list_groups(rest_client, group_index)
     if group_path not in groups:
         raise GroupDoesNotExist(f'group "{group_path}" does not exist')
 
@@ -150,15 +329,16 @@ async def group_info_by_id(group_id, rest_client=None):
     return ret
 
 
-async def create_group(group_path, attrs=None, rest_client=None):
+async def create_group(group_path, attrs=None, rest_client=None, group_index=None):
     """
     Create a group in Keycloak.
 
     Args:
         group_path (str): group path (/parent/parent/name)
         attrs (dict): attributes
+        group_index (GroupIndex): (optional) group index to use and update
     """
-    groups = await list_groups(rest_client=rest_client)
+    groups = await _list_groups(rest_client, group_index)
     if group_path in groups:
         logger.info(f'group "{group_path}" already exists')
     else:
@@ -182,8 +362,14 @@ async def create_group(group_path, attrs=None, rest_client=None):
         await rest_client.request('POST', url, group)
         logger.info(f'group "{group_path}" created')
 
+        if group_index is not None:
+            # POST doesn't return the new group, so look it up directly
+            ret = await rest_client.request('GET', f'/group-by-path{quote(group_path)}')
+            fix_singleton_attributes(ret)
+            group_index._add(ret)
+
 
-async def modify_group(group_path, attrs={}, new_group_name=None, rest_client=None):
+async def modify_group(group_path, attrs={}, new_group_name=None, rest_client=None, group_index=None):
     """
     Modify attributes for a group.
 
@@ -195,8 +381,9 @@ async def modify_group(group_path, attrs={}, new_group_name=None, rest_client=No
         group_path (str): group path (/parent/parent/name)
         attrs (dict): attributes to modify
         new_group_name (str): new group name
+        group_index (GroupIndex): (optional) group index to use and update
     """
-    groups = await list_groups(rest_client=rest_client)
+    groups = await _list_groups(rest_client, group_index)
     if group_path in groups:
         url = f'/groups/{groups[group_path]["id"]}'
         ret = await rest_client.request('GET', url)
@@ -212,37 +399,47 @@ async def modify_group(group_path, attrs={}, new_group_name=None, rest_client=No
             ret['path'] = ret['path'].rsplit('/', 1)[0] + '/' + new_group_name
         await rest_client.request('PUT', url, ret)
         logger.info(f'group "{group_path}" modified')
+
+        if group_index is not None:
+            fix_singleton_attributes(ret)
+            group_index[group_path]['attributes'] = ret['attributes']
+            if new_group_name:
+                group_index._rename(group_path, new_group_name)
     else:
         logger.info(f'group "{group_path}" does not exist')
 
 
-async def delete_group(group_path, rest_client=None):
+async def delete_group(group_path, rest_client=None, group_index=None):
     """
     Delete a group in Keycloak.
 
     Args:
         group_path (str): group path (/parent/parent/name)
+        group_index (GroupIndex): (optional) group index to use and update
     """
-    groups = await list_groups(rest_client=rest_client)
+    groups = await _list_groups(rest_client, group_index)
     if group_path in groups:
         url = f'/groups/{groups[group_path]["id"]}'
         await rest_client.request('DELETE', url)
         logger.info(f'group "{group_path}" deleted')
+        if group_index is not None:
+            group_index._remove(group_path)
     else:
         logger.info(f'group "{group_path}" does not exist')
 
 
-async def get_group_membership(group_path, rest_client=None):
+async def get_group_membership(group_path, rest_client=None, group_index=None):
     """
     Get the membership list of a group.
 
     Args:
         group_path (str): group path (/parent/parent/name)
+        group_index (GroupIndex): (optional) group index to use for lookups
 
     Returns:
         list: usernames
     """
-    groups = await list_groups(rest_client=rest_client)
+    groups = await _list_groups(rest_client, group_index)
     if group_path not in groups:
         raise GroupDoesNotExist(f'group "{group_path}" does not exist')
     group_id = groups[group_path]['id']
@@ -250,30 +447,98 @@ async def get_group_membership(group_path, rest_client=None):
     return await get_group_membership_by_id(group_id, rest_client=rest_client)
 
 
-async def get_group_membership_by_id(group_id, rest_client=None):
+async def iter_group_membership_by_id(group_id, rest_client=None, page_size=50, concurrency=4):
+    """
+    Iterate over the membership list of a group.
+
+    Same as `get_group_membership_by_id()`, but yields usernames as pages
+    arrive, so that the caller can start processing before the last page
+    is fetched.
+
+    Args:
+        group_id (str): group id
+        page_size (int): number of members per request
+        concurrency (int): max number of concurrent requests
+
+    Yields:
+        str: usernames
+    """
+    url = f'/groups/{group_id}/members?briefRepresentation=true'
+    async for user in paginate(rest_client, url, page_size=page_size, concurrency=concurrency):
+        yield user['username']
+
+
+async def get_group_membership_by_id(group_id, rest_client=None, page_size=50, concurrency=4):
     """
     Get the membership list of a group.
 
-    This is a paginated request that is fairly slow when linked with LDAP.
+    This is a paginated request that is fairly slow when linked with LDAP,
+    so several pages are requested at once.
 
     Args:
         group_id (str): group id
+        page_size (int): number of members per request
+        concurrency (int): max number of concurrent requests
 
     Returns:
         list: usernames
     """
-    start = 0
-    inc = 50
-    ret = []
-    data = [0]*inc
+    return [username async for username in iter_group_membership_by_id(
+        group_id, rest_client=rest_client, page_size=page_size, concurrency=concurrency)]
 
-    while len(data) == inc:
-        url = f'/groups/{group_id}/members?briefRepresentation=true&max={inc}&first={start}'
-        start += inc
-        data = await rest_client.request('GET', url)
-        for user in data:
-            ret.append(user['username'])
-    return ret
+
+async def get_memberships(paths_or_ids, subgroups=False, concurrency=8, cache=None,
+                          rest_client=None, group_index=None):
+    """
+    Get the membership lists of many groups at once.
+
+    Groups may be given by path or by id. Each distinct group is fetched
+    only once, with up to `concurrency` groups fetched in parallel. If
+    `subgroups` is set, the memberships of all descendants of the given
+    groups are included too, and overlapping subtrees are fetched once.
+
+    Args:
+        paths_or_ids (iterable): group paths and/or group ids
+        subgroups (bool): also get memberships of all descendant groups
+        concurrency (int): max number of concurrent requests
+        cache (dict): (optional) group_path: usernames of memberships
+                      already known; updated in place with new results
+        group_index (GroupIndex): (optional) group index to use for lookups
+
+    Returns:
+        tuple: ({group_path: [usernames]}, {username: [group_paths]})
+    """
+    if group_index is None:
+        group_index = await GroupIndex.load(rest_client=rest_client)
+    if cache is None:
+        cache = {}
+
+    group_paths = []
+    for path_or_id in paths_or_ids:
+        if path_or_id in group_index:
+            path = path_or_id
+        else:
+            path = group_index.get_path(path_or_id)
+        group_paths.append(path)
+        if subgroups:
+            group_paths.extend(group_index.descendants(path))
+    group_paths = list(dict.fromkeys(group_paths))
+
+    sem = asyncio.Semaphore(concurrency)
+
+    async def fetch(path):
+        async with sem:
+            cache[path] = await get_group_membership_by_id(
+                group_index.get_id(path), rest_client=rest_client, concurrency=1)
+
+    await asyncio.gather(*[fetch(path) for path in group_paths if path not in cache])
+
+    group_members = {path: cache[path] for path in group_paths}
+    user_groups = {}
+    for path, usernames in group_members.items():
+        for username in usernames:
+            user_groups.setdefault(username, []).append(path)
+    return group_members, user_groups
 
 
 async def get_user_groups(username, rest_client=None):
@@ -286,7 +551,7 @@ async def get_user_groups(username, rest_client=None):
     Returns:
         list: group paths
     """
-    info = await user_info(username, rest_client=rest_client)
+    info = await user_info(username, rest_client=rest_client, use_cache=False)
     return await get_user_groups_by_id(info['id'], rest_client=rest_client)
 
 
@@ -309,63 +574,134 @@ async def get_user_groups_by_id(user_id, rest_client=None):
     return ret
 
 
-async def add_user_group(group_path, username, rest_client=None):
+def plan_membership_changes(current, add=None, remove=None):
     """
-    Add a user to a group in Keycloak.
+    Plan the Keycloak requests needed to change a user's group memberships.
+
+    Keycloak silently ignores adding a user to a group while the user is
+    a member of one of its subgroups, so memberships of subgroups of added
+    groups are temporarily removed and then restored
+    (https://issues.redhat.com/browse/KEYCLOAK-11298). Each such subgroup
+    is removed and restored at most once, however many of its ancestors
+    are added.
 
     Args:
-        group_path (str): group path (/parent/parent/name)
-        username (str): username of user
+        current (iterable): group paths the user is currently a member of
+        add (iterable): group paths to add the user to
+        remove (iterable): group paths to remove the user from
+
+    Returns:
+        list: (method, group_path) requests, in order; empty if nothing to do
     """
-    groups = await list_groups(rest_client=rest_client)
-    if group_path not in groups:
-        raise GroupDoesNotExist(f'group "{group_path}" does not exist')
+    current = set(current)
+    add = set(add if add else []) - current
+    remove = set(remove if remove else []) & current
+    kept = current - remove
 
-    info = await user_info(username, rest_client=rest_client)
-    membership = await get_user_groups_by_id(info['id'], rest_client=rest_client)
+    # subgroup memberships that would block the additions
+    blocking = {path for path in kept if any(path.startswith(g + '/') for g in add)}
 
-    if group_path in membership:
-        logger.info(f'user "{username}" already a member of group "{group_path}"')
-    else:
-        # need to temp-remove child groups
-        # https://issues.redhat.com/browse/KEYCLOAK-11298
-        for group in membership:
-            if group.startswith(group_path):
-                url = f'/users/{info["id"]}/groups/{groups[group]["id"]}'
-                await rest_client.request('DELETE', url)
+    def depth(path):
+        return (path.count('/'), path)
 
-        url = f'/users/{info["id"]}/groups/{groups[group_path]["id"]}'
-        await rest_client.request('PUT', url)
+    ret = [('DELETE', path) for path in sorted(remove | blocking, key=depth, reverse=True)]
+    ret += [('PUT', path) for path in sorted(add | blocking, key=depth)]
+    return ret
 
-        for group in membership:
-            if group.startswith(group_path):
-                url = f'/users/{info["id"]}/groups/{groups[group]["id"]}'
-                await rest_client.request('PUT', url)
 
-        logger.info(f'user "{username}" added to group "{group_path}"')
+async def apply_membership_changes(add=None, remove=None, concurrency=8, rest_client=None, group_index=None):
+    """
+    Add and remove many group members, with the fewest Keycloak requests.
 
+    Each user's current memberships are fetched once, all the changes for
+    that user are planned together with `plan_membership_changes()`, and
+    only the requests that change something are made. Users are processed
+    in parallel, up to `concurrency` at a time; the requests for a single
+    user are made in order.
 
-async def remove_user_group(group_path, username, rest_client=None):
+    A failure for one user does not stop the others. Failed users are
+    returned with the exception, e.g. `UserDoesNotExist`.
+
+    Args:
+        add (dict): group_path: usernames to add to the group
+        remove (dict): group_path: usernames to remove from the group
+        concurrency (int): max number of users processed in parallel
+        group_index (GroupIndex): (optional) group index to use for lookups
+
+    Returns:
+        tuple: ({username: [(method, group_path)] requests made}, {username: exception})
     """
-    Remove a user from a group in Keycloak.
+    add = add if add else {}
+    remove = remove if remove else {}
+    if group_index is None:
+        group_index = await GroupIndex.load(rest_client=rest_client)
+
+    changes = {}  # username: (add paths, remove paths)
+    for i, group_changes in enumerate((add, remove)):
+        for group_path, usernames in group_changes.items():
+            if group_path not in group_index:
+                raise GroupDoesNotExist(f'group "{group_path}" does not exist')
+            for username in usernames:
+                changes.setdefault(username, (set(), set()))[i].add(group_path)
+
+    applied = {}
+    failed = {}
+    sem = asyncio.Semaphore(concurrency)
+
+    async def apply(username, add_paths, remove_paths):
+        async with sem:
+            try:
+                info = await user_info(username, rest_client=rest_client, use_cache=False)
+                membership = await get_user_groups_by_id(info['id'], rest_client=rest_client)
+                plan = plan_membership_changes(membership, add=add_paths, remove=remove_paths)
+                for method, group_path in plan:
+                    url = f'/users/{info["id"]}/groups/{group_index.get_id(group_path)}'
+                    await rest_client.request(method, url)
+                applied[username] = plan
+            except Exception as e:
+                logger.debug(f'membership changes for user "{username}" failed', exc_info=True)
+                failed[username] = e
+
+    await asyncio.gather(*[apply(username, *paths) for username, paths in changes.items()])
+    return applied, failed
+
+
+async def add_user_group(group_path, username, rest_client=None, group_index=None):
+    """
+    Add a user to a group in Keycloak.
 
     Args:
         group_path (str): group path (/parent/parent/name)
         username (str): username of user
+        group_index (GroupIndex): (optional) group index to use for lookups
     """
-    groups = await list_groups(rest_client=rest_client)
-    if group_path not in groups:
-        raise GroupDoesNotExist(f'group "{group_path}" does not exist')
+    applied, failed = await apply_membership_changes(add={group_path: [username]},
+                                                     rest_client=rest_client, group_index=group_index)
+    if username in failed:
+        raise failed[username]
+    if applied[username]:
+        logger.info(f'user "{username}" added to group "{group_path}"')
+    else:
+        logger.info(f'user "{username}" already a member of group "{group_path}"')
 
-    info = await user_info(username, rest_client=rest_client)
-    membership = await get_user_groups_by_id(info['id'], rest_client=rest_client)
 
-    if group_path not in membership:
-        logger.info(f'user "{username}" not a member of group "{group_path}"')
-    else:
-        url = f'/users/{info["id"]}/groups/{groups[group_path]["id"]}'
-        await rest_client.request('DELETE', url)
+async def remove_user_group(group_path, username, rest_client=None, group_index=None):
+    """
+    Remove a user from a group in Keycloak.
+
+    Args:
+        group_path (str): group path (/parent/parent/name)
+        username (str): username of user
+        group_index (GroupIndex): (optional) group index to use for lookups
+    """
+    applied, failed = await apply_membership_changes(remove={group_path: [username]},
+                                                     rest_client=rest_client, group_index=group_index)
+    if username in failed:
+        raise failed[username]
+    if applied[username]:
         logger.info(f'user "{username}" removed from group "{group_path}"')
+    else:
+        logger.info(f'user "{username}" not a member of group "{group_path}"')
 
 
 def main():
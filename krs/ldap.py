@@ -1,18 +1,116 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+import inspect
 import logging
 import ssl
+import threading
+import time
 
-from ldap3 import Server, Connection, Tls, ALL, ALL_ATTRIBUTES, MODIFY_ADD, MODIFY_REPLACE, MODIFY_DELETE
+from ldap3 import Server, Connection, Tls, SCHEMA, BASE, ALL_ATTRIBUTES, MODIFY_ADD, MODIFY_REPLACE, MODIFY_DELETE
+from ldap3.core.exceptions import LDAPCommunicationError
 from rest_tools.client import RestClient
 from wipac_dev_tools import from_environment
 
 logger = logging.getLogger('krs.ldap')
 
 
+class LDAPConnectionPool:
+    """
+    Pool of persistent LDAP connections bound with the same credentials.
+
+    Connections are opened on demand, up to `size` at once, and kept open
+    for reuse. An idle connection is health-checked before reuse if it sat
+    unused for more than `check_interval` seconds, and replaced if the
+    check fails. Connections that fail with a communication error are
+    discarded instead of returned to the pool.
+
+    Args:
+        server (Server): ldap3 server
+        user (str): bind DN (default: anonymous)
+        password (str): bind password
+        size (int): max number of connections
+        check_interval (float): seconds of idleness before a health check
+    """
+    def __init__(self, server, user=None, password=None, size=4, check_interval=60):
+        self.server = server
+        self.user = user
+        self.password = password
+        self.check_interval = check_interval
+        self.idle = []  # (connection, last used time)
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(size)
+
+    def _open(self):
+        # the schema is read once, by the first connection, and kept in the
+        # shared server object for typed attribute values
+        read_info = self.server.schema is None
+        c = Connection(self.server, user=self.user, password=self.password)
+        c.open(read_server_info=False)
+        if not c.bind(read_server_info=read_info):
+            raise Exception(f'LDAP bind failed: {c.result["description"]}')
+        return c
+
+    @staticmethod
+    def _healthy(c):
+        if c.closed or not c.bound:
+            return False
+        try:
+            return c.search('', '(objectClass=*)', search_scope=BASE, attributes=['1.1'])
+        except LDAPCommunicationError:
+            return False
+
+    @contextmanager
+    def connection(self):
+        """Borrow a connection from the pool."""
+        self.slots.acquire()
+        c = None
+        try:
+            with self.lock:
+                c, last_used = self.idle.pop() if self.idle else (None, 0)
+            if c and time.monotonic() - last_used > self.check_interval and not self._healthy(c):
+                logger.info('reconnecting stale LDAP connection')
+                self._close(c)
+                c = None
+            if not c:
+                c = self._open()
+            yield c
+        finally:
+            if c and (c.closed or not c.bound):
+                # broken by a communication error
+                self._close(c)
+            elif c:
+                with self.lock:
+                    self.idle.append((c, time.monotonic()))
+            self.slots.release()
+
+    @staticmethod
+    def _close(c):
+        try:
+            c.unbind()
+        except Exception:
+            pass
+
+    def close(self):
+        """Close all idle connections."""
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for c, _ in idle:
+            self._close(c)
+
+
 class LDAP:
     """
     LDAP client with a few basic actions to suppliment Keycloak
+
+    Connections are pooled and reused between calls. Use as a context
+    manager, or call `close()`, to close them when done.
+
+    Args:
+        pool_size (int): max number of connections per pool
     """
-    def __init__(self):
+    def __init__(self, pool_size=4):
         self.config = from_environment({
             'LDAP_URL': None,
             'LDAP_ADMIN_USER': 'cn=admin,dc=icecube,dc=wisc,dc=edu',
@@ -22,25 +120,60 @@ class LDAP:
             'LDAP_TLS_VERSION': '',
             'LDAP_TLS_CIPHERS': '',
         })
+        self.pool_size = pool_size
+        self.server = None
+        self.pools = {}
+        self.pools_lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """Close all pooled connections, and shut down the `AsyncLDAP` facade's thread pool."""
+        if (facade := self.__dict__.pop('_async_facade', None)) is not None:
+            facade.executor.shutdown(wait=True)
+        with self.pools_lock:
+            pools, self.pools = self.pools, {}
+        for pool in pools.values():
+            pool.close()
+
+    def _server(self):
+        if not self.server:
+            s_kwargs = {}
+            if self.config['LDAP_TLS_VERSION']:
+                # set up TLS
+                t_kwargs = {
+                    'version': getattr(ssl, 'PROTOCOL_'+self.config['LDAP_TLS_VERSION'])
+                }
+                if self.config['LDAP_TLS_CIPHERS']:
+                    t_kwargs['ciphers'] = self.config['LDAP_TLS_CIPHERS']
+                s_kwargs['tls'] = Tls(**t_kwargs)
 
-    def _connect(self, **c_kwargs):
-        s_kwargs = {}
-        if self.config['LDAP_TLS_VERSION']:
-            # set up TLS
-            t_kwargs = {
-                'version': getattr(ssl, 'PROTOCOL_'+self.config['LDAP_TLS_VERSION'])
-            }
-            if self.config['LDAP_TLS_CIPHERS']:
-                t_kwargs['ciphers'] = self.config['LDAP_TLS_CIPHERS']
-            s_kwargs['tls'] = Tls(**t_kwargs)
+            # define the server
+            self.server = Server(self.config['LDAP_URL'], get_info=SCHEMA, **s_kwargs)
+        return self.server
 
-        # define the server
-        s = Server(self.config['LDAP_URL'], get_info=ALL, **s_kwargs)
+    def _connect(self, admin=False):
+        """
+        Borrow a pooled connection.
 
-        # define the connection
-        c = Connection(s, auto_bind=True, **c_kwargs)
+        Args:
+            admin (bool): bind as the admin user (default: anonymous)
 
-        return c
+        Returns:
+            contextmanager: yields an ldap3 Connection
+        """
+        with self.pools_lock:
+            if admin not in self.pools:
+                kwargs = {}
+                if admin:
+                    kwargs = {'user': self.config['LDAP_ADMIN_USER'], 'password': self.config['LDAP_ADMIN_PASSWORD']}
+                self.pools[admin] = LDAPConnectionPool(self._server(), size=self.pool_size, **kwargs)
+            pool = self.pools[admin]
+        return pool.connection()
 
     async def keycloak_ldap_link(self, keycloak_token=None):
         cfg = from_environment({
@@ -228,45 +361,63 @@ class LDAP:
             logger.info(f'error: {e.response.text}')
             raise
 
-    def list_users(self, attrs=None):
+    @staticmethod
+    def _paged_search(c, base, search_filter, key, attrs=None, page_size=100):
         """
-        List user information in LDAP.
+        Paged search, yielding (key value, attr dict) for each entry.
+
+        Only the requested attributes (and the key) are fetched from the
+        server. Attributes that are not set are left out.
+        """
+        attributes = list(dict.fromkeys([key] + list(attrs))) if attrs else ALL_ATTRIBUTES
+        cookie = None
+        while True:
+            c.search(base, search_filter, attributes=attributes, paged_size=page_size, paged_cookie=cookie)
+            if c.result['result']:
+                logger.debug(f'search result {c.result}')
+                raise Exception(f'Search {base} failed: {c.result["description"]}')
+            for entry in c.entries:
+                entry = entry.entry_attributes_as_dict
+                val = {k: (entry[k][0] if len(entry[k]) == 1 else entry[k]) for k in entry
+                       if entry[k] and (not attrs or k in attrs)}
+                yield entry[key][0], val
+            cookie = c.result['controls']['1.2.840.113556.1.4.319']['value']['cookie']
+            if not cookie:
+                break
+
+    def iter_users(self, attrs=None, search_filter=None, page_size=100):
+        """
+        Iterate over user information in LDAP.
+
+        Same as `list_users()`, but yields one page of users at a time,
+        so the whole directory is never in memory at once. A pooled
+        connection is held until the iteration finishes.
 
         Args:
             attrs (list): attributes from each user to return (default: ALL)
+            search_filter (str): (optional) extra LDAP filter, e.g. "(loginShell=*)"
+            page_size (int): number of users per page
 
-        Returns:
-            dict: username: attr dict
+        Yields:
+            tuple: (username, attr dict)
         """
-        c = self._connect()
-
-        # search for the user
-        c.search(self.config['LDAP_USER_BASE'], '(uid=*)', attributes=ALL_ATTRIBUTES, paged_size=100)
-        if c.result['result']:
-            logger.debug(f'search result {c.result}')
-            raise Exception(f'Search users failed: {c.result["description"]}')
-        cookie = c.result['controls']['1.2.840.113556.1.4.319']['value']['cookie']
+        search_filter = f'(&(uid=*){search_filter})' if search_filter else '(uid=*)'
+        with self._connect() as c:
+            yield from self._paged_search(c, self.config['LDAP_USER_BASE'], search_filter, 'uid',
+                                          attrs=attrs, page_size=page_size)
 
-        def process():
-            for entry in c.entries:
-                entry = entry.entry_attributes_as_dict
-                if attrs:
-                    val = {k: (entry[k][0] if len(entry[k]) == 1 else entry[k]) for k in entry if k in attrs}
-                else:
-                    val = {k: (entry[k][0] if len(entry[k]) == 1 else entry[k]) for k in entry}
-                ret[entry['uid'][0]] = val
+    def list_users(self, attrs=None, search_filter=None):
+        """
+        List user information in LDAP.
 
-        ret = {}
-        process()
-        while cookie:
-            c.search(self.config['LDAP_USER_BASE'], '(uid=*)', attributes=ALL_ATTRIBUTES, paged_size=100, paged_cookie=cookie)
-            if c.result['result']:
-                logger.debug(f'search result {c.result}')
-                raise Exception(f'Search users failed: {c.result["description"]}')
-            cookie = c.result['controls']['1.2.840.113556.1.4.319']['value']['cookie']
-            process()
+        Args:
+            attrs (list): attributes from each user to return (default: ALL)
+            search_filter (str): (optional) extra LDAP filter, e.g. "(loginShell=*)"
 
-        return ret
+        Returns:
+            dict: username: attr dict
+        """
+        return dict(self.iter_users(attrs=attrs, search_filter=search_filter))
 
     def get_user(self, username):
         """
@@ -281,13 +432,12 @@ class LDAP:
         Raises:
             KeyError
         """
-        c = self._connect()
-
-        # search for the user
-        ret = c.search(self.config['LDAP_USER_BASE'], f'(uid={username})', attributes=ALL_ATTRIBUTES)
-        if not ret:
-            raise KeyError(f'user {username} not found')
-        return c.entries[0]
+        with self._connect() as c:
+            # search for the user
+            ret = c.search(self.config['LDAP_USER_BASE'], f'(uid={username})', attributes=ALL_ATTRIBUTES)
+            if not ret:
+                raise KeyError(f'user {username} not found')
+            return c.entries[0]
 
     def create_user(self, username, firstName, lastName, email):
         """
@@ -299,28 +449,24 @@ class LDAP:
             lastName (str): last name of user
             email (str): email of user
         """
-        c = self._connect(user=self.config['LDAP_ADMIN_USER'], password=self.config['LDAP_ADMIN_PASSWORD'])
-
-        # check if user already exists
-        ret = c.search(self.config['LDAP_USER_BASE'], f'(uid={username})')
-        if ret:
-            raise Exception(f'User {username} already exists')
-
-        # perform the Add operation
-        objectClasses = ['inetOrgPerson', 'organizationalPerson', 'person', 'top']
-        attrs = {
-            'cn': f'{firstName} {lastName}',
-            'sn': lastName,
-            'givenName': firstName,
-            'mail': email,
-            'uid': username,
-        }
-        ret = c.add(f'uid={username},{self.config["LDAP_USER_BASE"]}', objectClasses, attrs)
-        if not ret:
-            raise Exception(f'Create user {username} failed: {c.result["message"]}')
-
-        # close the connection
-        c.unbind()
+        with self._connect(admin=True) as c:
+            # check if user already exists
+            ret = c.search(self.config['LDAP_USER_BASE'], f'(uid={username})')
+            if ret:
+                raise Exception(f'User {username} already exists')
+
+            # perform the Add operation
+            objectClasses = ['inetOrgPerson', 'organizationalPerson', 'person', 'top']
+            attrs = {
+                'cn': f'{firstName} {lastName}',
+                'sn': lastName,
+                'givenName': firstName,
+                'mail': email,
+                'uid': username,
+            }
+            ret = c.add(f'uid={username},{self.config["LDAP_USER_BASE"]}', objectClasses, attrs)
+            if not ret:
+                raise Exception(f'Create user {username} failed: {c.result["message"]}')
 
     def modify_user(self, username, attributes=None, objectClass=None, removeObjectClass=None):
         """
@@ -335,91 +481,80 @@ class LDAP:
         if not attributes:
             attributes = {}
 
-        c = self._connect(user=self.config['LDAP_ADMIN_USER'], password=self.config['LDAP_ADMIN_PASSWORD'])
-
-        # check if user exists
-        ret = c.search(self.config['LDAP_USER_BASE'], f'(uid={username})', attributes=ALL_ATTRIBUTES)
-        if not ret:
-            raise Exception(f'User {username} does not exist')
-        ret = c.entries[0]
-
-        vals = {}
-        for a in attributes:
-            v = attributes[a] if isinstance(attributes[a], list) else [attributes[a]]
-            if attributes[a] is None:
-                if a in ret:
-                    vals[a] = [(MODIFY_DELETE, [])]
+        with self._connect(admin=True) as c:
+            # check if user exists
+            ret = c.search(self.config['LDAP_USER_BASE'], f'(uid={username})', attributes=ALL_ATTRIBUTES)
+            if not ret:
+                raise Exception(f'User {username} does not exist')
+            ret = c.entries[0]
+
+            vals = {}
+            for a in attributes:
+                v = attributes[a] if isinstance(attributes[a], list) else [attributes[a]]
+                if attributes[a] is None:
+                    if a in ret:
+                        vals[a] = [(MODIFY_DELETE, [])]
+                    else:
+                        continue  # trying to delete an attr that doesn't exist
+                elif a in ret:
+                    vals[a] = [(MODIFY_REPLACE, v)]
                 else:
-                    continue  # trying to delete an attr that doesn't exist
-            elif a in ret:
-                vals[a] = [(MODIFY_REPLACE, v)]
+                    vals[a] = [(MODIFY_ADD, v)]
+
+            if objectClass and removeObjectClass:
+                raise Exception('cannot add and remove object classes at once')
+            elif objectClass and objectClass not in ret['objectClass']:
+                vals['objectClass'] = [(MODIFY_ADD, [objectClass])]
+            elif removeObjectClass and removeObjectClass in ret['objectClass']:
+                vals['objectClass'] = [(MODIFY_DELETE, [removeObjectClass])]
+
+            # perform the operation
+            logger.debug(f'ldap change for user {username}: {vals}')
+            try:
+                ret = c.modify(f'uid={username},{self.config["LDAP_USER_BASE"]}', vals)
+            except Exception:
+                logger.debug('ldap exception', exc_info=True)
+                raise Exception(f'Modify user {username} failed')
             else:
-                vals[a] = [(MODIFY_ADD, v)]
+                if not ret:
+                    raise Exception(f'Modify user {username} failed: {c.result["message"]}')
 
-        if objectClass and removeObjectClass:
-            raise Exception('cannot add and remove object classes at once')
-        elif objectClass and objectClass not in ret['objectClass']:
-            vals['objectClass'] = [(MODIFY_ADD, [objectClass])]
-        elif removeObjectClass and removeObjectClass in ret['objectClass']:
-            vals['objectClass'] = [(MODIFY_DELETE, [removeObjectClass])]
+    def iter_groups(self, groupbase=None, attrs=None, search_filter=None, page_size=100):
+        """
+        Iterate over group information in LDAP.
 
-        # perform the operation
-        logger.debug(f'ldap change for user {username}: {vals}')
-        try:
-            ret = c.modify(f'uid={username},{self.config["LDAP_USER_BASE"]}', vals)
-        except Exception:
-            logger.debug('ldap exception', exc_info=True)
-            raise Exception(f'Modify user {username} failed')
-        else:
-            if not ret:
-                raise Exception(f'Modify user {username} failed: {c.result["message"]}')
+        Same as `list_groups()`, but yields one page of groups at a time,
+        so the whole directory is never in memory at once. A pooled
+        connection is held until the iteration finishes.
 
-        # close the connection
-        c.unbind()
+        Args:
+            groupbase (str): (optional) base (OU) of group
+            attrs (list): attributes from each group to return (default: ALL)
+            search_filter (str): (optional) extra LDAP filter, e.g. "(gidNumber=*)"
+            page_size (int): number of groups per page
+
+        Yields:
+            tuple: (groupname, attr dict)
+        """
+        if not groupbase:
+            groupbase = self.config['LDAP_GROUP_BASE']
+        search_filter = f'(&(cn=*){search_filter})' if search_filter else '(cn=*)'
+        with self._connect() as c:
+            yield from self._paged_search(c, groupbase, search_filter, 'cn', attrs=attrs, page_size=page_size)
 
-    def list_groups(self, groupbase=None, attrs=None):
+    def list_groups(self, groupbase=None, attrs=None, search_filter=None):
         """
         List group information in LDAP.
 
         Args:
             groupbase (str): (optional) base (OU) of group
             attrs (list): attributes from each group to return (default: ALL)
+            search_filter (str): (optional) extra LDAP filter, e.g. "(gidNumber=*)"
 
         Returns:
             dict: groupname: attr dict
         """
-        if not groupbase:
-            groupbase = self.config['LDAP_GROUP_BASE']
-
-        c = self._connect()
-
-        # paged search for the group
-        c.search(groupbase, '(cn=*)', attributes=ALL_ATTRIBUTES, paged_size=100)
-        if c.result['result']:
-            logger.debug(f'search result {c.result}')
-            raise Exception(f'Search groups failed: {c.result["description"]}')
-        cookie = c.result['controls']['1.2.840.113556.1.4.319']['value']['cookie']
-
-        def process():
-            for entry in c.entries:
-                entry = entry.entry_attributes_as_dict
-                if attrs:
-                    val = {k: (entry[k][0] if len(entry[k]) == 1 else entry[k]) for k in entry if k in attrs}
-                else:
-                    val = {k: (entry[k][0] if len(entry[k]) == 1 else entry[k]) for k in entry}
-                ret[entry['cn'][0]] = val
-
-        ret = {}
-        process()
-        while cookie:
-            c.search(groupbase, '(cn=*)', attributes=ALL_ATTRIBUTES, paged_size=100, paged_cookie=cookie)
-            if c.result['result']:
-                logger.debug(f'search result {c.result}')
-                raise Exception(f'Search groups failed: {c.result["description"]}')
-            cookie = c.result['controls']['1.2.840.113556.1.4.319']['value']['cookie']
-            process()
-
-        return ret
+        return dict(self.iter_groups(groupbase=groupbase, attrs=attrs, search_filter=search_filter))
 
     def get_group(self, groupname, groupbase=None):
         """
@@ -438,14 +573,13 @@ class LDAP:
         if not groupbase:
             groupbase = self.config['LDAP_GROUP_BASE']
 
-        c = self._connect()
-
-        # search for the group
-        ret = c.search(groupbase, f'(cn={groupname})', attributes=ALL_ATTRIBUTES)
-        if not ret:
-            raise KeyError(f'Group {groupname} not found')
-        entry = c.entries[0].entry_attributes_as_dict
-        return {k: (entry[k][0] if len(entry[k]) == 1 else entry[k]) for k in entry}
+        with self._connect() as c:
+            # search for the group
+            ret = c.search(groupbase, f'(cn={groupname})', attributes=ALL_ATTRIBUTES)
+            if not ret:
+                raise KeyError(f'Group {groupname} not found')
+            entry = c.entries[0].entry_attributes_as_dict
+            return {k: (entry[k][0] if len(entry[k]) == 1 else entry[k]) for k in entry}
 
     def create_group(self, groupname, groupbase=None, gidNumber=None):
         """
@@ -459,75 +593,124 @@ class LDAP:
         if not groupbase:
             groupbase = self.config['LDAP_GROUP_BASE']
 
-        c = self._connect(user=self.config['LDAP_ADMIN_USER'], password=self.config['LDAP_ADMIN_PASSWORD'])
-
-        # check if group already exists
-        ret = c.search(groupbase, f'(cn={groupname})')
-        if ret:
-            raise Exception(f'Group {groupname} already exists')
+        with self._connect(admin=True) as c:
+            # check if group already exists
+            ret = c.search(groupbase, f'(cn={groupname})')
+            if ret:
+                raise Exception(f'Group {groupname} already exists')
 
-        # perform the Add operation
-        objectClasses = ['posixGroup' if gidNumber else 'groupOfNames', 'top']
-        attrs = {
-            'cn': groupname,
-        }
-        if gidNumber:
-            attrs['gidNumber'] = gidNumber
-        else:
-            attrs['member'] = 'cn=empty-membership-placeholder'
-        ret = c.add(f'cn={groupname},{groupbase}', objectClasses, attrs)
-        if not ret:
-            raise Exception(f'Create group {groupname} failed: {c.result["message"]}')
-
-        # close the connection
-        c.unbind()
+            # perform the Add operation
+            objectClasses = ['posixGroup' if gidNumber else 'groupOfNames', 'top']
+            attrs = {
+                'cn': groupname,
+            }
+            if gidNumber:
+                attrs['gidNumber'] = gidNumber
+            else:
+                attrs['member'] = 'cn=empty-membership-placeholder'
+            ret = c.add(f'cn={groupname},{groupbase}', objectClasses, attrs)
+            if not ret:
+                raise Exception(f'Create group {groupname} failed: {c.result["message"]}')
 
-    def add_user_group(self, username, groupname, groupbase=None):
+    def set_group_members(self, groupname, add=None, remove=None, groupbase=None, chunk_size=500):
         """
-        Add a user to a group in LDAP.
+        Add and remove many members of a group in LDAP at once.
+
+        Members are changed with one modify request per `chunk_size`
+        members, instead of one per member. If a chunk fails, its members
+        are retried one by one, so that one bad member doesn't fail the rest.
 
         Args:
-            username (str): name of user
             groupname (str): name of group
+            add (iterable): usernames to add
+            remove (iterable): usernames to remove
             groupbase (str): (optional) base (OU) of group
+            chunk_size (int): max number of members changed per request
+
+        Returns:
+            dict: username: one of "added", "removed", "unchanged", "failed"
         """
         if not groupbase:
             groupbase = self.config['LDAP_GROUP_BASE']
+        add = list(dict.fromkeys(add or []))
+        remove = list(dict.fromkeys(remove or []))
+        if set(add) & set(remove):
+            raise Exception('cannot add and remove the same members at once')
+
+        with self._connect(admin=True) as c:
+            # check if group exists
+            ret = c.search(groupbase, f'(cn={groupname})', attributes=['gidNumber', 'member', 'memberUid'])
+            if not ret:
+                raise Exception(f'Group {groupname} does not exist')
+            ret = c.entries[0].entry_attributes_as_dict
 
-        c = self._connect(user=self.config['LDAP_ADMIN_USER'], password=self.config['LDAP_ADMIN_PASSWORD'])
+            if ret.get('gidNumber'):  # posix group
+                attr = 'memberUid'
+                values = {username: username for username in add + remove}
+            else:
+                attr = 'member'
+                values = {username: f'uid={username},{self.config["LDAP_USER_BASE"]}' for username in add + remove}
+            current = set(ret.get(attr, []))
+
+            results = {}
+            to_add = []
+            for username in add:
+                if values[username] in current:
+                    results[username] = 'unchanged'
+                else:
+                    to_add.append(username)
+            to_remove = []
+            for username in remove:
+                if values[username] in current:
+                    to_remove.append(username)
+                else:
+                    results[username] = 'unchanged'
+
+            dn = f'cn={groupname},{groupbase}'
+            if attr == 'member' and 'cn=empty-membership-placeholder' not in current:
+                remaining = current - {values[u] for u in to_remove}
+                if not remaining and not to_add:
+                    # groupOfNames must have at least one member
+                    c.modify(dn, {attr: [(MODIFY_ADD, ['cn=empty-membership-placeholder'])]})
+
+            def modify(op, usernames, result):
+                logger.debug(f'ldap change for group {groupname}: {op} {usernames}')
+                try:
+                    ok = c.modify(dn, {attr: [(op, [values[u] for u in usernames])]})
+                except LDAPCommunicationError:
+                    raise
+                except Exception:
+                    logger.debug('ldap exception', exc_info=True)
+                    ok = False
+                if ok:
+                    results.update((u, result) for u in usernames)
+                elif len(usernames) > 1:
+                    logger.info(f'modify of group {groupname} failed, retrying members one by one')
+                    for u in usernames:
+                        modify(op, [u], result)
+                else:
+                    logger.warning(f'{op} of {usernames[0]} for group {groupname} failed: {c.result["message"]}')
+                    results[usernames[0]] = 'failed'
 
-        # check if group exists
-        ret = c.search(groupbase, f'(cn={groupname})', attributes=ALL_ATTRIBUTES)
-        if not ret:
-            raise Exception(f'Group {groupname} does not exist')
-        ret = c.entries[0].entry_attributes_as_dict
+            for i in range(0, len(to_add), chunk_size):
+                modify(MODIFY_ADD, to_add[i:i+chunk_size], 'added')
+            for i in range(0, len(to_remove), chunk_size):
+                modify(MODIFY_DELETE, to_remove[i:i+chunk_size], 'removed')
 
-        vals = {}
-        if 'gidNumber' in ret:  # posix group
-            if 'memberUid' in ret and username in ret['memberUid']:
-                return
-            else:
-                vals['memberUid'] = [(MODIFY_ADD), [username]]
-        else:
-            user_cn = f'uid={username},{self.config["LDAP_USER_BASE"]}'
-            if 'member' in ret and user_cn in ret['member']:
-                return
-            else:
-                vals['member'] = [(MODIFY_ADD), [user_cn]]
+        return results
 
-        # perform the operation
-        logger.debug(f'ldap change for group {groupname}: {vals}')
-        try:
-            ret = c.modify(f'cn={groupname},{groupbase}', vals)
-            if c.result['result']:
-                logger.debug(f'modify ldap error: {c.result["message"]}')
-                raise Exception(f'Add user {username} to group {username} failed')
-        except Exception:
-            logger.debug('ldap exception', exc_info=True)
-            raise Exception(f'Add user {username} to group {username} failed')
+    def add_user_group(self, username, groupname, groupbase=None):
+        """
+        Add a user to a group in LDAP.
 
-        # close the connection
-        c.unbind()
+        Args:
+            username (str): name of user
+            groupname (str): name of group
+            groupbase (str): (optional) base (OU) of group
+        """
+        ret = self.set_group_members(groupname, add=[username], groupbase=groupbase)
+        if ret[username] == 'failed':
+            raise Exception(f'Add user {username} to group {groupname} failed')
 
     def remove_user_group(self, username, groupname, groupbase=None):
         """
@@ -538,41 +721,75 @@ class LDAP:
             groupname (str): name of group
             groupbase (str): (optional) base (OU) of group
         """
-        if not groupbase:
-            groupbase = self.config['LDAP_GROUP_BASE']
+        ret = self.set_group_members(groupname, remove=[username], groupbase=groupbase)
+        if ret[username] == 'unchanged':
+            logger.info('user not in group')
+        elif ret[username] == 'failed':
+            raise Exception(f'Remove user {username} from group {groupname} failed')
 
-        c = self._connect(user=self.config['LDAP_ADMIN_USER'], password=self.config['LDAP_ADMIN_PASSWORD'])
 
-        # check if group exists
-        ret = c.search(groupbase, f'(cn={groupname})', attributes=ALL_ATTRIBUTES)
-        if not ret:
-            raise Exception(f'Group {groupname} does not exist')
-        ret = c.entries[0].entry_attributes_as_dict
+class AsyncLDAP:
+    """
+    Asyncio facade for `LDAP`.
 
-        vals = {}
-        if 'gidNumber' in ret:  # posix group
-            if 'memberUid' in ret and username in ret['memberUid']:
-                vals['memberUid'] = [(MODIFY_DELETE), [username]]
-            else:
-                return
-        else:
-            user_cn = f'uid={username},{self.config["LDAP_USER_BASE"]}'
-            if 'member' in ret and user_cn in ret['member']:
-                vals['member'] = [(MODIFY_DELETE), user_cn]
-            else:
-                logger.info('user not in group')
-                return
+    Has the same methods as `LDAP`, as coroutines. Each call runs in a
+    bounded thread pool, so that slow searches don't block the event loop,
+    and LDAP and Keycloak requests can overlap. The generator methods
+    (`iter_users()`, `iter_groups()`) are not wrapped; use the `list_*`
+    methods instead.
 
-        # perform the operation
-        logger.debug(f'ldap change for group {groupname}: {vals}')
-        try:
-            ret = c.modify(f'cn={groupname},{groupbase}', vals)
-        except Exception:
-            logger.debug('ldap exception', exc_info=True)
-            raise Exception(f'Remove user {username} from group {username} failed')
+    Args:
+        ldap_client (LDAP): (optional) client to wrap (default: a new one)
+        max_workers (int): max number of concurrent LDAP calls
+    """
+    def __init__(self, ldap_client=None, max_workers=4):
+        self.ldap_client = ldap_client if ldap_client else LDAP(pool_size=max_workers)
+        self.executor = ThreadPoolExecutor(max_workers, thread_name_prefix='krs.ldap')
+
+    @classmethod
+    def wrap(cls, ldap_client):
+        """
+        Get an async facade for a client, reusing it for later calls.
+
+        The facade's thread pool is shut down by the client's `close()`.
 
-        # close the connection
-        c.unbind()
+        Args:
+            ldap_client (LDAP|AsyncLDAP): client
+
+        Returns:
+            AsyncLDAP: async client
+        """
+        if isinstance(ldap_client, cls):
+            return ldap_client
+        facade = ldap_client.__dict__.get('_async_facade')
+        if facade is None:
+            facade = ldap_client.__dict__['_async_facade'] = cls(ldap_client)
+        return facade
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        self.close()
+
+    def close(self):
+        """Shut down the thread pool and close pooled connections."""
+        self.executor.shutdown(wait=True)
+        self.ldap_client.close()
+
+    def __getattr__(self, name):
+        attr = getattr(self.ldap_client, name)
+        if name.startswith('_') or not callable(attr) or asyncio.iscoroutinefunction(attr):
+            return attr
+        if inspect.isgeneratorfunction(attr):
+            raise AttributeError(f'generator method {name} is not available in AsyncLDAP')
+
+        async def wrapper(*args, **kwargs):
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, partial(attr, *args, **kwargs))
+        wrapper.__name__ = name
+        wrapper.__doc__ = attr.__doc__
+        return wrapper
 
 
 def get_ldap_members(group):
@@ -0,0 +1,324 @@
+"""
+Event-driven in-memory mirror of Keycloak realm state.
+
+A long-running `RealmMirror` downloads all users, groups and group
+memberships once, then keeps them up to date by applying the Keycloak
+admin events received through RabbitMQ (`KK.EVENT.ADMIN.#`). Listeners
+can subscribe to the mirror to be called after each event has been
+applied, and read the current realm state from it instead of listing
+everything from Keycloak again.
+
+Only events of successful admin operations are applied. Subscribers can
+coalesce bursts of events with `dedup`, like `RabbitMQListener` does.
+
+Events can be lost (e.g. while disconnected from RabbitMQ), so the mirror
+also does a periodic full resync to repair any drift. Lag between an event
+happening in Keycloak and being applied locally is tracked in `metrics`.
+
+Example::
+
+    python -m krs.mirror --log-level debug
+"""
+import asyncio
+import logging
+import time
+
+from .groups import GroupIndex, get_memberships
+from .rabbitmq import Debouncer, RabbitMQListener
+from .token import get_rest_client
+from .users import iter_users
+from .util import fix_singleton_attributes
+
+logger = logging.getLogger('krs.mirror')
+
+
+class RealmMirror:
+    """
+    In-memory mirror of users, groups and memberships of a Keycloak realm.
+
+    Args:
+        rest_client (RestClient): Keycloak REST client
+        resync_interval (float): seconds between full resyncs (None to disable)
+        address (str): RabbitMQ server address
+        exchange (str): RabbitMQ exchange topic
+        concurrency (int): max number of concurrent requests during a resync
+    """
+    def __init__(self, rest_client, resync_interval=3600, address=None, exchange=None, concurrency=8):
+        self.rest_client = rest_client
+        self.resync_interval = resync_interval
+        self.concurrency = concurrency
+
+        self.users = {}               # user id: user info
+        self.usernames = {}           # username: user id
+        self.groups = GroupIndex({})
+        self.members = {}             # group id: set of usernames
+
+        self.metrics = {
+            'events': 0,
+            'events_ignored': 0,
+            'event_errors': 0,
+            'last_event_lag': None,
+            'max_event_lag': 0.,
+            'resyncs': 0,
+            'last_resync': None,
+            'last_resync_duration': None,
+        }
+
+        self.subscribers = []
+        self._resync_lock = asyncio.Lock()
+        self._resync_task = None
+        self.listener = RabbitMQListener(self.handle_event, address=address, exchange=exchange,
+                                         routing_key='KK.EVENT.ADMIN.#.SUCCESS.#')
+
+    def subscribe(self, action, resource_types=None, dedup=None, dedup_key=None, dedup_max_delay=None):
+        """
+        Call `action` with each event body, after it has been applied.
+
+        Without `dedup`, events wait for `action` to finish. With `dedup`,
+        `action` runs in the background, once per burst of events with the
+        same key (see `Debouncer`).
+
+        Args:
+            action (callable): async message processing function
+            resource_types (iterable): (optional) only these resource types (USER, GROUP, ...)
+            dedup (float): (optional) coalesce events received less than this many seconds apart
+            dedup_key (callable): event body -> key to coalesce on (default: one key for all),
+                                  or None to skip the event
+            dedup_max_delay (float): max seconds to delay an event (default: 10 * dedup)
+        """
+        if dedup:
+            action = Debouncer(action, dedup, key=dedup_key, max_delay=dedup_max_delay)
+        self.subscribers.append((action, set(resource_types) if resource_types else None))
+
+    async def start(self):
+        """Do the initial sync, then start listening for events."""
+        await self.listener.start()
+        await self.resync()
+        if self.resync_interval:
+            self._resync_task = asyncio.create_task(self._periodic_resync())
+
+    async def stop(self):
+        if self._resync_task:
+            self._resync_task.cancel()
+            self._resync_task = None
+        await self.listener.stop()
+        for action, _ in self.subscribers:
+            if isinstance(action, Debouncer):
+                await action.drain()
+
+    async def _periodic_resync(self):
+        while True:
+            await asyncio.sleep(self.resync_interval)
+            try:
+                await self.resync()
+            except Exception:
+                logger.warning('periodic resync failed', exc_info=True)
+
+    async def resync(self):
+        """
+        Reload all users, groups and memberships from Keycloak.
+
+        Events received while reloading wait and are applied afterwards,
+        in order, so that changes made during the reload are not lost.
+        """
+        async with self._resync_lock:
+            start = time.time()
+            users = {}
+            async for u in iter_users(rest_client=self.rest_client, concurrency=self.concurrency):
+                users[u['id']] = u
+            groups = await GroupIndex.load(rest_client=self.rest_client)
+            group_members, _ = await get_memberships(groups.keys(), concurrency=self.concurrency,
+                                                     rest_client=self.rest_client, group_index=groups)
+
+            drift = self._count_drift(users, groups, group_members)
+            self.users = users
+            self.usernames = {u['username']: uid for uid, u in users.items()}
+            self.groups = groups
+            self.members = {groups.get_id(path): set(members) for path, members in group_members.items()}
+
+            self.metrics['resyncs'] += 1
+            self.metrics['last_resync'] = time.time()
+            self.metrics['last_resync_duration'] = self.metrics['last_resync'] - start
+            logger.info(f'resync took {self.metrics["last_resync_duration"]:.1f}s, '
+                        f'{drift} differences repaired')
+
+    def _count_drift(self, users, groups, group_members):
+        if not self.metrics['resyncs']:
+            return 0
+        drift = len(users.keys() ^ self.users.keys())
+        drift += len(groups.ids.keys() ^ self.groups.ids.keys())
+        for path, members in group_members.items():
+            drift += len(set(members) ^ self.members.get(groups.get_id(path), set()))
+        return drift
+
+    async def handle_event(self, body):
+        """
+        Apply a Keycloak admin event, then pass it to subscribers.
+
+        Args:
+            body (dict): decoded message body from `RabbitMQListener`
+        """
+        if body.get('error'):
+            # failed admin operations didn't change anything
+            self.metrics['events_ignored'] += 1
+            return
+
+        if 'time' in body:
+            lag = time.time() - body['time'] / 1000.
+            self.metrics['last_event_lag'] = lag
+            self.metrics['max_event_lag'] = max(self.metrics['max_event_lag'], lag)
+
+        async with self._resync_lock:
+            try:
+                await self._apply(body)
+                resync = False
+            except Exception:
+                self.metrics['event_errors'] += 1
+                logger.warning('error applying event, resyncing', exc_info=True)
+                resync = True
+        if resync:
+            await self.resync()
+
+        for action, resource_types in self.subscribers:
+            if resource_types is None or body.get('resourceType') in resource_types:
+                await action(body)
+
+    async def _apply(self, body):
+        resource_type = body.get('resourceType')
+        operation = body.get('operationType')
+        parts = body.get('resourcePath', '').split('/')
+        rep = body.get('representation')
+        if not isinstance(rep, dict):
+            rep = {}
+
+        if resource_type == 'USER' and len(parts) == 2 and parts[0] == 'users':
+            self._apply_user(operation, parts[1], rep)
+        elif resource_type == 'GROUP':
+            # hierarchy changes are rare, and events don't carry enough
+            # information to place new or moved groups, so just reload it
+            await self.groups.refresh(rest_client=self.rest_client)
+            for group_id in list(self.members):
+                if group_id not in self.groups.ids:
+                    del self.members[group_id]
+        elif resource_type == 'GROUP_MEMBERSHIP' and len(parts) == 4 and parts[0] == 'users':
+            await self._apply_membership(operation, parts[1], parts[3])
+        else:
+            self.metrics['events_ignored'] += 1
+            return
+        self.metrics['events'] += 1
+
+    def _apply_user(self, operation, user_id, rep):
+        old = self.users.get(user_id)
+        if operation == 'DELETE':
+            if old:
+                del self.users[user_id]
+                self.usernames.pop(old['username'], None)
+                for members in self.members.values():
+                    members.discard(old['username'])
+            return
+
+        user = dict(old) if old else {}
+        user.update(rep)
+        user['id'] = user_id
+        if 'attributes' in user:
+            user['attributes'] = dict(user['attributes'])
+            fix_singleton_attributes(user)
+        self.users[user_id] = user
+        if old and old['username'] != user['username']:
+            self.usernames.pop(old['username'], None)
+            for members in self.members.values():
+                if old['username'] in members:
+                    members.discard(old['username'])
+                    members.add(user['username'])
+        self.usernames[user['username']] = user_id
+
+    async def _apply_membership(self, operation, user_id, group_id):
+        if user_id not in self.users:
+            user = await self.rest_client.request('GET', f'/users/{user_id}')
+            fix_singleton_attributes(user)
+            self.users[user_id] = user
+            self.usernames[self.users[user_id]['username']] = user_id
+        if group_id not in self.groups.ids:
+            await self.groups.refresh(rest_client=self.rest_client)
+        username = self.users[user_id]['username']
+        members = self.members.setdefault(group_id, set())
+        if operation == 'CREATE':
+            members.add(username)
+        elif operation == 'DELETE':
+            members.discard(username)
+
+    def list_users(self):
+        """
+        List all users.
+
+        Returns:
+            dict: username: user info
+        """
+        return {u['username']: u for u in self.users.values()}
+
+    def user_info(self, username):
+        """
+        Get user information.
+
+        Args:
+            username (str): username
+
+        Returns:
+            dict: user info
+        """
+        return self.users[self.usernames[username]]
+
+    def get_group_membership_by_id(self, group_id):
+        """
+        Get the membership list of a group.
+
+        Args:
+            group_id (str): group id
+
+        Returns:
+            list: usernames
+        """
+        self.groups.get_path(group_id)  # raises GroupDoesNotExist
+        return sorted(self.members.get(group_id, ()))
+
+    def get_group_membership(self, group_path):
+        """
+        Get the membership list of a group.
+
+        Args:
+            group_path (str): group path (/parent/parent/name)
+
+        Returns:
+            list: usernames
+        """
+        return self.get_group_membership_by_id(self.groups.get_id(group_path))
+
+
+def main():
+    import argparse
+    from pprint import pformat
+
+    parser = argparse.ArgumentParser(description='Mirror Keycloak realm state from admin events')
+    parser.add_argument('--listen-address', help='RabbitMQ address, including user/pass')
+    parser.add_argument('--listen-exchange', help='RabbitMQ exchange name')
+    parser.add_argument('--resync-interval', type=float, default=3600, help='seconds between full resyncs')
+    parser.add_argument('--metrics-interval', type=float, default=60, help='seconds between metrics logging')
+    parser.add_argument('--log-level', default='info', choices=('debug', 'info', 'warning', 'error'), help='logging level')
+    args = vars(parser.parse_args())
+
+    logging.basicConfig(level=getattr(logging, args['log_level'].upper()))
+
+    mirror = RealmMirror(get_rest_client(), resync_interval=args['resync_interval'],
+                         address=args['listen_address'], exchange=args['listen_exchange'])
+
+    async def run():
+        await mirror.start()
+        while True:
+            await asyncio.sleep(args['metrics_interval'])
+            logger.info(f'metrics: {pformat(mirror.metrics)}')
+
+    asyncio.run(run())
+
+
+if __name__ == '__main__':
+    main()
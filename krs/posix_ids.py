@@ -0,0 +1,130 @@
+"""
+POSIX uid/gid number allocation.
+
+New POSIX accounts get the same number as uid and gid, one higher than
+any uid or gid number already used in LDAP. Scanning the directory for
+the highest number on every allocation is slow, and two processes doing
+it at once can hand out the same number.
+
+`PosixIdAllocator` scans once, keeps the used numbers in a sorted list,
+and hands out numbers above the highest one used (gaps are not reused).
+Allocation with a counter does blocking LDAP I/O, so async code should
+run `allocate()` in a thread. To be safe across processes, set
+LDAP_POSIX_ID_COUNTER to the DN of a counter entry (a `posixGroup` outside
+the group base, whose `gidNumber` is the next free number). Allocations
+then reserve the number in the counter with an atomic compare-and-swap
+(one modify that deletes the old value and adds the new one), retrying
+if another process got there first. The counter entry is created if
+missing.
+"""
+import bisect
+import logging
+import threading
+
+from ldap3 import BASE, MODIFY_ADD, MODIFY_DELETE
+from wipac_dev_tools import from_environment
+
+logger = logging.getLogger('krs.posix_ids')
+
+
+class PosixIdAllocator:
+    """
+    Allocator of unused POSIX uid/gid numbers.
+
+    Args:
+        ldap_client (LDAP): LDAP client
+        counter_dn (str): (optional) DN of the LDAP counter entry
+                          (default: env LDAP_POSIX_ID_COUNTER, or disabled)
+        min_id (int): lowest number to hand out
+        retries (int): max number of compare-and-swap attempts
+    """
+    def __init__(self, ldap_client, counter_dn=None, min_id=1, retries=10):
+        config = from_environment({
+            'LDAP_POSIX_ID_COUNTER': '',
+        })
+        self.ldap_client = ldap_client
+        self.counter_dn = counter_dn if counter_dn else config['LDAP_POSIX_ID_COUNTER']
+        self.min_id = min_id
+        self.retries = retries
+        self.used = []  # sorted
+        self.lock = threading.Lock()
+
+    def load(self, users=None, groups=None):
+        """
+        Index the uid/gid numbers used in LDAP.
+
+        Args:
+            users (dict): (optional) output of `LDAP.list_users()` with
+                          uidNumber and gidNumber (default: search LDAP)
+            groups (dict): (optional) output of `LDAP.list_groups()` with
+                           gidNumber (default: search LDAP)
+        """
+        if users is None:
+            users = self.ldap_client.list_users(['uidNumber', 'gidNumber'],
+                                                search_filter='(|(uidNumber=*)(gidNumber=*))')
+        if groups is None:
+            groups = self.ldap_client.list_groups(attrs=['gidNumber'], search_filter='(gidNumber=*)')
+        used = set()
+        for entry in list(users.values()) + list(groups.values()):
+            for attr in ('uidNumber', 'gidNumber'):
+                if attr in entry:
+                    used.add(int(entry[attr]))
+        with self.lock:
+            self.used = sorted(used)
+        logger.debug(f'indexed {len(used)} used ids, max {self.max_id}')
+
+    @property
+    def max_id(self):
+        return self.used[-1] if self.used else self.min_id - 1
+
+    def is_used(self, posix_id):
+        i = bisect.bisect_left(self.used, posix_id)
+        return i < len(self.used) and self.used[i] == posix_id
+
+    def add_used(self, posix_id):
+        """Mark a number as used."""
+        with self.lock:
+            if not self.is_used(posix_id):
+                bisect.insort(self.used, posix_id)
+
+    def _next_free(self, start):
+        return max(start, self.max_id + 1, self.min_id)
+
+    def allocate(self, dryrun=False):
+        """
+        Allocate a number, unused as both uid and gid.
+
+        Args:
+            dryrun (bool): don't reserve the number in the LDAP counter
+
+        Returns:
+            int: uid/gid number
+        """
+        with self.lock:
+            if not self.counter_dn or dryrun:
+                posix_id = self._next_free(self.min_id)
+            else:
+                posix_id = self._reserve()
+            bisect.insort(self.used, posix_id)
+        return posix_id
+
+    def _reserve(self):
+        with self.ldap_client._connect(admin=True) as c:
+            for _ in range(self.retries):
+                if c.search(self.counter_dn, '(objectClass=*)', search_scope=BASE, attributes=['gidNumber']):
+                    counter = int(c.entries[0]['gidNumber'].value)
+                else:
+                    counter = None
+
+                posix_id = self._next_free(counter if counter else self.min_id)
+                if counter is None:
+                    cn = self.counter_dn.split(',', 1)[0].split('=', 1)[-1]
+                    ok = c.add(self.counter_dn, ['posixGroup', 'top'], {'cn': cn, 'gidNumber': posix_id + 1})
+                else:
+                    # atomic: fails if another process changed the counter
+                    ok = c.modify(self.counter_dn, {'gidNumber': [(MODIFY_DELETE, [counter]),
+                                                                  (MODIFY_ADD, [posix_id + 1])]})
+                if ok:
+                    return posix_id
+                logger.info(f'lost race for posix id counter: {c.result["description"]}')
+        raise Exception(f'Could not reserve a posix id in {self.counter_dn}')
@@ -0,0 +1,207 @@
+"""
+Rate and concurrency limits for Keycloak REST calls.
+
+Parallel lookups can easily overload Keycloak, and the LDAP server it
+federates users from. `ThrottledRestClient` wraps a REST client, and makes
+every `request()` first wait for its endpoint class to be under both a
+requests-per-second rate and a max number of requests in flight.
+
+Endpoint classes are:
+
+* users: user lookups (GET /users...)
+* members: member listings (GET /groups/{id}/members, GET .../roles/{name}/users)
+* mutations: anything other than GET
+* other: all other requests
+
+Limits are configured with the KEYCLOAK_THROTTLE environment variable, as
+comma-separated `class=rate:max_in_flight` entries, where 0 means
+unlimited, e.g. `users=20:8,members=10:4,mutations=5:2`. Classes that are
+not listed are unlimited. `krs.token.get_rest_client()` returns a throttled
+client if KEYCLOAK_THROTTLE is set.
+
+The time spent waiting is tracked per class in `stats()`, to help tune
+the limits.
+"""
+import asyncio
+import logging
+import re
+import time
+
+from wipac_dev_tools import from_environment
+
+logger = logging.getLogger('krs.throttle')
+
+ENDPOINT_CLASSES = ('users', 'members', 'mutations', 'other')
+
+MEMBERS_RE = re.compile(r'^/(groups/[^/]+/members|(clients/[^/]+/)?roles/[^/]+/users)\b')
+
+
+def endpoint_class(method, path):
+    """
+    Classify a Keycloak REST request.
+
+    Args:
+        method (str): HTTP method
+        path (str): request path, relative to the realm
+
+    Returns:
+        str: one of ENDPOINT_CLASSES
+    """
+    if method.upper() != 'GET':
+        return 'mutations'
+    if MEMBERS_RE.match(path):
+        return 'members'
+    if path.startswith('/users'):
+        return 'users'
+    return 'other'
+
+
+def parse_limits(spec):
+    """
+    Parse a KEYCLOAK_THROTTLE limits specification.
+
+    Args:
+        spec (str): comma-separated `class=rate:max_in_flight` entries
+
+    Returns:
+        dict: class: (rate, max_in_flight)
+    """
+    limits = {}
+    for entry in spec.split(','):
+        if not entry.strip():
+            continue
+        try:
+            name, value = entry.split('=')
+            rate, max_in_flight = value.split(':')
+            name = name.strip()
+            limits[name] = (float(rate), int(max_in_flight))
+        except ValueError:
+            raise ValueError(f'invalid throttle limit "{entry}", expected class=rate:max_in_flight')
+        if name not in ENDPOINT_CLASSES:
+            raise ValueError(f'unknown endpoint class "{name}", expected one of {ENDPOINT_CLASSES}')
+    return limits
+
+
+class Limiter:
+    """
+    Async rate limit (token bucket) and max in flight limit.
+
+    Args:
+        rate (float): requests per second (0 for unlimited)
+        max_in_flight (int): max number of concurrent requests (0 for unlimited)
+        burst (int): number of requests allowed at once before rate limiting
+    """
+    def __init__(self, rate=0, max_in_flight=0, burst=1):
+        self.rate = rate
+        self.max_in_flight = max_in_flight
+        self.burst = burst
+        self._next = time.monotonic()  # theoretical arrival time of the next request
+        self._semaphores = {}          # event loop: semaphore
+
+        self.requests = 0
+        self.in_flight = 0
+        self.total_wait = 0.
+        self.max_wait = 0.
+
+    def _reserve(self):
+        """Reserve a slot in the rate, and return how long to wait for it."""
+        if not self.rate:
+            return 0.
+        interval = 1. / self.rate
+        now = time.monotonic()
+        start = max(self._next, now)
+        self._next = start + interval
+        return max(0., start - (self.burst - 1) * interval - now)
+
+    def _semaphore(self):
+        # semaphores belong to an event loop, and clients may outlive one
+        loop = asyncio.get_running_loop()
+        if loop not in self._semaphores:
+            self._semaphores = {loop: asyncio.Semaphore(self.max_in_flight)}
+        return self._semaphores[loop]
+
+    async def __aenter__(self):
+        start = time.monotonic()
+        if (delay := self._reserve()):
+            await asyncio.sleep(delay)
+        if self.max_in_flight:
+            await self._semaphore().acquire()
+        wait = time.monotonic() - start
+        self.requests += 1
+        self.in_flight += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+        return self
+
+    async def __aexit__(self, *exc):
+        self.in_flight -= 1
+        if self.max_in_flight:
+            self._semaphore().release()
+
+    def stats(self):
+        return {
+            'rate': self.rate,
+            'max_in_flight': self.max_in_flight,
+            'requests': self.requests,
+            'in_flight': self.in_flight,
+            'total_wait': self.total_wait,
+            'avg_wait': self.total_wait / self.requests if self.requests else 0.,
+            'max_wait': self.max_wait,
+        }
+
+
+class ThrottledRestClient:
+    """
+    REST client wrapper limiting requests per endpoint class.
+
+    Attributes other than `request()` are those of the wrapped client, and
+    setting one (e.g. `address`) sets it on the wrapped client.
+
+    Args:
+        rest_client (RestClient): Keycloak REST client
+        limits (dict): class: (rate, max_in_flight), see ENDPOINT_CLASSES
+    """
+    def __init__(self, rest_client, limits):
+        self.rest_client = rest_client
+        self.limiters = {name: Limiter(*limits.get(name, (0, 0))) for name in ENDPOINT_CLASSES}
+
+    @classmethod
+    def from_environment(cls, rest_client):
+        """
+        Wrap a REST client as configured by the KEYCLOAK_THROTTLE environment variable.
+
+        Args:
+            rest_client (RestClient): Keycloak REST client
+
+        Returns:
+            ThrottledRestClient|RestClient: the wrapped client, or `rest_client` if no limits are set
+        """
+        config = from_environment({
+            'KEYCLOAK_THROTTLE': '',
+        })
+        if not (limits := parse_limits(config['KEYCLOAK_THROTTLE'])):
+            return rest_client
+        logger.debug(f'throttling Keycloak requests: {limits}')
+        return cls(rest_client, limits)
+
+    def __getattr__(self, name):
+        return getattr(self.rest_client, name)
+
+    def __setattr__(self, name, value):
+        if name.startswith('_') or name in ('rest_client', 'limiters'):
+            super().__setattr__(name, value)
+        else:
+            setattr(self.rest_client, name, value)
+
+    async def request(self, method, path, *args, **kwargs):
+        async with self.limiters[endpoint_class(method, path)]:
+            return await self.rest_client.request(method, path, *args, **kwargs)
+
+    def stats(self):
+        """
+        Get request and queue wait time statistics.
+
+        Returns:
+            dict: class: stats
+        """
+        return {name: limiter.stats() for name, limiter in self.limiters.items()}
@@ -1,11 +1,198 @@
 """
 Get an admin token for KeyCloak.
+
+Tokens are cached by a shared `TokenManager`, keyed by Keycloak URL, realm
+and client, and refreshed in the background shortly before they expire,
+so that REST clients don't block on authentication. The cache can also be
+kept on disk, so that consecutive runs of the command line tools don't
+each authenticate from scratch. It is configured with environment variables:
+
+* KEYCLOAK_TOKEN_CACHE_FILE: path of a JSON file to keep tokens in (default: memory only)
+* KEYCLOAK_TOKEN_REFRESH_MARGIN: seconds before expiration to refresh tokens
+
+REST clients keep connections to Keycloak alive in a pool. For many
+concurrent requests, the pool can be enlarged with environment variables
+(or the `get_rest_client()` arguments of the same name):
+
+* KEYCLOAK_POOL_WORKERS: max number of requests executing at once
+* KEYCLOAK_POOL_MAXSIZE: max number of connections per host (default: KEYCLOAK_POOL_WORKERS)
 """
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import hashlib
+import json
 import logging
+import os
+import threading
+import time
 
 import requests
+from requests.adapters import DEFAULT_POOLSIZE, HTTPAdapter
 from wipac_dev_tools import from_environment
-from rest_tools.client import ClientCredentialsAuth, SavedDeviceGrantAuth
+from rest_tools.client import RestClient, SavedDeviceGrantAuth
+
+from .throttle import ThrottledRestClient
+
+logger = logging.getLogger('krs.token')
+
+# tokens are not handed out if they expire sooner than this (seconds)
+MIN_TOKEN_VALIDITY = 10
+
+
+class TokenManager:
+    """
+    Cache of access tokens, with proactive refresh.
+
+    Each token is refreshed in a background thread `refresh_margin` seconds
+    before it expires, if it was used since it was last fetched. Unused
+    tokens are left to expire, and fetched again when next needed.
+
+    Args:
+        filename (str): (optional) JSON file to keep tokens in, shared between processes
+        refresh_margin (float): seconds before expiration to refresh a token
+                                (at most half of the token's remaining lifetime)
+    """
+    def __init__(self, filename=None, refresh_margin=60):
+        self.filename = filename
+        self.refresh_margin = refresh_margin
+        self.tokens = {}    # key: (access token, expiration time)
+        self.fetchers = {}  # key: function returning (access token, expiration time)
+        self.used = set()
+        self.timers = {}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_environment(cls):
+        config = from_environment({
+            'KEYCLOAK_TOKEN_CACHE_FILE': '',
+            'KEYCLOAK_TOKEN_REFRESH_MARGIN': 60,
+        })
+        return cls(config['KEYCLOAK_TOKEN_CACHE_FILE'] or None,
+                   refresh_margin=float(config['KEYCLOAK_TOKEN_REFRESH_MARGIN']))
+
+    def get(self, key, fetch):
+        """
+        Get a valid access token.
+
+        Args:
+            key (str): cache key (URL, realm, client, ...)
+            fetch (callable): function returning a new (access token, expiration time)
+
+        Returns:
+            str: access token
+        """
+        with self.lock:
+            self.fetchers[key] = fetch
+            self.used.add(key)
+            entry = self.tokens.get(key)
+            if entry is None and self.filename:
+                entry = self._load().get(key)
+                if entry is not None and entry[1] > time.time() + MIN_TOKEN_VALIDITY:
+                    self.tokens[key] = entry
+                    self._schedule(key, entry[1])
+            if entry is not None and entry[1] > time.time() + MIN_TOKEN_VALIDITY:
+                return entry[0]
+        return self.refresh(key)
+
+    def refresh(self, key):
+        """
+        Fetch a new token now.
+
+        Args:
+            key (str): cache key
+
+        Returns:
+            str: access token
+        """
+        token, expires = self.fetchers[key]()
+        with self.lock:
+            self.tokens[key] = (token, expires)
+            if self.filename:
+                self._save(key, (token, expires))
+            self._schedule(key, expires)
+        logger.debug(f'token for {key.split("|")[0]} refreshed, expires in {expires - time.time():.0f}s')
+        return token
+
+    def _schedule(self, key, expires):
+        if key in self.timers:
+            self.timers[key].cancel()
+        # short-lived tokens (Keycloak's default is 60s) are refreshed halfway
+        remaining = expires - time.time()
+        delay = max(0, remaining - min(self.refresh_margin, remaining / 2))
+        timer = threading.Timer(delay, self._background_refresh, [key])
+        timer.daemon = True
+        timer.start()
+        self.timers[key] = timer
+
+    def _background_refresh(self, key):
+        with self.lock:
+            self.timers.pop(key, None)
+            if key not in self.used:
+                return
+            self.used.discard(key)
+        try:
+            self.refresh(key)
+        except Exception:
+            logger.warning('background token refresh failed', exc_info=True)
+
+    def _load(self):
+        try:
+            with open(self.filename) as f:
+                return {key: tuple(entry) for key, entry in json.load(f).items()}
+        except (OSError, ValueError):
+            return {}
+
+    def _save(self, key, entry):
+        now = time.time()
+        tokens = {k: v for k, v in self._load().items() if v[1] > now}
+        tokens[key] = entry
+        tmp = f'{self.filename}.{os.getpid()}'
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(tokens, f)
+        os.replace(tmp, self.filename)
+
+    def clear(self):
+        """Forget all tokens, and stop refreshing them."""
+        with self.lock:
+            for timer in self.timers.values():
+                timer.cancel()
+            self.timers.clear()
+            self.tokens.clear()
+            self.used.clear()
+
+
+_token_manager = None
+
+
+def get_token_manager():
+    """Get the token manager shared by this process."""
+    global _token_manager
+    if _token_manager is None:
+        _token_manager = TokenManager.from_environment()
+    return _token_manager
+
+
+def hash_secret(secret):
+    """Short digest of a secret, to tell tokens of different credentials apart."""
+    return hashlib.sha256(secret.encode()).hexdigest()[:16]
+
+
+def request_token(url, data):
+    """
+    Request an access token from a Keycloak token endpoint.
+
+    Args:
+        url (str): token endpoint url
+        data (dict): form arguments (grant type, client, credentials)
+
+    Returns:
+        tuple: (access token, expiration time)
+    """
+    r = requests.post(url, data=data)
+    r.raise_for_status()
+    req = r.json()
+    return req['access_token'], time.time() + req.get('expires_in', 60)
 
 
 def get_token(url, client_id, client_secret, client_realm='master'):
@@ -17,41 +204,84 @@ def get_token(url, client_id, client_secret, client_realm='master'):
     }
     logging.debug(f'get_token()  url: {url}  client_id: {client_id}')
 
-    r = requests.post(url, data=args)
-    r.raise_for_status()
-    req = r.json()
-    return req['access_token']
+    key = f'{url}|{client_id}|{hash_secret(client_secret)}'
+    return get_token_manager().get(key, partial(request_token, url, args))
+
+
+def configure_connection_pool(rest_client, pool_workers=None, pool_maxsize=None):
+    """
+    Resize the connection pool of a REST client.
+
+    Requests are executed by a pool of worker threads, over keep-alive
+    connections. Threads wait for a free connection rather than opening
+    extra ones, so `pool_maxsize` limits the connections per host.
 
+    Args:
+        rest_client (RestClient): REST client
+        pool_workers (int): (optional) max number of requests executing at once
+        pool_maxsize (int): (optional) max number of connections per host (default: `pool_workers`)
+    """
+    session = rest_client.session
+    if pool_workers:
+        old_executor = session.executor
+        session.executor = ThreadPoolExecutor(max_workers=pool_workers)
+        old_executor.shutdown(wait=False)
+    if pool_maxsize := pool_maxsize or pool_workers:
+        for prefix, adapter in list(session.adapters.items()):
+            session.mount(prefix, HTTPAdapter(pool_connections=DEFAULT_POOLSIZE, pool_maxsize=pool_maxsize,
+                                              pool_block=True, max_retries=adapter.max_retries))
 
-def get_rest_client(retries=None, timeout=10):
+
+def get_rest_client(retries=None, timeout=10, throttle=True, pool_workers=None, pool_maxsize=None):
+    """
+    Get a Keycloak admin REST client.
+
+    Args:
+        retries (int): (optional) number of retries
+        timeout (float): request timeout in seconds
+        throttle (bool): apply the KEYCLOAK_THROTTLE limits (see krs/throttle.py)
+        pool_workers (int): (optional) max number of requests executing at once
+        pool_maxsize (int): (optional) max number of connections per host
+
+    Returns:
+        RestClient: REST client
+    """
     config = from_environment({
         'KEYCLOAK_REALM': 'icecube',
         'KEYCLOAK_URL': 'https://keycloak.icecube.wisc.edu',
         'KEYCLOAK_CLIENT_ID': 'rest-access',
         'KEYCLOAK_CLIENT_SECRET': '',
         'KEYCLOAK_CLIENT_REALM': 'master',
+        'KEYCLOAK_POOL_WORKERS': 0,
+        'KEYCLOAK_POOL_MAXSIZE': 0,
     })
     kwargs = {'timeout': timeout}
     if retries is not None:
         kwargs['retries'] = retries
     if config['KEYCLOAK_CLIENT_SECRET']:
-        return ClientCredentialsAuth(
+        rest_client = RestClient(
             address=f'{config["KEYCLOAK_URL"]}/auth/admin/realms/{config["KEYCLOAK_REALM"]}',
-            token_url=f'{config["KEYCLOAK_URL"]}/auth/realms/{config["KEYCLOAK_CLIENT_REALM"]}',
-            client_id=config['KEYCLOAK_CLIENT_ID'],
-            client_secret=config['KEYCLOAK_CLIENT_SECRET'],
+            token=partial(get_token, config['KEYCLOAK_URL'], config['KEYCLOAK_CLIENT_ID'],
+                          config['KEYCLOAK_CLIENT_SECRET'], client_realm=config['KEYCLOAK_CLIENT_REALM']),
+            logger=logging.getLogger('ClientCredentialsAuth'),
             **kwargs
         )
     else:
         if config['KEYCLOAK_CLIENT_ID'] == 'rest-access':
             config['KEYCLOAK_CLIENT_ID'] = 'rest-access-admin'
-        return SavedDeviceGrantAuth(
+        rest_client = SavedDeviceGrantAuth(
             address=f'{config["KEYCLOAK_URL"]}/auth/admin/realms/{config["KEYCLOAK_REALM"]}',
             token_url=f'{config["KEYCLOAK_URL"]}/auth/realms/{config["KEYCLOAK_CLIENT_REALM"]}',
             filename='.keycloak-rest-services-auth',
             client_id=config['KEYCLOAK_CLIENT_ID'],
             **kwargs
         )
+    configure_connection_pool(rest_client,
+                              pool_workers=pool_workers or int(config['KEYCLOAK_POOL_WORKERS']),
+                              pool_maxsize=pool_maxsize or int(config['KEYCLOAK_POOL_MAXSIZE']))
+    if throttle:
+        rest_client = ThrottledRestClient.from_environment(rest_client)
+    return rest_client
 
 
 def main():
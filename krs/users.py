@@ -1,20 +1,38 @@
 """
 User actions against Keycloak.
 
+Exact-username lookups by `user_info()` are cached in memory, including
+lookups of users that don't exist, and invalidated by the writes made
+through this module. Writes always look users up without the cache. The
+cache is configured with environment variables:
+
+* KRS_USER_CACHE_SIZE: max number of cached lookups
+* KRS_USER_CACHE_TTL: seconds before a cached user expires (0 disables caching)
+* KRS_USER_CACHE_NEGATIVE_TTL: seconds before a cached missing user expires
+
+In long-running processes (RabbitMQ listeners), changes made by others
+would be hidden for up to the TTL, so there the cache is opt-in: it is
+disabled unless KRS_USER_CACHE_TTL is set.
+
 This code uses custom keycloak attributes that are documented here:
 https://bookstack.icecube.wisc.edu/ops/books/services/page/custom-keycloak-attributes
 """
 import asyncio
+from collections import OrderedDict
+import copy
 import logging
-from random import randint
+from random import sample
+import time
 # noinspection PyPackageRequirements
 from unidecode import unidecode
 
 # noinspection PyPackageRequirements
 import requests.exceptions
 
+from wipac_dev_tools import from_environment
+
 from .token import get_rest_client
-from .util import fix_singleton_attributes
+from .util import fix_singleton_attributes, paginate
 
 logger = logging.getLogger('krs.users')
 
@@ -23,28 +41,109 @@ class UserDoesNotExist(Exception):
     pass
 
 
-async def list_users(search=None, attr_query=None, rest_client=None):
+class UserLookupCache:
     """
-    List users in Keycloak.
+    LRU cache of exact-username user lookups, with expiration.
 
-    Search and query format and semantics here:
-    https://www.keycloak.org/docs-api/24.0.1/rest-api/index.html
+    Lookups of users that don't exist are cached too, usually for less
+    time, since such users may get created by someone else. Entries are
+    keyed on the REST client address, so one cache can serve several realms.
 
-    The `search` parameter filters by a string contained in username, first or
-    last name, or email. Default search behavior is prefix-based (e.g., foo
-    or foo*). Use *foo* for infix search and "foo" for exact search. As of
-    Keycloak 24, suffix searching is not possible.
-
-    The `query` parameter filters by custom attributes. It should be of the
-    form {'attr_name': 'attr_value', ...}.
+    Args:
+        maxsize (int): max number of cached lookups
+        ttl (float): seconds before a cached user expires (0 disables caching)
+        negative_ttl (float): seconds before a cached missing user expires
+    """
+    def __init__(self, maxsize=10000, ttl=300, negative_ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.entries = OrderedDict()  # (realm, username): (expiration time, user info or None)
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def from_environment(cls, long_running=False):
+        """
+        Create a cache as configured by environment variables.
+
+        Args:
+            long_running (bool): disable caching unless the TTLs are set
+        """
+        config = from_environment({
+            'KRS_USER_CACHE_SIZE': 10000,
+            'KRS_USER_CACHE_TTL': 0 if long_running else 300,
+            'KRS_USER_CACHE_NEGATIVE_TTL': 0 if long_running else 60,
+        })
+        return cls(maxsize=int(config['KRS_USER_CACHE_SIZE']),
+                   ttl=float(config['KRS_USER_CACHE_TTL']),
+                   negative_ttl=float(config['KRS_USER_CACHE_NEGATIVE_TTL']))
+
+    def get(self, realm, username):
+        """
+        Look up a cached user.
+
+        Returns:
+            tuple: (found, user info or None if the user doesn't exist)
+        """
+        key = (realm, username)
+        entry = self.entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            self.entries.pop(key, None)
+            self.misses += 1
+            return False, None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return True, copy.deepcopy(entry[1])
+
+    def put(self, realm, username, user):
+        """Cache a user, or None if the user doesn't exist."""
+        ttl = self.ttl if user is not None else self.negative_ttl
+        if not self.ttl or not ttl:
+            return
+        key = (realm, username)
+        self.entries[key] = (time.monotonic() + ttl, copy.deepcopy(user))
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, realm=None, username=None):
+        """
+        Remove cached lookups.
+
+        Args:
+            realm (str): REST client address of the realm (default: all)
+            username (str): username (default: all)
+        """
+        for key in list(self.entries):
+            if (realm is None or key[0] == realm) and (username is None or key[1] == username):
+                del self.entries[key]
+
+
+_user_cache = None
+
+
+def get_user_cache():
+    """Get the user lookup cache shared by this process."""
+    global _user_cache
+    if _user_cache is None:
+        _user_cache = UserLookupCache.from_environment()
+    return _user_cache
+
+
+def configure_user_cache(long_running=False):
+    """
+    Replace the user lookup cache shared by this process.
 
     Args:
-        search (str|None): username/name/email search (see above)
-        attr_query (dict|None): attribute search (see above)
-        rest_client (RestClient): Keycloak REST client
-    Returns:
-        dict: username: user info
+        long_running (bool): the process is long-running, so the cache is opt-in
     """
+    global _user_cache
+    _user_cache = UserLookupCache.from_environment(long_running=long_running)
+    return _user_cache
+
+
+def _validate_user_query(search, attr_query):
     if search and attr_query:
         # As of KeyCloak 24, the q parameter is ignored if search is specified
         raise ValueError("Parameters search and query are mutually exclusive")
@@ -60,60 +159,269 @@ async def list_users(search=None, attr_query=None, rest_client=None):
                                           f" Either I don't know how to format the query or"
                                           f" Keycloak is known to have trouble with similar queries.")
 
-    inc = 50
+
+async def iter_users(search=None, attr_query=None, rest_client=None, page_size=50, concurrency=4):
+    """
+    Iterate over users in Keycloak.
+
+    Same as `list_users()`, but yields users as pages arrive, so that
+    the caller can start processing before the last page is fetched.
+
+    Args:
+        search (str|None): username/name/email search (see `list_users()`)
+        attr_query (dict|None): attribute search (see `list_users()`)
+        rest_client (RestClient): Keycloak REST client
+        page_size (int): number of users per request
+        concurrency (int): max number of concurrent requests
+    Yields:
+        dict: user info
+    """
+    _validate_user_query(search, attr_query)
+
+    params = []
+    if search:
+        params.append(f'search={search}')
+    if attr_query:
+        # query format here: https://www.keycloak.org/docs-api/24.0.1/rest-api/index.html
+        # double quote everything to be safe
+        params.append("q=" + " ".join(f'"{key}":"{val}"' for key, val in attr_query.items()))
+    query = '&'.join(params)
+
+    num_users = await rest_client.request('GET', '/users/count' + (f'?{query}' if query else ''))
+    url = '/users' + (f'?{query}' if query else '')
+    async for u in paginate(rest_client, url, total=num_users,
+                            page_size=page_size, concurrency=concurrency):
+        fix_singleton_attributes(u)
+        yield u
+
+
+async def list_users(search=None, attr_query=None, rest_client=None, page_size=50, concurrency=4):
+    """
+    List users in Keycloak.
+
+    Search and query format and semantics here:
+    https://www.keycloak.org/docs-api/24.0.1/rest-api/index.html
+
+    The `search` parameter filters by a string contained in username, first or
+    last name, or email. Default search behavior is prefix-based (e.g., foo
+    or foo*). Use *foo* for infix search and "foo" for exact search. As of
+    Keycloak 24, suffix searching is not possible.
+
+    The `query` parameter filters by custom attributes. It should be of the
+    form {'attr_name': 'attr_value', ...}.
+
+    Args:
+        search (str|None): username/name/email search (see above)
+        attr_query (dict|None): attribute search (see above)
+        rest_client (RestClient): Keycloak REST client
+        page_size (int): number of users per request
+        concurrency (int): max number of concurrent requests
+    Returns:
+        dict: username: user info
+    """
     ret = {}
-    num_users = await rest_client.request('GET', '/users/count')
-    for start in range(0, num_users, inc):
-        url = f'/users?&max={min(inc, num_users - start)}&first={start}'
-        if search:
-            url += f'&search={search}'
-        if attr_query:
-            # query format here: https://www.keycloak.org/docs-api/24.0.1/rest-api/index.html
-            # double quote everything to be safe
-            url += "&q=" + " ".join(f'"{key}":"{val}"' for key, val in attr_query.items())
-        data = await rest_client.request('GET', url)
-        for u in data:
-            fix_singleton_attributes(u)
-            ret[u['username']] = u
+    async for u in iter_users(search=search, attr_query=attr_query, rest_client=rest_client,
+                              page_size=page_size, concurrency=concurrency):
+        ret[u['username']] = u
     return ret
 
 
-async def user_info(username, rest_client=None):
+async def user_info(username, rest_client=None, use_cache=True):
     """
     Get user information.
 
     Args:
         username (str): username of user
         rest_client (RestClient): Keycloak REST client
+        use_cache (bool): use the user lookup cache (fresh results are cached either way)
 
     Returns:
         dict: user info
     """
+    cache = get_user_cache()
+    if use_cache:
+        found, user = cache.get(rest_client.address, username)
+        if found:
+            if user is None:
+                raise UserDoesNotExist(f'user "{username}" does not exist')
+            return user
+
     url = f'/users?exact=true&username={username}'
     ret = await rest_client.request('GET', url)
 
     if not ret:
+        cache.put(rest_client.address, username, None)
         raise UserDoesNotExist(f'user "{username}" does not exist')
     fix_singleton_attributes(ret[0])
+    cache.put(rest_client.address, username, ret[0])
     return ret[0]
 
 
-async def __address_in_use(address, rest_client):
-    if await list_users(attr_query={'canonical_email': address}, rest_client=rest_client):
-        return True
-    local_part = address.split('@')
-    try:
-        await user_info(local_part, rest_client=rest_client)
-    except UserDoesNotExist:
-        return False
-    else:
-        return True
+async def get_users(usernames, concurrency=8, rest_client=None, page_size=50, use_cache=True):
+    """
+    Get information of many users.
+
+    Users that are not in the user lookup cache are either looked up one
+    by one, in parallel, or all at once by listing all users, whichever
+    takes fewer requests (listing takes one request per `page_size` users
+    in the realm).
+
+    Args:
+        usernames (iterable): usernames
+        concurrency (int): max number of concurrent requests
+        rest_client (RestClient): Keycloak REST client
+        page_size (int): number of users per request when listing all users
+        use_cache (bool): use the user lookup cache (fresh results are cached either way)
+
+    Returns:
+        tuple: (dict of username: user info, list of usernames that don't exist)
+    """
+    cache = get_user_cache()
+    usernames = list(dict.fromkeys(usernames))
+    users = {}
+    missing = []
+    lookups = []
+    for username in usernames:
+        found, user = cache.get(rest_client.address, username) if use_cache else (False, None)
+        if not found:
+            lookups.append(username)
+        elif user is None:
+            missing.append(username)
+        else:
+            users[username] = user
+
+    scan = False
+    if len(lookups) > concurrency:
+        num_users = await rest_client.request('GET', '/users/count')
+        scan = len(lookups) > num_users / page_size + 1
+
+    if scan:
+        logger.debug(f'listing all users to get {len(lookups)} users')
+        all_users = await list_users(rest_client=rest_client, page_size=page_size, concurrency=concurrency)
+        for username in lookups:
+            # usernames are stored in lower case, but exact lookups ignore case
+            user = all_users.get(username) or all_users.get(username.lower())
+            cache.put(rest_client.address, username, user)
+            if user is None:
+                missing.append(username)
+            else:
+                users[username] = user
+    elif lookups:
+        sem = asyncio.Semaphore(concurrency)
+
+        async def lookup(username):
+            async with sem:
+                try:
+                    users[username] = await user_info(username, rest_client=rest_client, use_cache=False)
+                except UserDoesNotExist:
+                    missing.append(username)
+        await asyncio.gather(*[lookup(username) for username in lookups])
+
+    if missing:
+        logger.info(f'users not found: {sorted(missing)}')
+    return {u: users[u] for u in usernames if u in users}, sorted(missing)
+
+
+def canonical_email_stem(first_name, last_name):
+    """Get the local part of the standard canonical address of a user."""
+    return unidecode(first_name + '.' + last_name).lower().replace(' ', '.')
+
+
+class CanonicalEmailAllocator:
+    """
+    Allocator of unused canonical email addresses.
+
+    The canonical address of a user is first.last@icecube.wisc.edu or, if
+    that is in use, first.last{salt}@icecube.wisc.edu with a random salt.
+    An address is in use if it is the `canonical_email` of a user, or if
+    its local part is a username.
+
+    Keycloak can't search attributes by prefix. So, to allocate addresses
+    for many users, the addresses in use are taken from a list of all users
+    (either passed in, e.g. from a `RealmCache`, or fetched once by `load()`),
+    and salts are picked locally. Otherwise, each candidate address is
+    checked with exact lookups. Allocated addresses are reserved, so users
+    created together don't collide.
 
+    Args:
+        users (dict): (optional) output of `list_users()`
+        domain (str): email domain
+    """
+    # The range was chosen to avoid numbers problematic in various cultures, small numbers
+    # (e.g. john.doe2@ is just sad), and numbers that look like birth years (e.g. foo.bar91)
+    SALTS = range(100, 601)
+
+    def __init__(self, users=None, domain='icecube.wisc.edu'):
+        self.domain = domain
+        self.in_use = None  # local parts, if known
+        self.reserved = set()
+        if users is not None:
+            self.add_users(users.values())
+
+    def add_users(self, users):
+        """
+        Mark the addresses of users as in use.
+
+        Args:
+            users (iterable): user info dicts
+        """
+        if self.in_use is None:
+            self.in_use = set()
+        for user in users:
+            self.in_use.add(user['username'].lower())
+            address = user.get('attributes', {}).get('canonical_email')
+            if isinstance(address, str) and address.lower().endswith(f'@{self.domain}'):
+                self.in_use.add(address.lower().rsplit('@', 1)[0])
+
+    async def load(self, rest_client=None):
+        """Get the addresses in use from a list of all users."""
+        self.add_users([u async for u in iter_users(rest_client=rest_client)])
+
+    async def _address_in_use(self, local_part, rest_client):
+        if local_part in self.reserved:
+            return True
+        if self.in_use is not None:
+            return local_part in self.in_use
+        address = f'{local_part}@{self.domain}'
+        url = f'/users?q="canonical_email":"{address}"&briefRepresentation=true&max=1'
+        if await rest_client.request('GET', url):
+            return True
+        try:
+            await user_info(local_part, rest_client=rest_client, use_cache=False)
+        except UserDoesNotExist:
+            return False
+        return True
 
-async def create_user(username, first_name, last_name, email, attribs=None, rest_client=None):
+    async def allocate(self, first_name, last_name, rest_client=None):
+        """
+        Allocate a canonical address.
+
+        Args:
+            first_name (str): first name
+            last_name (str): last name
+            rest_client (RestClient): Keycloak REST client
+
+        Returns:
+            str: canonical email address
+        """
+        stem = canonical_email_stem(first_name, last_name)
+        # If the standard canonical address is in use, try salts in random order.
+        candidates = [stem] + [f'{stem}{salt}' for salt in sample(self.SALTS, len(self.SALTS))]
+        for local_part in candidates:
+            if not await self._address_in_use(local_part, rest_client):
+                self.reserved.add(local_part)
+                return f'{local_part}@{self.domain}'
+        raise Exception(f'all canonical addresses for {stem} are in use')
+
+
+async def create_user(username, first_name, last_name, email, attribs=None, rest_client=None,
+                      email_allocator=None):
     """
     Create a user in Keycloak.
 
+    To create many users, pass the same loaded `CanonicalEmailAllocator`
+    to each call.
+
     Args:
         username (str): username of user to create
         first_name (str): first name
@@ -121,12 +429,13 @@ async def create_user(username, first_name, last_name, email, attribs=None, rest
         email (str): email address
         attribs (dict): user attributes
         rest_client: keycloak rest client
+        email_allocator (CanonicalEmailAllocator): (optional) allocator of canonical addresses
     """
     if not attribs:
         attribs = {}
 
     try:
-        await user_info(username, rest_client=rest_client)
+        await user_info(username, rest_client=rest_client, use_cache=False)
     except UserDoesNotExist:
         pass
     else:
@@ -136,15 +445,9 @@ async def create_user(username, first_name, last_name, email, attribs=None, rest
     if 'canonical_email' in attribs:
         raise NotImplementedError("Support for custom canonical addresses not implemented")
     # Generate a canonical address that is not being used
-    name_part = unidecode(first_name + '.' + last_name).lower().replace(' ', '.')
-    canonical_email = f"{name_part}@icecube.wisc.edu"
-    # If the standard canonical address is in use, generate a "nice" random salt.
-    while await __address_in_use(canonical_email, rest_client):
-        # The range was chosen to avoid numbers problematic in various cultures, small numbers
-        # (e.g. john.doe2@ is just sad), and numbers that look like birth years (e.g. foo.bar91)
-        salt = str(randint(100, 600))
-        canonical_email = f'{name_part}{salt}@icecube.wisc.edu'
-    attribs['canonical_email'] = canonical_email
+    if email_allocator is None:
+        email_allocator = CanonicalEmailAllocator()
+    attribs['canonical_email'] = await email_allocator.allocate(first_name, last_name, rest_client=rest_client)
 
     logger.info(f'creating user "{username}"')
     user = {
@@ -161,6 +464,8 @@ async def create_user(username, first_name, last_name, email, attribs=None, rest
         logger.error('Keycloak returned HTTP error %r: %r', e.response.status_code, e.response.text)
         raise
     else:
+        get_user_cache().invalidate(rest_client.address, username)
+        email_allocator.reserved.add(username.lower())
         logger.info(f'user "{username}" created')
 
 
@@ -195,7 +500,7 @@ async def modify_user(username, first_name=None, last_name=None, email=None, att
 
     # get current user info
     try:
-        ret = await user_info(username, rest_client=rest_client)
+        ret = await user_info(username, rest_client=rest_client, use_cache=False)
     except Exception:
         logger.info(f'user "{username}" does not exist')
         raise
@@ -222,7 +527,10 @@ async def modify_user(username, first_name=None, last_name=None, email=None, att
     if not actions_reset:
         actions = list(set(actions) | set(ret['requiredActions']))
     ret['requiredActions'] = actions
-    await rest_client.request('PUT', url, ret)
+    try:
+        await rest_client.request('PUT', url, ret)
+    finally:
+        get_user_cache().invalidate(rest_client.address, username)
 
 
 async def set_user_password(username, password=None, temporary=False, rest_client=None):
@@ -244,7 +552,7 @@ async def set_user_password(username, password=None, temporary=False, rest_clien
         raise Exception('password must be a string')
 
     try:
-        ret = await user_info(username, rest_client=rest_client)
+        ret = await user_info(username, rest_client=rest_client, use_cache=False)
     except UserDoesNotExist:
         logger.info(f'user "{username}" does not exist')
     else:
@@ -266,12 +574,15 @@ async def delete_user(username, rest_client=None):
         rest_client (RestClient): Keycloak REST client
     """
     try:
-        ret = await user_info(username, rest_client=rest_client)
+        ret = await user_info(username, rest_client=rest_client, use_cache=False)
     except UserDoesNotExist:
         logger.info(f'user "{username}" does not exist')
     else:
         url = f'/users/{ret["id"]}'
-        await rest_client.request('DELETE', url)
+        try:
+            await rest_client.request('DELETE', url)
+        finally:
+            get_user_cache().invalidate(rest_client.address, username)
         logger.info(f'user "{username}" deleted')
 
 
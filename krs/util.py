@@ -1,3 +1,7 @@
+import asyncio
+from collections import deque
+
+
 async def keycloak_version(rest_client):
     """
     Return the version of the keycloak server rest_client is pointing to.
@@ -39,3 +43,51 @@ def fix_singleton_attributes(user_or_group):
         for k in user_or_group['attributes']:
             if len(user_or_group['attributes'][k]) == 1:
                 user_or_group['attributes'][k] = user_or_group['attributes'][k][0]
+
+
+async def paginate(rest_client, url, total=None, page_size=50, concurrency=4):
+    """
+    Fetch a paginated Keycloak collection, several pages at a time.
+
+    Pages are requested concurrently using the `first` and `max` query
+    parameters, but items are yielded in the original order as soon as
+    the pages preceding them have arrived.
+
+    If `total` is not known, pages are requested speculatively, up to
+    `concurrency` pages ahead, until a short page is returned.
+
+    Args:
+        rest_client (RestClient): Keycloak REST client
+        url (str): collection url, possibly with query parameters
+        total (int|None): total number of items, if known
+        page_size (int): number of items per page
+        concurrency (int): max number of pages to fetch at once
+
+    Yields:
+        dict: collection items
+    """
+    if page_size < 1 or concurrency < 1:
+        raise ValueError('page_size and concurrency must be positive')
+    sep = '&' if '?' in url else '?'
+
+    async def fetch(start):
+        num = page_size if total is None else min(page_size, total - start)
+        return await rest_client.request('GET', f'{url}{sep}first={start}&max={num}')
+
+    pending = deque()
+    next_start = 0
+    try:
+        while True:
+            while len(pending) < concurrency and (total is None or next_start < total):
+                pending.append(asyncio.ensure_future(fetch(next_start)))
+                next_start += page_size
+            if not pending:
+                break
+            page = await pending.popleft()
+            for item in page:
+                yield item
+            if total is None and len(page) < page_size:
+                break
+    finally:
+        for task in pending:
+            task.cancel()
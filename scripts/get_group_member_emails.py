@@ -14,21 +14,16 @@ import asyncio
 import fnmatch
 import logging
 
-from asyncache import cached
-from cachetools import TTLCache
-
 from krs.token import get_rest_client
 from krs.users import user_info
 from krs.groups import list_groups, get_group_membership_by_id
 
 
-@cached(TTLCache(1024, 60))
 async def get_name(username, client=None):
     ret = await user_info(username, rest_client=client)
     return ret['firstName']+' '+ret['lastName']
 
 
-@cached(TTLCache(1024, 60))
 async def get_email(username, client=None):
     ret = await user_info(username, rest_client=client)
     return ret.get('attributes', {}).get('canonical_email', ret.get('email', None))
@@ -2,9 +2,11 @@ import asyncio
 import logging
 import pytest
 import pytest_asyncio
+from unittest.mock import MagicMock
 
 #from krs.token import get_token
 from krs import users, groups, bootstrap, rabbitmq
+from krs.ldap import AsyncLDAP
 from actions import create_posix_account
 
 from ..util import keycloak_bootstrap, ldap_bootstrap, rabbitmq_bootstrap
@@ -153,3 +155,22 @@ async def test_listener(keycloak_bootstrap, ldap_bootstrap, listener):
     assert 'homeDirectory' in ret
     assert ret['homeDirectory'] == '/home/testuser'
     assert 'posixAccount' in ret['objectClass']
+
+
+@pytest.mark.asyncio
+async def test_member_not_in_ldap():
+    ldap_client = MagicMock()
+    ldap_client.list_users.return_value = {'alice': {}}
+    ldap_client.list_groups.return_value = {}
+    mirror = MagicMock()
+    mirror.get_group_membership.return_value = ['alice', 'bob']
+    id_allocator = MagicMock()
+    id_allocator.allocate.return_value = 1000
+
+    async with AsyncLDAP(ldap_client) as client:
+        await create_posix_account.process('/posix', ldap_client=client, mirror=mirror, id_allocator=id_allocator)
+
+    # bob is skipped, alice gets a POSIX account
+    id_allocator.allocate.assert_called_once()
+    modified = {c.args[0] for c in ldap_client.modify_user.call_args_list}
+    assert modified == {'alice'}
@@ -1,12 +1,13 @@
 import pytest
 from datetime import datetime
+from unittest.mock import AsyncMock
 
 from ..util import keycloak_bootstrap
 from krs.groups import create_group, modify_group, add_user_group, get_group_membership
 from krs.users import create_user
 from krs.institutions import create_inst, Region
 
-from actions.prune_mail_groups_by_experiment import prune_mail_groups
+from actions.prune_mail_groups_by_experiment import _prune_group, prune_mail_groups
 
 
 @pytest.mark.asyncio
@@ -61,3 +62,24 @@ async def test_prune_mail_groups(keycloak_bootstrap):
 
     ret = await get_group_membership('/mail/list/subgroup', rest_client=keycloak_bootstrap)
     assert set(ret) == {'good', 'wrong-exp-grace'}
+
+
+@pytest.mark.asyncio
+async def test_prune_group_stale_cache(mocker):
+    def user(username, insts):
+        return {'username': username, 'attributes': {'institutions_last_seen': insts}}
+    mocker.patch('actions.prune_mail_groups_by_experiment.get_group_membership',
+                 new_callable=AsyncMock, return_value=['joined', 'left', 'deleted'])
+    current = {'joined': user('joined', '/institutions/foo/A'), 'left': user('left', '/institutions/bar/B')}
+    get_users = mocker.patch('actions.prune_mail_groups_by_experiment.get_users', new_callable=AsyncMock)
+    get_users.side_effect = lambda usernames, **kwargs: (
+        {u: current[u] for u in usernames if u in current}, [u for u in usernames if u not in current])
+    remove = mocker.patch('actions.prune_mail_groups_by_experiment.remove_user_group', new_callable=AsyncMock)
+    # snapshot from before "joined" joined an allowed institution
+    user_info_cache = {name: user(name, '/institutions/bar/B') for name in ('joined', 'left', 'deleted')}
+
+    removed = await _prune_group('/mail/list', 7, {'/institutions/foo/A'}, user_info_cache, None)
+
+    assert removed == ['left']
+    remove.assert_called_once_with('/mail/list', 'left', rest_client=None)
+    get_users.assert_called_with(['joined', 'left', 'deleted'], rest_client=None, use_cache=False)
@@ -1,13 +1,23 @@
+import asyncio
 import pytest
 
 from functools import partial
-from unittest.mock import MagicMock, call
+from unittest.mock import AsyncMock, MagicMock, call
 
 from ..util import keycloak_bootstrap  # type: ignore # noqa: F401
 from krs.groups import create_group, add_user_group
 from krs.users import create_user, modify_user
 
 from actions.sync_gws_mailing_lists import sync_gws_mailing_lists
+from actions.util import GoogleApiExecutor
+
+
+@pytest.fixture
+def executor():
+    # the mock clients don't share a transport, so no credentials are needed
+    executor = GoogleApiExecutor()
+    yield executor
+    executor.shutdown()
 
 
 async def setup_user(first, last, groups, attrs=None, rest_client=None):
@@ -22,7 +32,7 @@ async def setup_user(first, last, groups, attrs=None, rest_client=None):
 
 
 @pytest.mark.asyncio
-async def test_sync_gws_mailing_lists_insert(keycloak_bootstrap):  # noqa: F811
+async def test_sync_gws_mailing_lists_insert(keycloak_bootstrap, executor):  # noqa: F811
     request_list_members = MagicMock()
     request_list_members.execute = MagicMock(
         return_value={'members': [
@@ -56,7 +66,7 @@ async def test_sync_gws_mailing_lists_insert(keycloak_bootstrap):  # noqa: F811
     await _setup_user('add', 'sub-mgr', ['/mail/list/subgroup/_managers'])
 
     await sync_gws_mailing_lists(gws_members_client, gws_groups_client, keycloak_bootstrap,
-                                 send_notifications=False, dryrun=False)
+                                 send_notifications=False, dryrun=False, executor=executor)
 
     assert (sorted(map(repr, gws_members_client.insert.call_args_list)) ==
             sorted(map(repr, [
@@ -84,7 +94,7 @@ async def test_sync_gws_mailing_lists_insert(keycloak_bootstrap):  # noqa: F811
 
 
 @pytest.mark.asyncio
-async def test_sync_gws_mailing_lists_delete(keycloak_bootstrap):  # noqa: F811
+async def test_sync_gws_mailing_lists_delete(keycloak_bootstrap, executor):  # noqa: F811
     request_members = MagicMock()
     request_members.execute = MagicMock(
         return_value={'members': [
@@ -114,7 +124,7 @@ async def test_sync_gws_mailing_lists_delete(keycloak_bootstrap):  # noqa: F811
     await setup_user('keep', 'subadmin', ['/mail/list/sub/_admin'], rest_client=keycloak_bootstrap)
 
     await sync_gws_mailing_lists(gws_members_client, gws_groups_client, keycloak_bootstrap,
-                                 send_notifications=False, dryrun=False)
+                                 send_notifications=False, dryrun=False, executor=executor)
 
     assert (sorted(map(repr, gws_members_client.delete.call_args_list)) ==
             sorted(map(repr, [
@@ -125,7 +135,7 @@ async def test_sync_gws_mailing_lists_delete(keycloak_bootstrap):  # noqa: F811
 
 
 @pytest.mark.asyncio
-async def test_sync_gws_mailing_lists_patch(keycloak_bootstrap):  # noqa: F811
+async def test_sync_gws_mailing_lists_patch(keycloak_bootstrap, executor):  # noqa: F811
     request_members = MagicMock()
     request_members.execute.side_effect = [
         {'members': [
@@ -151,7 +161,7 @@ async def test_sync_gws_mailing_lists_patch(keycloak_bootstrap):  # noqa: F811
     await setup_user('make', 'member', ['/mail/list'], rest_client=keycloak_bootstrap)
 
     await sync_gws_mailing_lists(gws_members_client, gws_groups_client, keycloak_bootstrap,
-                                 send_notifications=False, dryrun=False)
+                                 send_notifications=False, dryrun=False, executor=executor)
 
     assert (sorted(map(repr, gws_members_client.patch.call_args_list)) ==
             sorted(map(repr, [
@@ -162,3 +172,37 @@ async def test_sync_gws_mailing_lists_patch(keycloak_bootstrap):  # noqa: F811
             ])))
     assert gws_members_client.insert.call_args_list == []
     assert gws_members_client.delete.call_args_list == []
+
+
+@pytest.mark.asyncio
+async def test_sync_gws_mailing_lists_parallel(mocker, executor):
+    mocker.patch('actions.sync_gws_mailing_lists.GroupIndex.load', new_callable=AsyncMock)
+    group_info = mocker.patch('actions.sync_gws_mailing_lists.group_info', new_callable=AsyncMock)
+    group_info.return_value = {'subGroups': [
+        {'name': name, 'path': f'/mail/{name}', 'attributes': {'email': f'{name}@gws'}, 'subGroups': []}
+        for name in ('a', 'b', 'c', 'd')
+    ]}
+    running = set()
+    max_running = 0
+
+    async def sync(kc_group, group_email, *args, **kwargs):
+        nonlocal max_running
+        running.add(group_email)
+        max_running = max(max_running, len(running))
+        await asyncio.sleep(0.01)
+        running.discard(group_email)
+        if group_email == 'a@gws':
+            raise Exception('sync failed')
+    sync_group = mocker.patch('actions.sync_gws_mailing_lists.sync_kc_group_tree_to_gws', side_effect=sync)
+
+    request_groups = MagicMock()
+    request_groups.execute = MagicMock(
+        return_value={'groups': [{'email': f'{name}@gws'} for name in ('a', 'b', 'c', 'd')]})
+    gws_groups_client = MagicMock()
+    gws_groups_client.list = MagicMock(return_value=request_groups)
+
+    with pytest.raises(Exception, match='sync failed'):
+        await sync_gws_mailing_lists(MagicMock(), gws_groups_client, MagicMock(),
+                                     send_notifications=False, concurrency=2, executor=executor)
+    assert sync_group.call_count == 4
+    assert max_running == 2
@@ -1,3 +1,7 @@
+import asyncio
+import json
+from unittest.mock import AsyncMock
+
 import pytest
 
 from krs.groups import (create_group, add_user_group, get_group_membership,
@@ -8,6 +12,8 @@ from krs.users import create_user
 from ..util import keycloak_bootstrap  # type: ignore
 
 from actions.sync_synchronized_groups import (auto_sync_enabled_groups, manual_group_sync,
+                                              sync_groups_in_dependency_order, is_nested_group,
+                                              sync_synchronized_group,
                                               SyncGroupNotificationConfig, SyncGroupConfig,
                                               MembershipSyncPolicy)
 from attrs import fields
@@ -155,3 +161,168 @@ async def test_sync_synchronized_group_authorlist(keycloak_bootstrap):
     with pytest.raises(ValueError):
         await manual_group_sync(g_authors_disabled, '$..[*].name', keycloak_client=keycloak_bootstrap,
                                 allow_notifications=False, dryrun=False)
+
+
+@pytest.mark.asyncio
+async def test_sync_groups_in_dependency_order(mocker):
+    running = set()
+    log = []
+
+    async def sync(path, **kwargs):
+        running.add(path)
+        log.append(('start', path, frozenset(running)))
+        await asyncio.sleep(0.01)
+        running.discard(path)
+        log.append(('end', path))
+        if path == '/fail':
+            raise Exception('sync failed')
+    mocker.patch('actions.sync_synchronized_groups.sync_synchronized_group', side_effect=sync)
+
+    sources = {
+        '/a': {'/src'},
+        '/b': {'/src'},
+        '/c': {'/a', '/b'},
+        '/fail': {'/src'},
+        '/d': {'/fail'},
+    }
+    configs = {path: None for path in sources}
+    with pytest.raises(Exception, match='sync failed'):
+        await sync_groups_in_dependency_order(configs, sources, keycloak=None,
+                                              allow_notifications=False, dryrun=True, concurrency=3)
+
+    starts = [entry[1] for entry in log if entry[0] == 'start']
+    assert sorted(starts) == ['/a', '/b', '/c', '/fail']  # /d skipped
+    assert log[0][2] | log[1][2] | log[2][2] == {'/a', '/b', '/fail'}  # independent groups in parallel
+    start_c = next(i for i, entry in enumerate(log) if entry[:2] == ('start', '/c'))
+    assert log.index(('end', '/a')) < start_c and log.index(('end', '/b')) < start_c
+
+
+@pytest.mark.asyncio
+async def test_sync_groups_in_dependency_order_nested(mocker):
+    running = set()
+    overlaps = []
+
+    async def sync(path, **kwargs):
+        overlaps.append((path, frozenset(running)))
+        running.add(path)
+        await asyncio.sleep(0.01)
+        running.discard(path)
+    mocker.patch('actions.sync_synchronized_groups.sync_synchronized_group', side_effect=sync)
+
+    sources = {'/a': {'/src'}, '/a/b': {'/src'}, '/a/b/c': {'/src'}, '/a/d': {'/src'}, '/ab': {'/src'}}
+    await sync_groups_in_dependency_order({path: None for path in sources}, sources, keycloak=None,
+                                          allow_notifications=False, dryrun=True, concurrency=5)
+    assert sorted(path for path, _ in overlaps) == sorted(sources)
+    for path, others in overlaps:
+        assert not any(is_nested_group(path, other) for other in others)
+    # groups that are not nested still run in parallel
+    assert dict(overlaps)['/ab'] == {'/a'}
+
+
+@pytest.mark.asyncio
+async def test_sync_groups_in_dependency_order_subgroup_source(mocker):
+    running = set()
+    overlaps = {}
+
+    async def sync(path, **kwargs):
+        overlaps[path] = set(running)
+        running.add(path)
+        await asyncio.sleep(0.01)
+        running.discard(path)
+        overlaps[path] |= running
+    mocker.patch('actions.sync_synchronized_groups.sync_synchronized_group', side_effect=sync)
+
+    sources = {
+        '/x/b': {'/src'},
+        '/a': {'/x/b/sub'},  # a plain subgroup of synchronized group /x/b
+        '/c': {'/src'},
+        '/p': {'/q/sub'},  # cycle through subgroups
+        '/q': {'/p/sub'},
+    }
+    await sync_groups_in_dependency_order({path: None for path in sources}, sources, keycloak=None,
+                                          allow_notifications=False, dryrun=True, concurrency=5)
+    assert '/a' not in overlaps['/x/b'] and '/x/b' not in overlaps['/a']
+    assert '/p' not in overlaps['/q'] and '/q' not in overlaps['/p']
+    assert '/c' in overlaps['/x/b']
+
+
+@pytest.mark.asyncio
+async def test_sync_groups_in_dependency_order_cycle(mocker):
+    order = []
+    shared = set()
+
+    async def sync(path, **kwargs):
+        order.append(path)
+        shared.add((id(kwargs['group_index']), id(kwargs['membership_cache'])))
+    mocker.patch('actions.sync_synchronized_groups.sync_synchronized_group', side_effect=sync)
+
+    sources = {'/a': {'/b'}, '/b': {'/a'}, '/c': {'/b'}}
+    group_index = object()
+    await sync_groups_in_dependency_order({path: None for path in sources}, sources, keycloak=None,
+                                          allow_notifications=False, dryrun=True,
+                                          group_index=group_index)
+    assert order == ['/a', '/b', '/c']
+    # the group index and source membership cache are shared by all groups of the run
+    assert len(shared) == 1 and next(iter(shared))[0] == id(group_index)
+
+
+@pytest.mark.asyncio
+async def test_deferred_removals_transaction(mocker):
+    # noinspection PyTypeChecker
+    cfg = SyncGroupConfig('/mail/test', {
+        fields(SyncGroupConfig).auto_sync.metadata['attr']: 'true',
+        fields(SyncGroupConfig).policy.metadata['attr']: MembershipSyncPolicy.prune.value,
+        fields(SyncGroupConfig).sources_expr.metadata['attr']: '$..path',
+    })
+    group_info = mocker.patch('actions.sync_synchronized_groups.group_info')
+    group_info.return_value = {'attributes': {
+        cfg.deferred_removals_attr: '{"user1": "2020-01-01T00:00:00", "user2": "2020-01-01T00:00:00"}'}}
+    modify_group = mocker.patch('actions.sync_synchronized_groups.modify_group')
+
+    async with cfg.deferred_removals_transaction(None):
+        await cfg.clear_deferred_removal('user1', None)
+        for username in ('user3', 'user4'):
+            await cfg.set_deferred_removal(username, None)
+        await cfg.clear_deferred_removal('nobody', None)
+        modify_group.assert_not_called()
+
+    group_info.assert_called_once()
+    modify_group.assert_called_once()
+    written = json.loads(modify_group.call_args.kwargs['attrs'][cfg.deferred_removals_attr])
+    assert sorted(written) == ['user2', 'user3', 'user4']
+    assert written['user2'] == '2020-01-01T00:00:00'
+
+    # outside of a transaction, changes are written immediately
+    await cfg.clear_deferred_removal('user2', None)
+    assert modify_group.call_count == 2
+
+
+@pytest.mark.asyncio
+async def test_sync_synchronized_group_one_index(mocker):
+    # noinspection PyTypeChecker
+    cfg = SyncGroupConfig('/mail/test', {
+        fields(SyncGroupConfig).auto_sync.metadata['attr']: 'true',
+        fields(SyncGroupConfig).policy.metadata['attr']: MembershipSyncPolicy.match.value,
+        fields(SyncGroupConfig).sources_expr.metadata['attr']: '$..path',
+    })
+    index = object()
+    load = mocker.patch('actions.sync_synchronized_groups.GroupIndex.load', new_callable=AsyncMock,
+                        return_value=index)
+    mocker.patch('actions.sync_synchronized_groups.get_source_group_paths', new_callable=AsyncMock,
+                 return_value=['/src'])
+    get_memberships = mocker.patch('actions.sync_synchronized_groups.get_memberships', new_callable=AsyncMock,
+                                   return_value=({'/src': ['new']}, {'new': ['/src']}))
+    get_group_membership = mocker.patch('actions.sync_synchronized_groups.get_group_membership',
+                                        new_callable=AsyncMock, return_value=['old'])
+    group_info = mocker.patch('actions.sync_synchronized_groups.group_info', new_callable=AsyncMock,
+                              return_value={'attributes': {}})
+    apply = mocker.patch('actions.sync_synchronized_groups.apply_membership_changes', new_callable=AsyncMock,
+                         return_value=({}, {}))
+
+    await sync_synchronized_group('/mail/test', cfg=cfg, keycloak=None, allow_notifications=False, dryrun=False)
+
+    load.assert_called_once()
+    for mock in (get_memberships, get_group_membership, group_info):
+        assert mock.call_args.kwargs['group_index'] is index
+    assert apply.call_count == 2
+    assert all(c.kwargs['group_index'] is index for c in apply.call_args_list)
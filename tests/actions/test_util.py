@@ -1,5 +1,15 @@
+import threading
+import time
+from unittest.mock import MagicMock
+
+import httplib2
 import pytest
-from actions.util import ssh, scp_and_run, scp_and_run_sudo
+from googleapiclient.errors import HttpError
+from googleapiclient.http import HttpRequest
+from jsonpath_ng.ext import parse
+
+from actions.util import (ApiStats, GoogleApiExecutor, GroupHierarchyIndex, RateLimiter, RetryError,
+                          batch_execute, retry_execute_async, ssh, scp_and_run, scp_and_run_sudo)
 
 from .util import TestException
 
@@ -47,3 +57,171 @@ def test_scp_and_run_sudo_error(mocker):
 
     with pytest.raises(TestException):
         scp_and_run_sudo('test.test.test', 'data data data')
+
+
+def make_group(path, attrs=None, subgroups=()):
+    return {'id': path, 'name': path.rsplit('/', 1)[1], 'path': path,
+            'attributes': attrs or {}, 'subGroups': list(subgroups)}
+
+
+GROUP_HIERARCHY = [
+    make_group('/institutions', subgroups=[
+        make_group('/institutions/IceCube', {'authorlist': 'true'}, subgroups=[
+            make_group('/institutions/IceCube/UW', {'authorlist': 'true'}, subgroups=[
+                make_group('/institutions/IceCube/UW/authorlist'),
+                make_group('/institutions/IceCube/UW/authorlist-x'),
+                make_group('/institutions/IceCube/UW/_admin'),
+            ]),
+            make_group('/institutions/IceCube/MSU', {'authorlist': 'false'}, subgroups=[
+                make_group('/institutions/IceCube/MSU/authorlist'),
+            ]),
+        ]),
+        make_group('/institutions/ARA', subgroups=[
+            make_group('/institutions/ARA/A1'),
+            make_group('/institutions/ARA/A2', {'multi': ['1', '2']}),
+        ]),
+        make_group('/institutions/CTA', subgroups=[make_group('/institutions/CTA/C1')]),
+    ]),
+    make_group('/mail', subgroups=[make_group('/mail/list')]),
+]
+
+
+@pytest.mark.parametrize('expr', [
+    "$..subGroups[?path =~ '^/institutions/((ARA)|(CTA))$'].subGroups[*].path",
+    "$..subGroups[?path == '/institutions/IceCube'].subGroups[?attributes.authorlist == 'true']"
+    ".subGroups[?name =~ '^authorlist.*'].path",
+    "$..subGroups[?name == 'authorlist'].path",
+    "$..subGroups[?attributes.authorlist == 'true'].name",
+    "$..subGroups[?attributes.multi == '1'].path",
+    "$..subGroups[?path == '/institutions'].path",
+    "$..subGroups[*].path",
+    "$[?path == '/mail'].subGroups[*].path",
+    "$..path",  # not indexed
+])
+def test_group_hierarchy_index(expr):
+    index = GroupHierarchyIndex(GROUP_HIERARCHY)
+    expected = [match.value for match in parse(expr).find(GROUP_HIERARCHY)]
+    assert index.find(expr) == expected
+    assert index.find(expr) == expected  # memoized
+
+
+def test_group_hierarchy_index_memoized(mocker):
+    index = GroupHierarchyIndex(GROUP_HIERARCHY)
+    evaluate = mocker.spy(index, '_evaluate')
+    expr = "$..subGroups[?path == '/institutions/ARA'].subGroups[*].path"
+    assert index.find(expr) == ['/institutions/ARA/A1', '/institutions/ARA/A2']
+    assert index.find(expr) == ['/institutions/ARA/A1', '/institutions/ARA/A2']
+    evaluate.assert_called_once()
+
+
+def test_rate_limiter():
+    limiter = RateLimiter(50, burst=5)
+    start = time.monotonic()
+    for _ in range(15):
+        limiter.acquire()
+    # 5 at once, then 10 at 50/s
+    assert 0.15 < time.monotonic() - start < 0.5
+
+
+@pytest.mark.asyncio
+async def test_google_api_executor():
+    executor = GoogleApiExecutor(max_workers=2, rate=1000)
+    threads = set()
+
+    def execute():
+        threads.add(threading.current_thread().name)
+        return 'ok'
+    request = MagicMock()
+    request.execute = MagicMock(side_effect=execute)
+
+    assert await executor.execute(request) == 'ok'
+    assert len(threads) == 1 and threads.pop().startswith('google-api')
+    executor.shutdown()
+
+
+def http_error(status, headers=None):
+    return HttpError(httplib2.Response(dict(headers or {}, status=status)), b'')
+
+
+@pytest.mark.asyncio
+async def test_retry_execute_async(mocker):
+    sleep = mocker.patch('asyncio.sleep')
+    request = MagicMock()
+    request.methodId = 'directory.members.insert'
+    request.execute = MagicMock(side_effect=[http_error(503), http_error(429, {'retry-after': '30'}), 'ok'])
+    stats = ApiStats()
+
+    assert await retry_execute_async(request, stats=stats) == 'ok'
+    delays = [c.args[0] for c in sleep.call_args_list]
+    assert len(delays) == 2
+    assert 0 <= delays[0] <= 1
+    assert delays[1] == 30
+    summary = stats.summary()['directory.members.insert']
+    assert (summary['attempts'], summary['retries'], summary['errors']) == (3, 2, 2)
+
+
+@pytest.mark.asyncio
+async def test_retry_execute_async_not_retryable(mocker):
+    mocker.patch('asyncio.sleep')
+    request = MagicMock()
+    request.execute = MagicMock(side_effect=http_error(409))
+    with pytest.raises(RetryError):
+        await retry_execute_async(request, stats=ApiStats())
+    request.execute.assert_called_once()
+
+
+class FakeBatch:
+    """Stand-in for BatchHttpRequest that answers from `outcomes`."""
+    def __init__(self, outcomes, log, callback):
+        self.outcomes = outcomes
+        self.log = log
+        self.callback = callback
+        self.requests = {}
+
+    def add(self, request, request_id):
+        self.requests[request_id] = request
+
+    def execute(self, http=None):
+        self.log.append([r.uri for r in self.requests.values()])
+        for request_id, request in self.requests.items():
+            status = self.outcomes[request.uri].pop(0)
+            if status == 200:
+                self.callback(request_id, {'uri': request.uri}, None)
+            elif status == 429:
+                self.callback(request_id, None, http_error(status, {'retry-after': '30'}))
+            else:
+                self.callback(request_id, None, http_error(status))
+
+
+def test_batch_execute(mocker):
+    sleep = mocker.patch('time.sleep')
+    outcomes = {'a': [200], 'b': [429, 200], 'c': [409], 'd': [200], 'e': [503] * 3}
+    log = []
+    resource = MagicMock()
+    resource.new_batch_http_request = lambda callback: FakeBatch(outcomes, log, callback)
+    requests = {key: HttpRequest(None, None, key, method='POST', methodId='test.insert') for key in outcomes}
+    stats = ApiStats()
+
+    results, errors = batch_execute(resource, requests, batch_size=3, max_attempts=3, stats=stats)
+
+    assert results == {'a': {'uri': 'a'}, 'b': {'uri': 'b'}, 'd': {'uri': 'd'}}
+    assert sorted(errors) == ['c', 'e']
+    assert errors['c'].status_code == 409
+    # only the retryable failures are retried
+    assert log == [['a', 'b', 'c'], ['d', 'e'], ['b', 'e'], ['e']]
+    # no sleep before the first attempt, and the second one honors Retry-After
+    delays = [c.args[0] for c in sleep.call_args_list]
+    assert len(delays) == 2
+    assert delays[0] == 30
+    assert 0 <= delays[1] <= 3
+    summary = stats.summary()['test.insert']
+    assert (summary['attempts'], summary['retries'], summary['errors']) == (8, 3, 5)
+
+
+def test_batch_execute_not_batchable():
+    request = MagicMock()
+    request.execute = MagicMock(return_value='ok')
+    stats = ApiStats()
+    results, errors = batch_execute(MagicMock(), {'x': request}, stats=stats)
+    assert results == {'x': 'ok'} and errors == {}
+    assert stats.summary()['MagicMock']['attempts'] == 1
@@ -0,0 +1,85 @@
+import pytest
+from unittest.mock import AsyncMock, MagicMock
+
+from krs import cache
+
+
+@pytest.fixture
+def rest_client():
+    client = MagicMock()
+    client.address = 'http://localhost/auth/admin/realms/testrealm'
+    return client
+
+
+@pytest.mark.asyncio
+async def test_list_users(tmp_path, rest_client, mocker):
+    list_users = mocker.patch('krs.cache.list_users', new_callable=AsyncMock)
+    list_users.return_value = {'testuser': {'username': 'testuser'}}
+
+    c = cache.RealmCache(str(tmp_path / 'cache.sqlite'))
+    ret = await c.list_users(rest_client=rest_client)
+    assert ret == {'testuser': {'username': 'testuser'}}
+
+    # second instance shares the snapshot
+    c2 = cache.RealmCache(str(tmp_path / 'cache.sqlite'))
+    ret = await c2.list_users(rest_client=rest_client)
+    assert ret == {'testuser': {'username': 'testuser'}}
+    assert list_users.call_count == 1
+
+    # bypass
+    c3 = cache.RealmCache(str(tmp_path / 'cache.sqlite'), bypass=True)
+    await c3.list_users(rest_client=rest_client)
+    assert list_users.call_count == 2
+
+    # missing required user
+    await c.list_users(require=['testuser'], rest_client=rest_client)
+    assert list_users.call_count == 2
+    await c.list_users(require=['newuser'], rest_client=rest_client)
+    assert list_users.call_count == 3
+
+
+@pytest.mark.asyncio
+async def test_ttl(tmp_path, rest_client, mocker):
+    list_users = mocker.patch('krs.cache.list_users', new_callable=AsyncMock)
+    list_users.return_value = {}
+
+    c = cache.RealmCache(str(tmp_path / 'cache.sqlite'), users_ttl=-1)
+    await c.list_users(rest_client=rest_client)
+    await c.list_users(rest_client=rest_client)
+    assert list_users.call_count == 2
+    assert c.info()[0]['expired']
+
+
+@pytest.mark.asyncio
+async def test_invalidate(tmp_path, rest_client, mocker):
+    list_users = mocker.patch('krs.cache.list_users', new_callable=AsyncMock)
+    list_users.return_value = {}
+
+    c = cache.RealmCache(str(tmp_path / 'cache.sqlite'))
+    await c.list_users(rest_client=rest_client)
+    c.invalidate('users', realm='http://other')
+    assert [e['entity'] for e in c.info()] == ['users']
+    c.invalidate('users', realm=rest_client.address)
+    assert c.info() == []
+    await c.list_users(rest_client=rest_client)
+    assert list_users.call_count == 2
+
+    with pytest.raises(ValueError):
+        c.invalidate('groups')
+
+
+def test_info_unknown_entity(tmp_path):
+    c = cache.RealmCache(str(tmp_path / 'cache.sqlite'))
+    c._put('realm', 'groups', {})  # e.g. written by an older version
+    assert [(e['entity'], e['expired']) for e in c.info()] == [('groups', True)]
+
+
+def test_from_environment(tmp_path, monkeypatch):
+    monkeypatch.delenv('KRS_CACHE_FILE', raising=False)
+    assert cache.RealmCache.from_environment() is None
+
+    monkeypatch.setenv('KRS_CACHE_FILE', str(tmp_path / 'cache.sqlite'))
+    monkeypatch.setenv('KRS_CACHE_USERS_TTL', '5')
+    c = cache.RealmCache.from_environment(bypass=True)
+    assert c.ttl['users'] == 5
+    assert c.bypass
@@ -1,4 +1,5 @@
 import pytest
+from unittest.mock import AsyncMock
 
 from krs.token import get_token
 from krs import groups, users
@@ -307,3 +308,133 @@ async def test_get_group_hierarchy(keycloak_bootstrap):
     from pprint import pformat
     assert dict_is_contained(expected, actual), \
         f"{pformat(expected)}\n!=\n{pformat(actual)}"
+
+
+@pytest.mark.asyncio
+async def test_group_index(keycloak_bootstrap):
+    await groups.create_group('/parent', rest_client=keycloak_bootstrap)
+    await groups.create_group('/parent/child', rest_client=keycloak_bootstrap)
+    index = await groups.GroupIndex.load(rest_client=keycloak_bootstrap)
+    assert '/parent' in index
+    assert index.get_path(index.get_id('/parent/child')) == '/parent/child'
+    assert index.parent('/parent/child') == '/parent'
+    assert index.parent('/parent') is None
+    assert index.children('/parent') == ['/parent/child']
+
+    with pytest.raises(groups.GroupDoesNotExist):
+        index.get_id('/foo')
+
+@pytest.mark.asyncio
+async def test_group_index_updates(keycloak_bootstrap):
+    index = await groups.GroupIndex.load(rest_client=keycloak_bootstrap)
+    await groups.create_group('/parent', rest_client=keycloak_bootstrap, group_index=index)
+    await groups.create_group('/parent/child', attrs={'foo': 'bar'}, rest_client=keycloak_bootstrap, group_index=index)
+    await groups.create_group('/parent/child/grandchild', rest_client=keycloak_bootstrap, group_index=index)
+    assert index.keys() == (await groups.list_groups(rest_client=keycloak_bootstrap)).keys()
+    assert index['/parent/child']['attributes'] == {'foo': 'bar'}
+
+    await groups.modify_group('/parent/child', new_group_name='child2', rest_client=keycloak_bootstrap, group_index=index)
+    assert index.children('/parent') == ['/parent/child2']
+    assert '/parent/child2/grandchild' in index
+    assert index.keys() == (await groups.list_groups(rest_client=keycloak_bootstrap)).keys()
+
+    await groups.delete_group('/parent/child2', rest_client=keycloak_bootstrap, group_index=index)
+    assert list(index.keys()) == ['/parent']
+    assert index.children('/parent') == []
+
+@pytest.mark.asyncio
+async def test_add_user_group_index(keycloak_bootstrap):
+    await users.create_user('testuser', first_name='first', last_name='last', email='email@test', rest_client=keycloak_bootstrap)
+    index = await groups.GroupIndex.load(rest_client=keycloak_bootstrap)
+    with pytest.raises(groups.GroupDoesNotExist):
+        await groups.add_user_group('/testgroup', 'testuser', rest_client=keycloak_bootstrap, group_index=index)
+
+    await groups.create_group('/testgroup', rest_client=keycloak_bootstrap, group_index=index)
+    await groups.add_user_group('/testgroup', 'testuser', rest_client=keycloak_bootstrap, group_index=index)
+    ret = await groups.get_group_membership('/testgroup', rest_client=keycloak_bootstrap, group_index=index)
+    assert ret == ['testuser']
+
+    await groups.remove_user_group('/testgroup', 'testuser', rest_client=keycloak_bootstrap, group_index=index)
+    ret = await groups.get_group_membership('/testgroup', rest_client=keycloak_bootstrap, group_index=index)
+    assert ret == []
+
+@pytest.mark.asyncio
+async def test_get_memberships(keycloak_bootstrap):
+    await users.create_user('user1', first_name='first', last_name='last', email='email1@test', rest_client=keycloak_bootstrap)
+    await users.create_user('user2', first_name='first', last_name='last', email='email2@test', rest_client=keycloak_bootstrap)
+    await groups.create_group('/parent', rest_client=keycloak_bootstrap)
+    await groups.create_group('/parent/child', rest_client=keycloak_bootstrap)
+    await groups.create_group('/other', rest_client=keycloak_bootstrap)
+    await groups.add_user_group('/parent', 'user1', rest_client=keycloak_bootstrap)
+    await groups.add_user_group('/parent/child', 'user2', rest_client=keycloak_bootstrap)
+    await groups.add_user_group('/other', 'user2', rest_client=keycloak_bootstrap)
+
+    index = await groups.GroupIndex.load(rest_client=keycloak_bootstrap)
+    members, memberships = await groups.get_memberships(['/parent', index.get_id('/other'), '/other'],
+                                                        rest_client=keycloak_bootstrap, group_index=index)
+    assert members == {'/parent': ['user1'], '/other': ['user2']}
+    assert memberships == {'user1': ['/parent'], 'user2': ['/other']}
+
+    members, memberships = await groups.get_memberships(['/parent', '/parent/child'], subgroups=True,
+                                                        rest_client=keycloak_bootstrap)
+    assert members == {'/parent': ['user1'], '/parent/child': ['user2']}
+    assert memberships == {'user1': ['/parent'], 'user2': ['/parent/child']}
+
+    with pytest.raises(groups.GroupDoesNotExist):
+        await groups.get_memberships(['/foo'], rest_client=keycloak_bootstrap)
+
+def test_plan_membership_changes():
+    plan = groups.plan_membership_changes
+    assert plan(['/a'], add=['/a'], remove=['/b']) == []
+    assert plan(['/a'], remove=['/a']) == [('DELETE', '/a')]
+
+    # subgroup memberships are removed and restored once, around the additions
+    current = ['/a/b/c', '/a/b', '/a/x', '/y']
+    assert plan(current, add=['/a', '/a/b/c/d']) == [
+        ('DELETE', '/a/b/c'), ('DELETE', '/a/x'), ('DELETE', '/a/b'),
+        ('PUT', '/a'), ('PUT', '/a/b'), ('PUT', '/a/x'), ('PUT', '/a/b/c'), ('PUT', '/a/b/c/d'),
+    ]
+
+    # removed subgroups are not restored, and prefixes are not subgroups
+    assert plan(['/a/b', '/ab'], add=['/a'], remove=['/a/b']) == [('DELETE', '/a/b'), ('PUT', '/a')]
+
+
+@pytest.mark.asyncio
+async def test_apply_membership_changes():
+    index = groups.GroupIndex({
+        '/a': {'id': 'a-id', 'name': 'a', 'path': '/a', 'children': ['b'], 'attributes': {}},
+        '/a/b': {'id': 'b-id', 'name': 'b', 'path': '/a/b', 'children': [], 'attributes': {}},
+    })
+    memberships = {'u1': [{'path': '/a/b'}], 'u2': [{'path': '/a'}]}
+
+    async def request(method, url):
+        if url.startswith('/users?'):
+            username = url.rsplit('=', 1)[-1]
+            if username not in memberships:
+                return []
+            return [{'id': username, 'username': username}]
+        if method == 'GET':
+            return memberships[url.split('/')[2]]
+    rest_client = AsyncMock()
+    rest_client.request.side_effect = request
+
+    applied, failed = await groups.apply_membership_changes(
+        add={'/a': ['u1', 'u2', 'u3']}, remove={'/a/b': ['u2']}, rest_client=rest_client, group_index=index)
+    assert applied == {
+        'u1': [('DELETE', '/a/b'), ('PUT', '/a'), ('PUT', '/a/b')],
+        'u2': [],
+    }
+    assert list(failed) == ['u3']
+    assert isinstance(failed['u3'], users.UserDoesNotExist)
+    mutations = [c.args for c in rest_client.request.call_args_list if c.args[0] != 'GET']
+    assert mutations == [('DELETE', '/users/u1/groups/b-id'), ('PUT', '/users/u1/groups/a-id'),
+                         ('PUT', '/users/u1/groups/b-id')]
+
+    # a user created since then is found: writes don't trust cached lookups
+    memberships['u3'] = []
+    applied, failed = await groups.apply_membership_changes(add={'/a': ['u3']}, rest_client=rest_client,
+                                                            group_index=index)
+    assert applied == {'u3': [('PUT', '/a')]} and not failed
+
+    with pytest.raises(groups.GroupDoesNotExist):
+        await groups.apply_membership_changes(add={'/c': ['u1']}, rest_client=rest_client, group_index=index)
@@ -1,8 +1,9 @@
 import pytest
+from ldap3 import Connection
 
 from krs import ldap
 
-from ..util import ldap_bootstrap
+from ..util import ldap_bootstrap, mock_ldap, add_mock_entry
 
 
 def test_get_users_none(ldap_bootstrap):
@@ -193,3 +194,113 @@ def test_remove_user_group_posix_twice(ldap_bootstrap):
     assert list(ret.keys()) == ['foo']
     print(ret)
     assert 'memberUid' not in ret['foo'] or 'foo' not in ret['foo']['memberUid']
+
+def test_connection_pool(mocker):
+    Connection = mocker.patch('krs.ldap.Connection')
+    Connection.side_effect = lambda *args, **kwargs: mocker.MagicMock(closed=False, bound=True)
+    server = mocker.MagicMock(schema=None)
+    pool = ldap.LDAPConnectionPool(server, user='cn=admin', password='pass', size=2)
+
+    with pool.connection() as c1:
+        c1.bind.assert_called_once_with(read_server_info=True)
+    with pool.connection() as c2:
+        pass
+    assert c1 is c2
+    assert Connection.call_count == 1
+
+    # broken connections are discarded
+    with pool.connection() as c3:
+        c3.closed = True
+    with pool.connection() as c4:
+        pass
+    assert c4 is not c3
+    assert Connection.call_count == 2
+
+    # stale connections are checked before reuse
+    pool.check_interval = -1
+    c4.search.return_value = False
+    with pool.connection() as c5:
+        pass
+    assert c5 is not c4
+    c4.unbind.assert_called_once()
+
+    pool.close()
+    c5.unbind.assert_called_once()
+    assert not pool.idle
+
+def test_set_group_members(ldap_bootstrap):
+    for name in ('foo', 'bar', 'baz'):
+        ldap_bootstrap.create_user(username=name, firstName=name, lastName='bar', email=f'{name}@bar')
+    ldap_bootstrap.create_group('grp')
+    ldap_bootstrap.add_user_group('foo', 'grp')
+
+    ret = ldap_bootstrap.set_group_members('grp', add=['bar', 'baz'], remove=['foo'])
+    assert ret == {'bar': 'added', 'baz': 'added', 'foo': 'removed'}
+
+    ret = ldap_bootstrap.list_groups()
+    assert sorted(ldap.get_ldap_members(ret['grp'])) == ['bar', 'baz']
+
+def test_set_group_members_posix(mock_ldap, mocker):
+    add_mock_entry(mock_ldap.server, 'cn=foo,ou=Group,dc=icecube,dc=wisc,dc=edu', {
+        'objectClass': ['posixGroup', 'top'], 'cn': 'foo', 'gidNumber': 1000, 'memberUid': ['a']})
+    modify = mocker.spy(Connection, 'modify')
+
+    ret = mock_ldap.set_group_members('foo', add=['a', 'b', 'c', 'd'], chunk_size=2)
+    assert ret == {'a': 'unchanged', 'b': 'added', 'c': 'added', 'd': 'added'}
+    assert modify.call_count == 2
+
+    ret = mock_ldap.set_group_members('foo', add=['e'], remove=['a', 'b', 'z'])
+    assert ret == {'e': 'added', 'a': 'removed', 'b': 'removed', 'z': 'unchanged'}
+    assert sorted(mock_ldap.get_group('foo')['memberUid']) == ['c', 'd', 'e']
+
+def test_set_group_members_placeholder(mock_ldap):
+    add_mock_entry(mock_ldap.server, 'cn=foo,ou=Group,dc=icecube,dc=wisc,dc=edu', {
+        'objectClass': ['groupOfNames', 'top'], 'cn': 'foo', 'member': ['uid=a,ou=People,dc=icecube,dc=wisc,dc=edu']})
+
+    assert mock_ldap.set_group_members('foo', remove=['a']) == {'a': 'removed'}
+    assert mock_ldap.get_group('foo')['member'] == 'cn=empty-membership-placeholder'
+
+@pytest.mark.asyncio
+async def test_async_ldap(mock_ldap):
+    add_mock_entry(mock_ldap.server, 'cn=foo,ou=Group,dc=icecube,dc=wisc,dc=edu', {
+        'objectClass': ['posixGroup', 'top'], 'cn': 'foo', 'gidNumber': 1000})
+
+    client = ldap.AsyncLDAP.wrap(mock_ldap)
+    assert ldap.AsyncLDAP.wrap(mock_ldap) is client
+    assert ldap.AsyncLDAP.wrap(client) is client
+    assert client.config is mock_ldap.config
+
+    ret = await client.get_group('foo')
+    assert ret['gidNumber'] == 1000
+    ret = await client.set_group_members('foo', add=['a'])
+    assert ret == {'a': 'added'}
+    with pytest.raises(KeyError):
+        await client.get_group('bar')
+
+    # closing the client shuts down the facade's thread pool
+    mock_ldap.close()
+    with pytest.raises(RuntimeError):
+        client.executor.submit(print)
+    assert ldap.AsyncLDAP.wrap(mock_ldap) is not client
+
+def test_list_users_projection(mock_ldap, mocker):
+    for uid, shell in (('foo', '/bin/bash'), ('bar', None)):
+        attrs = {'objectClass': ['inetOrgPerson', 'posixAccount', 'top'], 'uid': uid, 'cn': uid, 'sn': uid,
+                 'uidNumber': 1000, 'gidNumber': 1000, 'homeDirectory': f'/home/{uid}'}
+        if shell:
+            attrs['loginShell'] = shell
+        add_mock_entry(mock_ldap.server, f'uid={uid},ou=People,dc=icecube,dc=wisc,dc=edu', attrs)
+    search = mocker.spy(Connection, 'search')
+
+    ret = mock_ldap.list_users(['uidNumber', 'loginShell'])
+    assert ret == {
+        'foo': {'uidNumber': 1000, 'loginShell': '/bin/bash'},
+        'bar': {'uidNumber': 1000},
+    }
+    assert search.call_args.kwargs['attributes'] == ['uid', 'uidNumber', 'loginShell']
+
+    ret = mock_ldap.list_users(['uid'], search_filter='(loginShell=*)')
+    assert ret == {'foo': {'uid': 'foo'}}
+
+    ret = list(mock_ldap.iter_users(['cn'], search_filter='(uid=bar)'))
+    assert ret == [('bar', {'cn': 'bar'})]
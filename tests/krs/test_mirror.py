@@ -0,0 +1,153 @@
+import time
+
+import pytest
+from unittest.mock import AsyncMock, MagicMock
+
+from krs import mirror
+from krs.groups import GroupDoesNotExist, GroupIndex
+
+
+GROUPS = {
+    '/foo': {'id': 'foo-id', 'name': 'foo', 'path': '/foo', 'children': ['bar'], 'attributes': {}},
+    '/foo/bar': {'id': 'bar-id', 'name': 'bar', 'path': '/foo/bar', 'children': [], 'attributes': {}},
+}
+
+
+@pytest.fixture
+def realm(mocker):
+    async def iter_users(**kwargs):
+        for u in [{'id': 'u1', 'username': 'alice'}, {'id': 'u2', 'username': 'bob'}]:
+            yield u
+    mocker.patch('krs.mirror.iter_users', iter_users)
+    load = mocker.patch('krs.mirror.GroupIndex.load', new_callable=AsyncMock)
+    load.side_effect = lambda **kwargs: GroupIndex({k: dict(v) for k, v in GROUPS.items()})
+    get_memberships = mocker.patch('krs.mirror.get_memberships', new_callable=AsyncMock)
+    get_memberships.return_value = ({'/foo': ['alice'], '/foo/bar': []}, {})
+    mocker.patch('krs.mirror.RabbitMQListener')
+    return MagicMock()
+
+
+@pytest.mark.asyncio
+async def test_resync(realm):
+    m = mirror.RealmMirror(realm)
+    await m.resync()
+    assert m.list_users().keys() == {'alice', 'bob'}
+    assert m.get_group_membership('/foo') == ['alice']
+    assert m.get_group_membership('/foo/bar') == []
+    with pytest.raises(GroupDoesNotExist):
+        m.get_group_membership('/baz')
+    assert m.metrics['resyncs'] == 1
+
+
+@pytest.mark.asyncio
+async def test_membership_events(realm):
+    m = mirror.RealmMirror(realm)
+    await m.resync()
+
+    subscriber = AsyncMock()
+    m.subscribe(subscriber, resource_types=['GROUP_MEMBERSHIP'])
+
+    body = {
+        'time': time.time() * 1000 - 2000,
+        'resourceType': 'GROUP_MEMBERSHIP',
+        'operationType': 'CREATE',
+        'resourcePath': 'users/u2/groups/bar-id',
+        'representation': {'id': 'bar-id', 'path': '/foo/bar'},
+    }
+    await m.handle_event(body)
+    assert m.get_group_membership('/foo/bar') == ['bob']
+    subscriber.assert_called_once_with(body)
+    assert m.metrics['last_event_lag'] >= 2
+
+    await m.handle_event(dict(body, operationType='DELETE', resourcePath='users/u1/groups/foo-id'))
+    assert m.get_group_membership('/foo') == []
+    assert m.metrics['events'] == 2
+
+    # subscriber not called for other resource types
+    await m.handle_event({'resourceType': 'CLIENT', 'operationType': 'UPDATE', 'resourcePath': 'clients/x'})
+    assert subscriber.call_count == 2
+    assert m.metrics['events_ignored'] == 1
+
+
+@pytest.mark.asyncio
+async def test_user_events(realm):
+    m = mirror.RealmMirror(realm)
+    await m.resync()
+
+    await m.handle_event({'resourceType': 'USER', 'operationType': 'CREATE',
+                          'resourcePath': 'users/u3', 'representation': {'username': 'carol'}})
+    assert m.user_info('carol')['id'] == 'u3'
+
+    await m.handle_event({'resourceType': 'USER', 'operationType': 'UPDATE',
+                          'resourcePath': 'users/u1', 'representation': {'username': 'alice', 'email': 'a@test'}})
+    assert m.user_info('alice')['email'] == 'a@test'
+
+    await m.handle_event({'resourceType': 'USER', 'operationType': 'DELETE', 'resourcePath': 'users/u1'})
+    assert 'alice' not in m.list_users()
+    assert m.get_group_membership('/foo') == []
+
+
+@pytest.mark.asyncio
+async def test_drift_repair(realm):
+    m = mirror.RealmMirror(realm)
+    await m.resync()
+
+    # an event applied locally that Keycloak doesn't agree with
+    m.members['foo-id'].add('bob')
+    await m.resync()
+    assert m.get_group_membership('/foo') == ['alice']
+    assert m.metrics['resyncs'] == 2
+
+    # a membership event for an unknown user fetches the user
+    realm.request = AsyncMock(return_value={'id': 'u9', 'username': 'zed'})
+    await m.handle_event({'resourceType': 'GROUP_MEMBERSHIP', 'operationType': 'CREATE',
+                          'resourcePath': 'users/u9/groups/foo-id', 'representation': {}})
+    assert m.get_group_membership('/foo') == ['alice', 'zed']
+
+
+@pytest.mark.asyncio
+async def test_error_events_ignored(realm):
+    m = mirror.RealmMirror(realm)
+    await m.resync()
+    subscriber = AsyncMock()
+    m.subscribe(subscriber)
+
+    await m.handle_event({'resourceType': 'GROUP_MEMBERSHIP', 'operationType': 'CREATE',
+                          'resourcePath': 'users/u2/groups/bar-id', 'error': 'unknown_error',
+                          'representation': {'id': 'bar-id', 'path': '/foo/bar'}})
+    assert m.get_group_membership('/foo/bar') == []
+    subscriber.assert_not_called()
+    assert m.metrics['events_ignored'] == 1
+
+
+@pytest.mark.asyncio
+async def test_user_attributes_normalized(realm):
+    m = mirror.RealmMirror(realm)
+    await m.resync()
+
+    await m.handle_event({'resourceType': 'USER', 'operationType': 'UPDATE', 'resourcePath': 'users/u1',
+                          'representation': {'username': 'alice', 'attributes': {'a': ['1'], 'b': ['1', '2']}}})
+    assert m.user_info('alice')['attributes'] == {'a': '1', 'b': ['1', '2']}
+
+    realm.request = AsyncMock(return_value={'id': 'u9', 'username': 'zed', 'attributes': {'a': ['1']}})
+    await m.handle_event({'resourceType': 'GROUP_MEMBERSHIP', 'operationType': 'CREATE',
+                          'resourcePath': 'users/u9/groups/foo-id', 'representation': {}})
+    assert m.user_info('zed')['attributes'] == {'a': '1'}
+
+
+@pytest.mark.asyncio
+async def test_subscriber_dedup(realm):
+    m = mirror.RealmMirror(realm)
+    await m.resync()
+    subscriber = AsyncMock()
+    m.subscribe(subscriber, dedup=0.05, dedup_key=lambda body: body['representation']['path'])
+
+    for path in ['/foo', '/foo/bar', '/foo']:
+        await m.handle_event({'resourceType': 'GROUP_MEMBERSHIP', 'operationType': 'CREATE',
+                              'resourcePath': 'users/u2/groups/foo-id',
+                              'representation': {'id': 'foo-id', 'path': path}})
+    # handle_event doesn't wait for debounced subscribers
+    subscriber.assert_not_called()
+    m.listener.stop = AsyncMock()
+    await m.stop()
+    assert subscriber.call_count == 2
@@ -0,0 +1,51 @@
+from krs import posix_ids
+
+from ..util import mock_ldap, add_mock_entry
+
+
+def add_user(server, uid, uid_number, gid_number):
+    add_mock_entry(server, f'uid={uid},ou=People,dc=icecube,dc=wisc,dc=edu', {
+        'objectClass': ['inetOrgPerson', 'posixAccount', 'top'], 'uid': uid, 'cn': uid, 'sn': uid,
+        'uidNumber': uid_number, 'gidNumber': gid_number, 'homeDirectory': f'/home/{uid}'})
+
+
+def test_allocate(mock_ldap):
+    add_user(mock_ldap.server, 'foo', 1000, 1000)
+    add_user(mock_ldap.server, 'bar', 1001, 1500)
+    add_mock_entry(mock_ldap.server, 'cn=baz,ou=Group,dc=icecube,dc=wisc,dc=edu', {
+        'objectClass': ['posixGroup', 'top'], 'cn': 'baz', 'gidNumber': 1200})
+
+    alloc = posix_ids.PosixIdAllocator(mock_ldap)
+    alloc.load()
+    assert alloc.is_used(1200)
+    assert not alloc.is_used(1100)
+    assert alloc.allocate() == 1501
+    assert alloc.allocate() == 1502
+    assert alloc.is_used(1502)
+
+
+def test_allocate_min_id():
+    alloc = posix_ids.PosixIdAllocator(None, min_id=2000)
+    alloc.load(users={'foo': {'uidNumber': 10, 'gidNumber': 10}}, groups={})
+    assert alloc.allocate() == 2000
+    alloc.add_used(2001)
+    assert alloc.allocate() == 2002
+
+
+def test_allocate_counter(mock_ldap):
+    add_user(mock_ldap.server, 'foo', 1000, 1000)
+    counter_dn = 'cn=nextPosixId,dc=icecube,dc=wisc,dc=edu'
+
+    alloc1 = posix_ids.PosixIdAllocator(mock_ldap, counter_dn=counter_dn)
+    alloc1.load(groups={})
+    alloc2 = posix_ids.PosixIdAllocator(mock_ldap, counter_dn=counter_dn)
+    alloc2.load(groups={})
+
+    # both processes see the same directory, but get different ids
+    assert alloc1.allocate() == 1001
+    assert alloc2.allocate() == 1002
+    assert alloc1.allocate() == 1003
+
+    # dry runs don't reserve
+    assert alloc2.allocate(dryrun=True) == 1003
+    assert alloc1.allocate() == 1004
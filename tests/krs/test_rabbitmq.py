@@ -0,0 +1,179 @@
+import asyncio
+import json
+import time
+
+import pytest
+from unittest.mock import AsyncMock, MagicMock
+
+from krs import rabbitmq
+
+
+def make_message(path, resource_path='users/u1/groups/g1', redelivered=False):
+    message = MagicMock()
+    message.body = json.dumps({
+        'resourcePath': resource_path,
+        'representation': json.dumps({'path': path}),
+    }).encode()
+    message.redelivered = redelivered
+    message.ack = AsyncMock()
+    message.nack = AsyncMock()
+    message.reject = AsyncMock()
+    return message
+
+
+@pytest.mark.asyncio
+async def test_dedup_keyed():
+    action = AsyncMock()
+    mq = rabbitmq.RabbitMQListener(action, dedup=0.05, dedup_key=rabbitmq.group_path_key)
+
+    messages = [make_message('/foo'), make_message('/bar'), make_message('/foo')]
+    for m in messages:
+        await mq._process_dedup(m)
+    await asyncio.sleep(0.2)
+
+    assert action.call_count == 2
+    paths = sorted(c.args[0]['representation']['path'] for c in action.call_args_list)
+    assert paths == ['/bar', '/foo']
+    for m in messages:
+        m.ack.assert_called_once()
+
+
+@pytest.mark.asyncio
+async def test_dedup_max_delay():
+    calls = []
+    action = AsyncMock(side_effect=lambda body: calls.append(time.monotonic()))
+    mq = rabbitmq.RabbitMQListener(action, dedup=0.05, dedup_max_delay=0.1)
+
+    # a steady stream of messages, closer together than the dedup delay,
+    # would postpone the action forever without the max delay
+    messages = []
+    start = time.monotonic()
+    while time.monotonic() - start < 0.35:
+        messages.append(make_message('/foo'))
+        await mq._process_dedup(messages[-1])
+        await asyncio.sleep(0.02)
+    assert calls
+    assert 0.1 <= calls[0] - start < 0.2
+    assert len(calls) >= 2
+    assert all(b - a < 0.2 for a, b in zip(calls, calls[1:]))
+
+    await mq._drain()
+    for m in messages:
+        m.ack.assert_called_once()
+
+
+@pytest.mark.asyncio
+async def test_dedup_skip_key():
+    action = AsyncMock()
+    mq = rabbitmq.RabbitMQListener(action, dedup=0.01, dedup_key=lambda body: None)
+    message = make_message('/foo')
+    await mq._process_dedup(message)
+    await asyncio.sleep(0.05)
+    action.assert_not_called()
+    message.ack.assert_called_once()
+
+
+@pytest.mark.asyncio
+async def test_dedup_failure():
+    action = AsyncMock(side_effect=Exception('failed'))
+    mq = rabbitmq.RabbitMQListener(action, dedup=0.01)
+
+    first = make_message('/foo')
+    second = make_message('/foo', redelivered=True)
+    await mq._process_dedup(first)
+    await mq._process_dedup(second)
+    await asyncio.sleep(0.05)
+
+    action.assert_called_once()
+    first.ack.assert_not_called()
+    first.nack.assert_called_once_with(requeue=True)
+    second.reject.assert_called_once()
+
+
+@pytest.mark.asyncio
+async def test_pool_concurrency():
+    running = 0
+    max_running = 0
+
+    async def action(body):
+        nonlocal running, max_running
+        running += 1
+        max_running = max(max_running, running)
+        await asyncio.sleep(0.02)
+        running -= 1
+
+    mq = rabbitmq.RabbitMQListener(action, concurrency=3)
+    mq._start_workers()
+    for i in range(10):
+        await mq._process_pool(make_message('/foo'))
+    await mq._drain()
+    assert max_running == 3
+    assert mq.workers == []
+
+
+@pytest.mark.asyncio
+async def test_pool_ordered():
+    seen = []
+
+    async def action(body):
+        await asyncio.sleep(0.01 if body['representation']['path'] == '/a0' else 0)
+        seen.append(body['representation']['path'])
+
+    mq = rabbitmq.RabbitMQListener(action, concurrency=4, ordered=True)
+    mq._start_workers()
+    for i in range(5):
+        message = make_message(f'/a{i}')
+        message.routing_key = 'KK.EVENT.ADMIN.realm.SUCCESS.USER.UPDATE'
+        await mq._process_pool(message)
+    await mq._drain()
+    assert seen == [f'/a{i}' for i in range(5)]
+
+
+@pytest.mark.asyncio
+async def test_dedup_drain_waits_for_running():
+    done = []
+
+    async def action(body):
+        await asyncio.sleep(0.05)
+        done.append(body)
+
+    mq = rabbitmq.RabbitMQListener(action, dedup=0.01)
+    message = make_message('/foo')
+    await mq._process_dedup(message)
+    await asyncio.sleep(0.03)
+    # the action is running, and no longer pending
+    assert not mq.debouncer.pending
+    await mq._drain()
+    assert len(done) == 1
+    message.ack.assert_called_once()
+
+
+def test_dedup_and_concurrency():
+    with pytest.raises(ValueError):
+        rabbitmq.RabbitMQListener(AsyncMock(), dedup=1, concurrency=2)
+
+
+@pytest.mark.asyncio
+async def test_debouncer():
+    running = 0
+    max_running = 0
+
+    async def action(body):
+        nonlocal running, max_running
+        running += 1
+        max_running = max(max_running, running)
+        await asyncio.sleep(0.02)
+        running -= 1
+
+    on_done = AsyncMock()
+    debouncer = rabbitmq.Debouncer(action, 0.01, key=lambda body: body['key'], concurrency=2, on_done=on_done)
+    for i in range(8):
+        assert debouncer.submit({'key': i % 4}, i)
+    assert not debouncer.submit({'key': None})
+    await debouncer.drain()
+
+    assert max_running == 2
+    assert not debouncer.pending and not debouncer.locks
+    items = sorted(c.args[0] for c in on_done.call_args_list)
+    assert items == [[0, 4], [1, 5], [2, 6], [3, 7]]
+    assert all(c.args[1] is None for c in on_done.call_args_list)
@@ -0,0 +1,104 @@
+import asyncio
+import time
+
+import pytest
+from unittest.mock import MagicMock
+
+from krs import throttle
+from krs.util import keycloak_version
+
+
+@pytest.mark.parametrize('method,path,expected', [
+    ('GET', '/users', 'users'),
+    ('GET', '/users/u1/groups', 'users'),
+    ('GET', '/groups/g1/members', 'members'),
+    ('GET', '/roles/admin/users', 'members'),
+    ('GET', '/clients/c1/roles/admin/users', 'members'),
+    ('GET', '/groups', 'other'),
+    ('PUT', '/users/u1/groups/g1', 'mutations'),
+    ('DELETE', '/groups/g1', 'mutations'),
+])
+def test_endpoint_class(method, path, expected):
+    assert throttle.endpoint_class(method, path) == expected
+
+
+def test_parse_limits():
+    assert throttle.parse_limits('') == {}
+    assert throttle.parse_limits('users=20:8, mutations=5:2') == {'users': (20., 8), 'mutations': (5., 2)}
+    with pytest.raises(ValueError):
+        throttle.parse_limits('users=20')
+    with pytest.raises(ValueError):
+        throttle.parse_limits('groups=1:1')
+
+
+def test_from_environment(monkeypatch):
+    client = MagicMock()
+    monkeypatch.setenv('KEYCLOAK_THROTTLE', '')
+    assert throttle.ThrottledRestClient.from_environment(client) is client
+    monkeypatch.setenv('KEYCLOAK_THROTTLE', 'users=10:2')
+    rc = throttle.ThrottledRestClient.from_environment(client)
+    assert rc.limiters['users'].rate == 10
+    assert rc.address is client.address
+
+
+@pytest.mark.asyncio
+async def test_max_in_flight():
+    running = 0
+    max_running = 0
+
+    async def request(method, path):
+        nonlocal running, max_running
+        running += 1
+        max_running = max(max_running, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+        return path
+
+    client = MagicMock()
+    client.request = request
+    rc = throttle.ThrottledRestClient(client, {'users': (0, 2)})
+
+    ret = await asyncio.gather(*[rc.request('GET', f'/users/{i}') for i in range(6)])
+    assert ret == [f'/users/{i}' for i in range(6)]
+    assert max_running == 2
+    stats = rc.stats()['users']
+    assert stats['requests'] == 6 and stats['in_flight'] == 0
+    assert stats['max_wait'] > 0
+    assert rc.stats()['mutations']['requests'] == 0
+
+
+@pytest.mark.asyncio
+async def test_rate():
+    async def request(method, path):
+        return path
+
+    client = MagicMock()
+    client.request = request
+    rc = throttle.ThrottledRestClient(client, {'mutations': (50, 0)})
+
+    start = time.monotonic()
+    await asyncio.gather(*[rc.request('PUT', '/users/u1') for _ in range(6)])
+    # first one immediately, then 5 at 50/s
+    assert 0.09 < time.monotonic() - start < 0.3
+    # other classes are not limited
+    start = time.monotonic()
+    await asyncio.gather(*[rc.request('GET', '/users/u1') for _ in range(6)])
+    assert time.monotonic() - start < 0.05
+
+
+@pytest.mark.asyncio
+async def test_keycloak_version():
+    client = MagicMock()
+    client.address = 'https://keycloak.test/auth/admin/realms/testrealm'
+    urls = []
+
+    async def request(method, path):
+        urls.append(client.address + path)
+        return {'systemInfo': {'version': '24.0.1'}}
+    client.request = request
+    rc = throttle.ThrottledRestClient(client, {'other': (0, 1)})
+
+    assert await keycloak_version(rc) == '24.0.1'
+    assert urls == ['https://keycloak.test/auth/admin/serverinfo']
+    assert rc.address == client.address == 'https://keycloak.test/auth/admin/realms/testrealm'
+    assert 'address' not in rc.__dict__
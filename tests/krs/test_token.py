@@ -0,0 +1,108 @@
+import json
+import time
+
+from unittest.mock import MagicMock
+
+from rest_tools.client import RestClient
+
+from krs import token
+
+
+def test_token_manager_cached():
+    fetch = MagicMock(return_value=('tok1', time.time() + 300))
+    tm = token.TokenManager(refresh_margin=60)
+    assert tm.get('key', fetch) == 'tok1'
+    assert tm.get('key', fetch) == 'tok1'
+    fetch.assert_called_once()
+    tm.clear()
+
+
+def test_token_manager_expired():
+    fetch = MagicMock(side_effect=[('tok1', time.time() + 5), ('tok2', time.time() + 300)])
+    tm = token.TokenManager(refresh_margin=0)
+    assert tm.get('key', fetch) == 'tok1'
+    # expires too soon to hand out
+    assert tm.get('key', fetch) == 'tok2'
+    tm.clear()
+
+
+def test_token_manager_background_refresh(monkeypatch):
+    monkeypatch.setattr(token, 'MIN_TOKEN_VALIDITY', 0)
+    fetch = MagicMock(side_effect=lambda: (f'tok{fetch.call_count}', time.time() + 0.4))
+    tm = token.TokenManager(refresh_margin=60)
+    assert tm.get('key', fetch) == 'tok1'
+    time.sleep(0.3)
+    assert fetch.call_count == 2
+    assert tm.get('key', fetch) == 'tok2'
+    tm.clear()
+
+
+def test_token_manager_unused_not_refreshed(monkeypatch):
+    monkeypatch.setattr(token, 'MIN_TOKEN_VALIDITY', 0)
+    fetch = MagicMock(side_effect=lambda: ('tok', time.time() + 0.4))
+    tm = token.TokenManager(refresh_margin=60)
+    tm.get('key', fetch)
+    time.sleep(0.3)
+    # refreshed once after use, then left alone
+    assert fetch.call_count == 2
+    time.sleep(0.4)
+    assert fetch.call_count == 2
+    tm.clear()
+
+
+def test_token_manager_file(tmp_path):
+    filename = str(tmp_path / 'tokens.json')
+    fetch = MagicMock(return_value=('tok1', time.time() + 300))
+    tm = token.TokenManager(filename, refresh_margin=60)
+    tm.get('key', fetch)
+    tm.clear()
+    assert json.load(open(filename))['key'][0] == 'tok1'
+    assert (tmp_path / 'tokens.json').stat().st_mode & 0o077 == 0
+
+    # another process
+    tm = token.TokenManager(filename, refresh_margin=60)
+    assert tm.get('key', MagicMock(side_effect=Exception)) == 'tok1'
+    tm.clear()
+
+
+def test_get_token(mocker):
+    mocker.patch('krs.token._token_manager', token.TokenManager())
+    post = mocker.patch('requests.post')
+    post.return_value.json.return_value = {'access_token': 'tok', 'expires_in': 300}
+    assert token.get_token('http://kc', 'client', 'secret') == 'tok'
+    assert token.get_token('http://kc', 'client', 'secret') == 'tok'
+    post.assert_called_once()
+    # different credentials get their own token
+    token.get_token('http://kc', 'client', 'secret2')
+    assert post.call_count == 2
+    token.get_token_manager().clear()
+
+
+def test_configure_connection_pool():
+    rc = RestClient('http://kc', retries=3)
+    token.configure_connection_pool(rc, pool_workers=32)
+    assert rc.session.executor._max_workers == 32
+    adapter = rc.session.get_adapter('https://kc')
+    assert adapter.max_retries.total == 3
+    assert adapter.poolmanager.connection_pool_kw['maxsize'] == 32
+    assert adapter.poolmanager.connection_pool_kw['block'] is True
+
+    token.configure_connection_pool(rc, pool_maxsize=4)
+    assert rc.session.executor._max_workers == 32
+    assert rc.session.get_adapter('http://kc').poolmanager.connection_pool_kw['maxsize'] == 4
+    rc.close()
+
+
+def test_token_manager_short_lifetime(monkeypatch):
+    monkeypatch.setattr(token, 'MIN_TOKEN_VALIDITY', 0)
+    fetch = MagicMock(side_effect=lambda: (f'tok{fetch.call_count}', time.time() + 0.8))
+    tm = token.TokenManager(refresh_margin=60)
+    assert tm.get('key', fetch) == 'tok1'
+    # not refreshed right away, despite the margin being longer than the lifetime
+    time.sleep(0.2)
+    assert fetch.call_count == 1
+    # refreshed halfway through the lifetime, before expiring
+    time.sleep(0.4)
+    assert fetch.call_count == 2
+    assert tm.get('key', fetch) == 'tok2'
+    tm.clear()
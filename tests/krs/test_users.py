@@ -1,5 +1,6 @@
 # noinspection PyPackageRequirements
 import pytest
+from unittest.mock import AsyncMock, MagicMock
 
 from krs import users
 
@@ -251,3 +252,185 @@ async def test_set_user_password_bad(keycloak_bootstrap):
 async def test_delete_user(keycloak_bootstrap):
     await users.create_user('testuser', first_name='first', last_name='last', email='foo@test', rest_client=keycloak_bootstrap)
     await users.delete_user('testuser', rest_client=keycloak_bootstrap)
+
+
+@pytest.fixture
+def user_cache(mocker):
+    cache = users.UserLookupCache(maxsize=2, ttl=300, negative_ttl=300)
+    mocker.patch('krs.users._user_cache', cache)
+    return cache
+
+
+@pytest.mark.asyncio
+async def test_user_info_cached(user_cache):
+    rc = MagicMock()
+    rc.request = AsyncMock(side_effect=[[{'id': 'u1', 'username': 'alice', 'attributes': {}}], []])
+
+    ret = await users.user_info('alice', rest_client=rc)
+    ret['attributes']['foo'] = 'bar'  # callers can't modify cached values
+    assert await users.user_info('alice', rest_client=rc) == {'id': 'u1', 'username': 'alice', 'attributes': {}}
+    assert rc.request.call_count == 1
+
+    # negative caching
+    for _ in range(2):
+        with pytest.raises(users.UserDoesNotExist):
+            await users.user_info('bob', rest_client=rc)
+    assert rc.request.call_count == 2
+    assert (user_cache.hits, user_cache.misses) == (2, 2)
+
+    # cache is per realm
+    rc2 = MagicMock()
+    rc2.request = AsyncMock(return_value=[])
+    with pytest.raises(users.UserDoesNotExist):
+        await users.user_info('alice', rest_client=rc2)
+
+
+def test_user_cache_bounds(user_cache):
+    user_cache.put('realm', 'a', {'username': 'a'})
+    user_cache.put('realm', 'b', None)
+    user_cache.get('realm', 'a')
+    user_cache.put('realm', 'c', {'username': 'c'})
+    # least recently used is evicted
+    assert user_cache.get('realm', 'b') == (False, None)
+    assert user_cache.get('realm', 'a') == (True, {'username': 'a'})
+
+    user_cache.ttl = 0
+    user_cache.put('realm', 'd', {'username': 'd'})
+    assert user_cache.get('realm', 'd') == (False, None)
+
+
+@pytest.mark.asyncio
+async def test_user_cache_invalidated_by_writes(user_cache):
+    rc = MagicMock()
+    user = {'id': 'u1', 'username': 'alice', 'attributes': {}, 'requiredActions': []}
+    rc.request = AsyncMock(side_effect=lambda method, url, *args: [user] if url.startswith('/users?') else user)
+
+    await users.user_info('alice', rest_client=rc)
+    await users.modify_user('alice', first_name='Alice', rest_client=rc)
+    assert user_cache.get(rc.address, 'alice') == (False, None)
+
+    await users.user_info('alice', rest_client=rc)
+    await users.delete_user('alice', rest_client=rc)
+    assert user_cache.get(rc.address, 'alice') == (False, None)
+
+
+@pytest.mark.asyncio
+async def test_user_writes_bypass_cache(user_cache):
+    rc = MagicMock()
+    user = {'id': 'u2', 'username': 'alice', 'attributes': {}, 'requiredActions': []}
+    rc.request = AsyncMock(side_effect=lambda method, url, *args: [user] if url.startswith('/users?') else user)
+    # stale entries: alice was recorded missing, or with the id of a deleted account
+    for write in (users.delete_user, users.set_user_password, users.modify_user):
+        user_cache.put(rc.address, 'alice', None)
+        kwargs = {'password': 'pw'} if write is users.set_user_password else {}
+        await write('alice', rest_client=rc, **kwargs)
+        assert any(c.args[1].startswith('/users/u2') for c in rc.request.call_args_list)
+        rc.request.reset_mock()
+
+    user_cache.put(rc.address, 'alice', dict(user, id='u1'))
+    await users.modify_user('alice', first_name='Alice', rest_client=rc)
+    assert not any('/u1' in c.args[1] for c in rc.request.call_args_list)
+
+
+def test_configure_user_cache(monkeypatch, mocker):
+    mocker.patch('krs.users._user_cache', None)
+    monkeypatch.delenv('KRS_USER_CACHE_TTL', raising=False)
+    assert users.get_user_cache().ttl == 300
+    assert users.configure_user_cache(long_running=True).ttl == 0
+    assert users.get_user_cache().ttl == 0
+    monkeypatch.setenv('KRS_USER_CACHE_TTL', '30')
+    assert users.configure_user_cache(long_running=True).ttl == 30
+
+
+def make_rest_client(usernames):
+    def request(method, url, *args):
+        if url == '/users/count':
+            return len(usernames)
+        if url.startswith('/users?exact=true'):
+            username = url.split('username=')[1]
+            return [{'username': username}] if username in usernames else []
+        if url.startswith('/users?'):
+            first = int(url.split('first=')[1].split('&')[0])
+            return [{'username': u} for u in usernames[first:first+50]]
+        raise Exception(f'unexpected request {url}')
+    rc = MagicMock()
+    rc.request = AsyncMock(side_effect=request)
+    return rc
+
+
+@pytest.mark.asyncio
+async def test_get_users_lookups(user_cache):
+    rc = make_rest_client([f'user{i}' for i in range(1000)])
+    ret, missing = await users.get_users(['user3', 'user1', 'nobody', 'user3'], rest_client=rc)
+    assert list(ret) == ['user3', 'user1']
+    assert missing == ['nobody']
+    assert rc.request.call_count == 3
+
+
+@pytest.mark.asyncio
+async def test_get_users_scan(user_cache):
+    user_cache.maxsize = 1000
+    rc = make_rest_client([f'user{i}' for i in range(100)])
+    wanted = [f'user{i}' for i in range(20)] + ['nobody']
+    ret, missing = await users.get_users(wanted, concurrency=4, rest_client=rc)
+    assert list(ret) == wanted[:-1]
+    assert missing == ['nobody']
+    urls = [c.args[1] for c in rc.request.call_args_list]
+    assert not any(url.startswith('/users?exact=true') for url in urls)
+
+    # results were cached
+    rc.request.reset_mock()
+    ret, missing = await users.get_users(wanted, concurrency=4, rest_client=rc)
+    assert len(ret) == 20 and missing == ['nobody']
+    rc.request.assert_not_called()
+
+    # bypassing the cache
+    ret, missing = await users.get_users(wanted, concurrency=4, rest_client=rc, use_cache=False)
+    assert len(ret) == 20 and missing == ['nobody']
+    rc.request.assert_called()
+
+
+@pytest.mark.asyncio
+async def test_canonical_email_allocator_local():
+    existing = {
+        'first.last': {'username': 'first.last', 'attributes': {}},
+        'u1': {'username': 'u1', 'attributes': {'canonical_email': 'jane.doe@icecube.wisc.edu'}},
+    }
+    allocator = users.CanonicalEmailAllocator(existing)
+    rc = MagicMock()
+    rc.request = AsyncMock()
+
+    assert await allocator.allocate('John', 'Doe', rest_client=rc) == 'john.doe@icecube.wisc.edu'
+    # in use as a username, a canonical address, and allocated just now
+    for first, last in [('First', 'Last'), ('Jane', 'Doe'), ('John', 'Doe')]:
+        address = await allocator.allocate(first, last, rest_client=rc)
+        local_part = address.split('@')[0]
+        stem = users.canonical_email_stem(first, last)
+        assert local_part.startswith(stem)
+        assert 100 <= int(local_part[len(stem):]) <= 600
+    rc.request.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_canonical_email_allocator_remote(user_cache):
+    async def request(method, url, *args):
+        in_use = 'q="canonical_email":"first.last@' in url or url.endswith('username=first.last')
+        return [{'username': 'x'}] if in_use else []
+    rc = MagicMock()
+    rc.request = AsyncMock(side_effect=request)
+
+    address = await users.CanonicalEmailAllocator().allocate('First', 'Last', rest_client=rc)
+    assert address.startswith('first.last') and address != 'first.last@icecube.wisc.edu'
+    # one request for the standard address, then two for the salted one
+    assert rc.request.call_count == 3
+    urls = [c.args[1] for c in rc.request.call_args_list]
+    assert not any(url.startswith('/users/count') for url in urls)
+    assert f'username={address.split("@")[0]}' in urls[-1]
+
+
+@pytest.mark.asyncio
+async def test_canonical_email_allocator_exhausted():
+    existing = {str(i): {'username': f'a.b{i}', 'attributes': {}} for i in range(100, 601)}
+    existing['x'] = {'username': 'a.b', 'attributes': {}}
+    with pytest.raises(Exception, match='in use'):
+        await users.CanonicalEmailAllocator(existing).allocate('A', 'B')
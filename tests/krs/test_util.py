@@ -1,3 +1,5 @@
+import asyncio
+
 import pytest
 
 from packaging import version
@@ -14,3 +16,49 @@ async def test_keycloak_version(keycloak_bootstrap):
     # Check that our rest client is still functional
     ret = await keycloak_bootstrap.request('GET', '/')
     assert 'realm' in ret
+
+
+class FakePagedClient:
+    """Serve a list of items in pages, with later pages arriving first."""
+    def __init__(self, items):
+        self.items = items
+        self.urls = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def request(self, method, url):
+        self.urls.append(url)
+        params = dict(p.split('=') for p in url.split('?', 1)[1].split('&'))
+        first, num = int(params['first']), int(params['max'])
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        await asyncio.sleep(0.01 * (10 - first // num % 10))
+        self.in_flight -= 1
+        return self.items[first:first+num]
+
+
+@pytest.mark.asyncio
+async def test_paginate_total():
+    client = FakePagedClient(list(range(95)))
+    ret = [i async for i in util.paginate(client, '/items?foo=bar', total=95, page_size=10, concurrency=3)]
+    assert ret == list(range(95))
+    assert len(client.urls) == 10
+    assert client.urls[0] == '/items?foo=bar&first=0&max=10'
+    assert client.urls[-1] == '/items?foo=bar&first=90&max=5'
+    assert client.max_in_flight == 3
+
+
+@pytest.mark.asyncio
+async def test_paginate_unknown_total():
+    client = FakePagedClient(list(range(20)))
+    ret = [i async for i in util.paginate(client, '/items', page_size=10, concurrency=4)]
+    assert ret == list(range(20))
+    assert client.urls[0] == '/items?first=0&max=10'
+
+
+@pytest.mark.asyncio
+async def test_paginate_empty():
+    client = FakePagedClient([])
+    ret = [i async for i in util.paginate(client, '/items', total=0)]
+    assert ret == []
+    assert client.urls == []
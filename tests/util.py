@@ -2,13 +2,14 @@ import os
 from functools import partial
 
 import pytest
-from ldap3 import Connection
+from ldap3 import Server, Connection, MOCK_SYNC, OFFLINE_SLAPD_2_4
 from rest_tools.client import RestClient
 from wipac_dev_tools import from_environment
 import requests
 
 from krs import bootstrap
 from krs.token import get_token
+from krs.users import get_user_cache
 from krs import ldap
 from krs import rabbitmq
 
@@ -21,6 +22,8 @@ def keycloak_bootstrap(monkeypatch):
 
     secret = bootstrap.bootstrap()
     monkeypatch.setenv('KEYCLOAK_CLIENT_SECRET', secret)
+    # the realm is recreated for each test
+    get_user_cache().invalidate()
 
     # make sure rabbitmq is set up for tests
     tok = bootstrap.get_token()
@@ -91,8 +94,27 @@ def ldap_bootstrap(monkeypatch):
     try:
         yield obj
     finally:
+        obj.close()
         cleanup()
 
+@pytest.fixture
+def mock_ldap(monkeypatch, mocker):
+    monkeypatch.setenv('LDAP_URL', 'ldap://mock')
+    server = Server('mock', get_info=OFFLINE_SLAPD_2_4)
+    mocker.patch('krs.ldap.Connection', lambda s, user=None, password=None: Connection(
+        server, user=user, password=password, client_strategy=MOCK_SYNC))
+    add_mock_entry(server, 'cn=admin,dc=icecube,dc=wisc,dc=edu', {'userPassword': 'admin', 'sn': 'admin'})
+
+    obj = ldap.LDAP()
+    obj.server = server
+    try:
+        yield obj
+    finally:
+        obj.close()
+
+def add_mock_entry(server, dn, attrs):
+    Connection(server, client_strategy=MOCK_SYNC).strategy.add_entry(dn, attrs)
+
 @pytest.fixture(scope="session")
 def rabbitmq_bootstrap():
     config = from_environment({